@@ -1,6 +1,5 @@
 import os
-import torch
-import soundfile as sf
+import sys
 import pandas as pd
 import numpy as np
 from tqdm import tqdm
@@ -8,112 +7,102 @@ from tqdm import tqdm
 from argparse import ArgumentParser
 
 from transformers import logging
-from transformers.models.wav2vec2 import Wav2Vec2Model
+
+# Featurizer, feature store and cache shared with scripts/wav_to_w2v2-feats.py
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'scripts'))
+from feature_store import load_feature_store, resolve_feats_path
+from run_cache import FeatureCache, file_sha1, params_sha1
+from w2v2_featurizer import KNOWN_MODELS, load_wav2vec2_featurizer
 
 logging.set_verbosity(40)
 
+# wav2vec 2.0 outputs one frame every 20 ms
+FRAME_RATE = 50
+
 parser = ArgumentParser(
     prog='Wav2Vec2 Featurizer',
     description='Extract features aggregated across intervals specified in input csv file',
 )
 
 parser.add_argument('--model', default='wav2vec2-large-xlsr-53')
-parser.add_argument('--intervals_csv', help = 'CSV file of intervals')
+parser.add_argument('--stage', default='transformer', choices=['encoder', 'quantizer', 'transformer'], help = 'name of wav2vec 2.0 output stage')
+parser.add_argument('--layer', default=11, type=int, help = 'if stage is transformer, which layer of transformer')
+parser.add_argument('--intervals_csv', help = 'CSV file of intervals (columns: xmin, xmax, text, file)')
 parser.add_argument('--features_csv', help = 'Name of output CSV file')
+parser.add_argument('--wav_dir', default='', help = 'directory relative to which wav files in the intervals CSV are found')
+parser.add_argument('--feats_file', default=None, help = 'if given, read features from this file written by wav_to_w2v2-feats.py (e.g. data/interim/features/gos-kdl/wav2vec2-large-xlsr-53_transformer-L11/references.npy) instead of featurizing the wav files')
+parser.add_argument('--cache_dir', default=None, help = 'if given, read and add features of each wav file from/to this cache (shared with wav_to_w2v2-feats.py --cache_dir)')
+parser.add_argument('--num_threads', default=None, type=int, help = 'number of threads used by torch on CPU (default: torch default)')
 
 args = parser.parse_args()
 
-KNOWN_MODELS = {
-    # Pre-trained
-    'wav2vec2-base': 'facebook/wav2vec2-base',
-    'wav2vec2-large': {'name' : 'facebook/wav2vec2-large', 'revision' : '85c73b1a7c1ee154fd7b06634ca7f42321db94db' },
-    # March 11, 2021 version: https://huggingface.co/facebook/wav2vec2-large/commit/85c73b1a7c1ee154fd7b06634ca7f42321db94db
-    'wav2vec2-large-lv60': 'facebook/wav2vec2-large-lv60',
-    'wav2vec2-large-xlsr-53': {'name' : 'facebook/wav2vec2-large-xlsr-53', 'revision' : '8e86806e53a4df405405f5c854682c785ae271da' },
-    # May 6, 2021 version: https://huggingface.co/facebook/wav2vec2-large-xlsr-53/commit/8e86806e53a4df405405f5c854682c785ae271da
-    
-    # Fine-tuned
-    'wav2vec2-base-960h': 'facebook/wav2vec2-base-960h',
-    'wav2vec2-large-960h': 'facebook/wav2vec2-large-960h',
-    'wav2vec2-large-960h-lv60': 'facebook/wav2vec2-large-960h-lv60',
-    'wav2vec2-large-960h-lv60-self': 'facebook/wav2vec2-large-960h-lv60-self',
-    'wav2vec2-large-xlsr-53-english': 'jonatasgrosman/wav2vec2-large-xlsr-53-english',
-    'wav2vec2-large-xlsr-53-tamil': 'manandey/wav2vec2-large-xlsr-tamil'
-}
-
-def load_wav2vec2_featurizer(model, layer=None):
-    """
-    Loads Wav2Vec2 featurization pipeline and returns it as a function.
-    Featurizer returns a list with all hidden layer representations if "layer" argument is None.
-    Otherwise, only returns the specified layer representations.
-    """
-
-    model_spec = KNOWN_MODELS.get(model, model)
-    model_kwargs = {}
-    if layer is not None:
-        model_kwargs["num_hidden_layers"] = layer if layer > 0 else 0
-
-    if type(model_spec) is dict:
-        model_name_or_path       = model_spec['name']
-        model_kwargs['revision'] = model_spec['revision']
-    else:
-        model_name_or_path = model_spec
-    
-    model = Wav2Vec2Model.from_pretrained(model_name_or_path, **model_kwargs)
-
-    num_gpus = torch.cuda.device_count()
-
-    if num_gpus > 1:
-        model = torch.nn.DataParallel(model)
-
-    model.eval()
-    if torch.cuda.is_available():
-        model.cuda()
-
-    @torch.no_grad()
-    def _featurize(path):
-        input_values, rate = sf.read(path, dtype=np.float32)
-        assert rate == 16_000
-        input_values = torch.from_numpy(input_values).unsqueeze(0)
-        if torch.cuda.is_available():
-            input_values = input_values.cuda()
-
-        if layer is None:
-            hidden_states = model(input_values, output_hidden_states=True).hidden_states
-            hidden_states = [s.squeeze(0).cpu().numpy() for s in hidden_states]
-            return hidden_states
-
-        if layer >= 0:
-            hidden_state = model(input_values).last_hidden_state.squeeze(0).cpu().numpy()
-        else:
-            hidden_state = model.feature_extractor(input_values) if num_gpus <= 1 else model.module.feature_extractor(input_values)
-            hidden_state = hidden_state.transpose(1, 2)
-            if layer == -1:
-                hidden_state = model.feature_projection(hidden_state) if num_gpus <= 1 else model.module.feature_projection(hidden_state)
-            hidden_state = hidden_state.squeeze(0).cpu().numpy()
-
-        return hidden_state
-
-    return _featurize
-
-featurizer = load_wav2vec2_featurizer(args.model, layer=11)
-
-segs_df    = pd.read_csv(args.intervals_csv)
-
-feat_names = ["file", "text"] + [ "d" + str(n + 1).zfill(4) for n in range(1024) ]
-feats_df   = pd.DataFrame(columns = feat_names)
-
-for i in tqdm(range(segs_df.shape[0])):
-    soi = segs_df.iloc[i]
-
-    T11_feats  = featurizer(soi.file)
-    
-    soi_start = round((soi.xmin) * 50)
-    soi_end   = round((soi.xmax) * 50)
-
-    new_row   = [ soi.file, soi.text ] + list(np.mean(T11_feats[soi_start:soi_end,:], axis=0))
-    new_row   = dict(zip(feat_names, new_row))
-    
-    feats_df = feats_df.append(new_row, ignore_index=True, sort=False)
-
-feats_df.to_csv(args.features_csv, index = False)
+layer = { 'encoder' : -2, 'quantizer' : -1 }.get(args.stage, args.layer)
+
+store = load_feature_store(resolve_feats_path(args.feats_file)) if args.feats_file is not None else None
+cache = FeatureCache(args.cache_dir) if args.cache_dir is not None else None
+
+featurizer = None
+
+def file_feats(wav_file):
+    '''
+    Features of a wav file, from the feature store or cache if available, otherwise from
+    the model (loaded on first use, so that it is not loaded if all features are stored)
+    '''
+
+    global featurizer
+
+    if store is not None:
+        filename = os.path.splitext(os.path.basename(wav_file))[0]
+        assert filename in store.index, f'No features for {filename} in {args.feats_file}'
+        return store[filename]
+
+    wav_path = os.path.join(args.wav_dir, wav_file)
+
+    if cache is not None:
+        # Same key as wav_to_w2v2-feats.py (non-streaming)
+        cache_key = params_sha1(file_sha1(wav_path), KNOWN_MODELS.get(args.model, args.model), layer, None)
+
+        if cache_key in cache:
+            return cache.get(cache_key)
+
+    if featurizer is None:
+        featurizer = load_wav2vec2_featurizer(args.model, layer=layer, num_threads=args.num_threads)
+
+    feats = featurizer(wav_path)
+
+    if cache is not None:
+        cache.put(cache_key, feats)
+
+    return feats
+
+def interval_means(feats, xmin, xmax):
+    '''
+    Mean of the feature frames within each interval (in seconds), for all intervals at once from
+    cumulative sums over frames. Intervals without any frames get NaN (as np.mean of an empty slice)
+    '''
+
+    n_frames = feats.shape[0]
+    starts   = np.clip(np.round(np.asarray(xmin) * FRAME_RATE).astype(int), 0, n_frames)
+    ends     = np.clip(np.round(np.asarray(xmax) * FRAME_RATE).astype(int), 0, n_frames)
+
+    cum_feats = np.zeros((n_frames + 1, feats.shape[1]))
+    np.cumsum(feats, axis=0, dtype=np.float64, out=cum_feats[1:])
+
+    lengths = (ends - starts).astype(np.float64)
+    lengths[lengths <= 0] = np.nan
+
+    return (cum_feats[ends] - cum_feats[starts]) / lengths[:, None]
+
+segs_df = pd.read_csv(args.intervals_csv)
+
+# Rows are written one file at a time (files in order of first appearance, intervals
+# within a file in input order), so each file is featurized once and the output is
+# never held in memory in full
+with open(args.features_csv, 'w', newline='') as features_csv:
+    for i, (wav_file, file_segs) in enumerate(tqdm(segs_df.groupby('file', sort=False))):
+        means = interval_means(file_feats(wav_file), file_segs.xmin.values, file_segs.xmax.values)
+
+        feat_names = [ "d" + str(n + 1).zfill(4) for n in range(means.shape[1]) ]
+        feats_df   = pd.concat([ file_segs[["file", "text"]].reset_index(drop=True), pd.DataFrame(means, columns=feat_names) ], axis=1)
+
+        feats_df.to_csv(features_csv, header=(i == 0), index=False)
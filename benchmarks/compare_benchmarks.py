@@ -0,0 +1,53 @@
+import argparse
+import json
+import sys
+
+parser = argparse.ArgumentParser(
+    description='Compare benchmark results (from run_benchmarks.py) against a baseline and flag regressions. example: python benchmarks/compare_benchmarks.py benchmarks/results/baseline.json benchmarks/results/latest.json',
+    formatter_class=argparse.ArgumentDefaultsHelpFormatter
+    )
+
+parser.add_argument('baseline', help = "JSON file with baseline results")
+parser.add_argument('current', help = "JSON file with results to compare")
+parser.add_argument('--tolerance',  default=0.1, type=float, help = "flag a regression if throughput (frames/s) drops by more than this fraction of the baseline")
+
+args = parser.parse_args()
+
+baseline = json.load(open(args.baseline))
+current  = json.load(open(args.current))
+
+# Throughputs are only comparable for the same data sizes and settings
+config_diffs = { k : (baseline['config'].get(k), v) for k, v in current['config'].items() if baseline['config'].get(k) != v }
+
+if len(config_diffs) > 0:
+    print("Warning: benchmark settings differ from baseline: " + ", ".join("{} ({} vs. {})".format(k, b, c) for k, (b, c) in config_diffs.items()))
+
+if baseline['machine'] != current['machine']:
+    print("Warning: benchmarks were run on different machines or software versions")
+
+regressions = []
+
+print("{:<32} {:>16} {:>16} {:>8}".format("benchmark", "baseline (fr/s)", "current (fr/s)", "ratio"))
+
+for name, result in current['results'].items():
+    if name not in baseline['results']:
+        print("{:<32} {:>16} {:>16.1f} {:>8}".format(name, "-", result['frames_per_sec'], "new"))
+        continue
+
+    baseline_fps = baseline['results'][name]['frames_per_sec']
+    ratio        = result['frames_per_sec'] / baseline_fps
+    regressed    = ratio < 1 - args.tolerance
+
+    if regressed:
+        regressions.append(name)
+
+    print("{:<32} {:>16.1f} {:>16.1f} {:>8.2f}{}".format(name, baseline_fps, result['frames_per_sec'], ratio, "  REGRESSION" if regressed else ""))
+
+for name in baseline['results'].keys() - current['results'].keys():
+    print("{:<32} not in current results".format(name))
+
+if len(regressions) > 0:
+    print("{} regression(s) of more than {:.0%}: {}".format(len(regressions), args.tolerance, ", ".join(regressions)))
+    sys.exit(1)
+
+print("No regressions of more than {:.0%}".format(args.tolerance))
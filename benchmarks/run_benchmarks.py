@@ -0,0 +1,272 @@
+import argparse
+import json
+import os
+import pickle
+import platform
+import sys
+import tempfile
+import time
+import numpy as np
+import pandas as pd
+import soundfile as sf
+from datetime import datetime
+from pathlib import Path
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'scripts'))
+from feature_store import FeatureStore, FeatureWriter, load_feature_store
+from segmental_dtw import SEGDTW_IMPLEMENTATIONS, feats_to_distance_matrix, iter_distance_matrices, segdtw_sim_score
+from synthetic_data import make_feats, make_wavs
+
+STAGES = [ 'distance', 'segdtw', 'io', 'w2v2' ]
+
+parser = argparse.ArgumentParser(
+    description='Time the stages of the QbE-STD pipeline on synthetic data and write results to JSON. example: python benchmarks/run_benchmarks.py --output benchmarks/results/baseline.json',
+    formatter_class=argparse.ArgumentDefaultsHelpFormatter
+    )
+
+parser.add_argument('--output',  default='benchmarks/results/latest.json', help = "JSON file for results")
+parser.add_argument('--stages',  default=','.join(STAGES), help = "comma-separated stages to run, from: {}".format(', '.join(STAGES)))
+parser.add_argument('--repeats',  default=3, type=int, help = "number of times each benchmark is run (the fastest run is reported)")
+parser.add_argument('--data_dir',  default=None, help = "directory for synthetic data (default: a temporary directory, removed afterwards)")
+
+parser.add_argument('--n_queries',  default=5, type=int, help = "number of synthetic queries")
+parser.add_argument('--n_references',  default=20, type=int, help = "number of synthetic references")
+parser.add_argument('--query_frames',  default=60, type=int, help = "mean number of frames per query")
+parser.add_argument('--reference_frames',  default=1000, type=int, help = "mean number of frames per reference")
+parser.add_argument('--dims',  default=1024, type=int, help = "number of feature columns")
+parser.add_argument('--seed',  default=1, type=int, help = "random seed for synthetic data")
+
+parser.add_argument('--dtw_impls',  default='numpy,numpy-pruned', help = "comma-separated segmental DTW implementations to time, from: {}".format(', '.join(SEGDTW_IMPLEMENTATIONS.keys())))
+parser.add_argument('--top_k',  default=5, type=int, help = "also time numpy-pruned with the k-th best score per query as abandoning threshold (as in feats_to_dtw.py --top_k), 0 to skip")
+
+parser.add_argument('--n_wavs',  default=5, type=int, help = "number of synthetic wav files for wav2vec 2.0 inference")
+parser.add_argument('--wav_seconds',  default=10.0, type=float, help = "mean duration of synthetic wav files in seconds")
+parser.add_argument('--w2v2_model',  default=None, help = "wav2vec 2.0 model name or path (see w2v2_featurizer.py); by default, a randomly initialised model of --w2v2_size is used, so that no download is needed")
+parser.add_argument('--w2v2_size',  default='large', choices=['base', 'large'], help = "architecture of randomly initialised model (large: as wav2vec2-large-xlsr-53)")
+parser.add_argument('--w2v2_layer',  default=11, type=int, help = "wav2vec 2.0 layer to extract (-2: encoder, -1: quantizer, 1 to N: transformer layers)")
+parser.add_argument('--num_threads',  default=None, type=int, help = "number of threads used by torch on CPU (default: torch default)")
+
+args = parser.parse_args()
+
+def time_best(fn):
+    """
+    Runs fn args.repeats times and returns the shortest time in seconds (and fn's last return value)
+    """
+
+    times = []
+
+    for _ in range(args.repeats):
+        start_time = time.perf_counter()
+        value      = fn()
+        times.append(time.perf_counter() - start_time)
+
+    return min(times), value
+
+def result(seconds, frames, pairs = None, **extra):
+    r = { 'seconds' : seconds, 'frames' : int(frames), 'frames_per_sec' : frames / seconds }
+
+    if pairs is not None:
+        r.update({ 'pairs' : int(pairs), 'pairs_per_sec' : pairs / seconds })
+
+    r.update(extra)
+
+    return r
+
+def bench_distance(queries, references):
+    """
+    Distance matrices for all query-reference pairs: one cdist call per pair (feats_to_distance_matrix)
+    and batched over references (iter_distance_matrices). Frames are reference frames searched
+    """
+
+    pairs  = len(queries) * len(references)
+    frames = len(queries) * sum(r.shape[0] for r in references)
+
+    def per_pair():
+        for q in queries:
+            for r in references:
+                feats_to_distance_matrix(q, r)
+
+    def batched():
+        for q in queries:
+            for _ in iter_distance_matrices(q, references):
+                pass
+
+    return {
+        'distance/cdist' : result(time_best(per_pair)[0], frames, pairs),
+        'distance/batched' : result(time_best(batched)[0], frames, pairs)
+    }
+
+def bench_segdtw(queries, references):
+    """
+    Segmental DTW on precomputed distance matrices of all query-reference pairs, for each implementation
+    """
+
+    distance_matrices = [ list(iter_distance_matrices(q, references)) for q in queries ]
+
+    pairs  = len(queries) * len(references)
+    frames = len(queries) * sum(r.shape[0] for r in references)
+
+    results = {}
+
+    for impl in args.dtw_impls.split(','):
+        segdtw_impl = SEGDTW_IMPLEMENTATIONS[impl]
+
+        def run():
+            return [ [ segdtw_sim_score(segdtw_impl(dm)) for dm in query_dms ] for query_dms in distance_matrices ]
+
+        seconds, scores = time_best(run)
+        results['segdtw/' + impl] = result(seconds, frames, pairs)
+
+    # Pruned search for the top k references per query, with the running k-th best distance as threshold
+    if args.top_k > 0 and 'numpy-pruned' in SEGDTW_IMPLEMENTATIONS:
+        def run_top_k():
+            n_offsets, n_pruned = 0, 0
+
+            for query_dms in distance_matrices:
+                best = []
+
+                for dm in query_dms:
+                    max_dist = np.inf if len(best) < args.top_k else best[args.top_k - 1]
+                    dists    = SEGDTW_IMPLEMENTATIONS['numpy-pruned'](dm, max_dist = max_dist)
+
+                    n_offsets += len(dists)
+                    n_pruned  += int(np.isinf(dists).sum())
+                    best       = sorted(best + [ dists.min() ])[:args.top_k]
+
+            return n_pruned / max(n_offsets, 1)
+
+        seconds, pruned_rate = time_best(run_top_k)
+        results['segdtw/numpy-pruned-top{}'.format(args.top_k)] = result(seconds, frames, pairs, pruned_rate = pruned_rate)
+
+    return results
+
+def bench_io(feats_dir):
+    """
+    Reading features (.npy, memory-mapped, and legacy .pickle), and writing them with FeatureWriter.
+    Frames are feature frames read or written (queries and references)
+    """
+
+    splits = [ 'queries', 'references' ]
+    stores = { split : load_feature_store(os.path.join(feats_dir, split + '.npy')) for split in splits }
+    frames = sum(store.data.shape[0] for store in stores.values())
+    nbytes = sum(os.path.getsize(os.path.join(feats_dir, split + '.npy')) for split in splits)
+
+    def load_npy():
+        # Touch every file's features, so that memory-mapped data is actually read
+        for split in splits:
+            store = FeatureStore.from_npy(os.path.join(feats_dir, split + '.npy'))
+            for filename in store.filenames:
+                np.asarray(store[filename]).sum()
+
+    def load_pickle():
+        for split in splits:
+            feats_df = pickle.load(open(os.path.join(feats_dir, split + '.pickle'), 'rb'))
+            FeatureStore.from_dataframe(feats_df)
+
+    def write_npy():
+        with tempfile.TemporaryDirectory() as write_dir:
+            for split, store in stores.items():
+                with FeatureWriter(os.path.join(write_dir, split + '.npy')) as writer:
+                    for filename in store.filenames:
+                        writer.append(filename, store[filename])
+
+    load_seconds = time_best(load_npy)[0]
+
+    return {
+        'io/npy_load' : result(load_seconds, frames, mb_per_sec = nbytes / 1e6 / load_seconds),
+        'io/pickle_load' : result(time_best(load_pickle)[0], frames),
+        'io/npy_write' : result(time_best(write_npy)[0], frames)
+    }
+
+def bench_w2v2(wav_dir):
+    """
+    wav2vec 2.0 CPU inference (including reading wav files), one file at a time.
+    Frames are output frames; also reports seconds of audio featurized per second
+    """
+
+    import torch
+    from transformers import logging
+    from w2v2_featurizer import load_wav2vec2_featurizer
+
+    logging.set_verbosity(40)
+
+    wav_paths     = make_wavs(wav_dir, args.n_wavs, args.wav_seconds, seed = args.seed)
+    audio_seconds = sum(sf.info(p).duration for p in wav_paths)
+
+    model = args.w2v2_model
+
+    if model is None:
+        from transformers import Wav2Vec2Config, Wav2Vec2Model
+
+        if args.w2v2_size == 'large':
+            config = Wav2Vec2Config(hidden_size = 1024, num_hidden_layers = 24, num_attention_heads = 16, intermediate_size = 4096,
+                feat_extract_norm = 'layer', conv_bias = True, do_stable_layer_norm = True)
+        else:
+            config = Wav2Vec2Config()
+
+        model = os.path.join(wav_dir, 'w2v2-random-' + args.w2v2_size)
+        Wav2Vec2Model(config).save_pretrained(model)
+
+    featurizer = load_wav2vec2_featurizer(model, layer = args.w2v2_layer, num_threads = args.num_threads)
+
+    def run():
+        return sum(featurizer(p).shape[0] for p in wav_paths)
+
+    # Warm-up run, so that one-off allocations are not timed
+    featurizer(wav_paths[0])
+
+    seconds, frames = time_best(run)
+
+    return {
+        'w2v2/cpu_inference' : result(seconds, frames, audio_seconds_per_sec = audio_seconds / seconds, torch_threads = torch.get_num_threads())
+    }
+
+def main():
+    stages = args.stages.split(',')
+    assert set(stages).issubset(STAGES), "Unknown stages: {}".format(set(stages).difference(STAGES))
+
+    with tempfile.TemporaryDirectory() as temp_dir:
+        data_dir  = args.data_dir or temp_dir
+        feats_dir = os.path.join(data_dir, 'features')
+
+        make_feats(feats_dir, args.n_queries, args.n_references, args.query_frames, args.reference_frames, args.dims, seed = args.seed)
+
+        queries_store    = load_feature_store(os.path.join(feats_dir, 'queries.npy'))
+        references_store = load_feature_store(os.path.join(feats_dir, 'references.npy'))
+
+        queries    = [ np.array(queries_store[f]) for f in queries_store.filenames ]
+        references = [ np.array(references_store[f]) for f in references_store.filenames ]
+
+        results = {}
+
+        for stage in stages:
+            print("Running {} benchmarks...".format(stage))
+
+            if stage == 'distance':
+                results.update(bench_distance(queries, references))
+            elif stage == 'segdtw':
+                results.update(bench_segdtw(queries, references))
+            elif stage == 'io':
+                results.update(bench_io(feats_dir))
+            elif stage == 'w2v2':
+                results.update(bench_w2v2(os.path.join(data_dir, 'wavs')))
+
+    for name, r in results.items():
+        print("{:<32} {:>10.3f} s {:>14.1f} frames/s {:>12}".format(name, r['seconds'], r['frames_per_sec'], "{:.1f} pairs/s".format(r['pairs_per_sec']) if 'pairs_per_sec' in r else ""))
+
+    config = { k : v for k, v in vars(args).items() if k not in [ 'output', 'data_dir' ] }
+
+    output = {
+        'created' : datetime.now().isoformat(timespec = 'seconds'),
+        'machine' : { 'platform' : platform.platform(), 'processor' : platform.processor(), 'cpu_count' : os.cpu_count(), 'python' : platform.python_version(), 'numpy' : np.__version__, 'pandas' : pd.__version__ },
+        'config' : config,
+        'results' : results
+    }
+
+    Path(os.path.dirname(os.path.abspath(args.output))).mkdir(parents = True, exist_ok = True)
+    json.dump(output, open(args.output, 'w'), indent = 2)
+
+    print("Results written to {}".format(args.output))
+
+if __name__ == '__main__':
+    main()
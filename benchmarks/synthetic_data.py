@@ -0,0 +1,116 @@
+import argparse
+import os
+import pickle
+import sys
+import numpy as np
+import pandas as pd
+import soundfile as sf
+from pathlib import Path
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'scripts'))
+from feature_store import FeatureWriter
+
+SAMPLE_RATE = 16_000
+
+def _random_lengths(rng, n, mean_length):
+    # Lengths vary by up to 50% around the mean, as in real queries and references
+    return np.maximum(rng.randint(mean_length // 2, mean_length * 3 // 2 + 1, size = n), 2)
+
+def _frames(rng, codebook, n_frames, segment_frames = 6, noise = 0.3):
+    """
+    Feature frames made of segments of roughly segment_frames frames, each a noisy copy of a
+    random codebook entry, so that frames are correlated over time as with speech features
+    """
+
+    n_segments = int(np.ceil(n_frames / segment_frames))
+    segments   = np.repeat(rng.randint(len(codebook), size = n_segments), segment_frames)[:n_frames]
+
+    return codebook[segments] + noise * rng.normal(size = (n_frames, codebook.shape[1]))
+
+def make_feats(output_dir, n_queries = 10, n_references = 20, query_frames = 60, reference_frames = 1000, dims = 1024, positive_rate = 0.2, seed = 1):
+    """
+    Writes synthetic queries.npy and references.npy (and legacy .pickle copies), with each query
+    embedded (with added noise) in about positive_rate of the references, and a labels.csv in the
+    format of the datasets' labels files. Returns the path of labels.csv
+    """
+
+    rng      = np.random.RandomState(seed)
+    codebook = rng.normal(size = (50, dims))
+
+    Path(output_dir).mkdir(parents = True, exist_ok = True)
+
+    queries    = { "Q{:04d}".format(i) : _frames(rng, codebook, n) for i, n in enumerate(_random_lengths(rng, n_queries, query_frames)) }
+    references = { "R{:05d}".format(i) : _frames(rng, codebook, n) for i, n in enumerate(_random_lengths(rng, n_references, reference_frames)) }
+
+    labels = []
+
+    for query, query_feats in queries.items():
+        for reference, reference_feats in references.items():
+            label = int(rng.rand() < positive_rate and reference_feats.shape[0] > query_feats.shape[0])
+
+            if label == 1:
+                start = rng.randint(reference_feats.shape[0] - query_feats.shape[0] + 1)
+                reference_feats[start:start + query_feats.shape[0]] = query_feats + 0.3 * rng.normal(size = query_feats.shape)
+
+            labels.append((query, reference, label))
+
+    for split, split_feats in [ ('queries', queries), ('references', references) ]:
+        with FeatureWriter(os.path.join(output_dir, split + '.npy')) as writer:
+            for filename, features in split_feats.items():
+                writer.append(filename, features)
+
+        feats_df = pd.DataFrame({ 'filename' : list(split_feats.keys()), 'features' : [ f.astype(np.float32) for f in split_feats.values() ] })
+        pickle.dump(feats_df, open(os.path.join(output_dir, split + '.pickle'), 'wb'))
+
+    labels_csv = os.path.join(output_dir, 'labels.csv')
+    pd.DataFrame(labels, columns = [ 'query', 'reference', 'label' ]).to_csv(labels_csv, index = False)
+
+    return labels_csv
+
+def make_wavs(output_dir, n_wavs = 5, wav_seconds = 10.0, seed = 1):
+    """
+    Writes n_wavs 16 kHz mono .wav files of about wav_seconds each (harmonic tones with
+    changing pitch plus noise) and returns their paths
+    """
+
+    rng = np.random.RandomState(seed)
+
+    Path(output_dir).mkdir(parents = True, exist_ok = True)
+
+    wav_paths = []
+
+    for i, n_samples in enumerate(_random_lengths(rng, n_wavs, int(wav_seconds * SAMPLE_RATE))):
+        # Pitch changes every 100 ms
+        pitch = np.repeat(rng.uniform(80, 300, size = n_samples // 1600 + 1), 1600)[:n_samples]
+        phase = 2 * np.pi * np.cumsum(pitch) / SAMPLE_RATE
+        audio = sum(np.sin(h * phase) / h for h in range(1, 6)) * 0.2 + 0.01 * rng.normal(size = n_samples)
+
+        wav_path = os.path.join(output_dir, "W{:04d}.wav".format(i))
+        sf.write(wav_path, audio.astype(np.float32), SAMPLE_RATE, subtype = 'PCM_16')
+        wav_paths.append(wav_path)
+
+    return wav_paths
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description='Generate synthetic features and wav files for benchmarks (or for trying out the pipeline without the datasets). example: python benchmarks/synthetic_data.py tmp/bench --n_references 200',
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter
+        )
+
+    parser.add_argument('output_dir', help = 'directory for features (features/) and wav files (wavs/)')
+
+    parser.add_argument('--n_queries',  default=10, type=int, help = "number of queries")
+    parser.add_argument('--n_references',  default=20, type=int, help = "number of references")
+    parser.add_argument('--query_frames',  default=60, type=int, help = "mean number of frames per query")
+    parser.add_argument('--reference_frames',  default=1000, type=int, help = "mean number of frames per reference")
+    parser.add_argument('--dims',  default=1024, type=int, help = "number of feature columns")
+    parser.add_argument('--n_wavs',  default=5, type=int, help = "number of wav files")
+    parser.add_argument('--wav_seconds',  default=10.0, type=float, help = "mean duration of wav files in seconds")
+    parser.add_argument('--seed',  default=1, type=int, help = "random seed")
+
+    args = parser.parse_args()
+
+    labels_csv = make_feats(os.path.join(args.output_dir, 'features'), args.n_queries, args.n_references, args.query_frames, args.reference_frames, args.dims, seed = args.seed)
+    wav_paths  = make_wavs(os.path.join(args.output_dir, 'wavs'), args.n_wavs, args.wav_seconds, seed = args.seed)
+
+    print("Features and labels written to {}, {} wav files to {}".format(os.path.dirname(labels_csv), len(wav_paths), os.path.join(args.output_dir, 'wavs')))
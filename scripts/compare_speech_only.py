@@ -0,0 +1,120 @@
+import argparse
+import glob
+import os
+import time
+import numpy as np
+import pandas as pd
+from feature_store import load_feature_store, resolve_feats_path
+from pathlib import Path
+from segmental_dtw import SEGDTW_IMPLEMENTATIONS, feats_to_distance_matrix, n_window_offsets, segdtw_sim_score, spans_to_mask, window_columns
+from term_weighted_value import labels_mtwv, reference_durations
+
+parser = argparse.ArgumentParser(
+    description='Compares DTW search over whole references with search only inside their speech regions (feats_to_dtw.py --speech_only) on a sample of label rows: non-speech frames and window offsets skipped, speedup, and change in scores and MTWV. Features must have been extracted with --vad. example: python compare_speech_only.py mfcc gos-kdl',
+    formatter_class=argparse.ArgumentDefaultsHelpFormatter
+    )
+
+parser.add_argument('features', help='features to use, use _all_ to iterate over all with speech regions')
+parser.add_argument('dataset', help = 'name of dataset')
+
+parser.add_argument('--feats_dir',  default='data/interim/features', help = "directory for features")
+parser.add_argument('--datasets_dir', default='data/raw/datasets', help = "directory for raw datasets and labels files")
+
+parser.add_argument('--dtw_impl',  default='numpy', choices=list(SEGDTW_IMPLEMENTATIONS.keys()), help = "segmental DTW implementation (see feats_to_dtw.py)")
+parser.add_argument('--max_rows',  default=500, type=int, help = "number of label rows sampled (0 for all)")
+parser.add_argument('--seed',  default=1, type=int, help = "random seed for sampling rows")
+parser.add_argument('--output_csv', default='data/processed/speech_only.csv', help = 'output CSV file, with one row per features')
+
+args = parser.parse_args()
+
+def search(labels_df, queries_store, references_store, speech_only):
+    # DTW scores of all rows of labels_df, with the time taken for distance matrices and DTW
+    scores, dist_time, dtw_time = [], 0, 0
+
+    for query, reference in zip(labels_df["query"], labels_df["reference"]):
+        query_feats_matrix     = queries_store[query]
+        reference_feats_matrix = references_store[reference]
+
+        start_time = time.perf_counter()
+        start_mask = spans_to_mask(references_store.speech[reference], reference_feats_matrix.shape[0]) if speech_only else None
+        columns    = None if start_mask is None else window_columns(start_mask, query_feats_matrix.shape[0])
+
+        distance_matrix = feats_to_distance_matrix(query_feats_matrix, reference_feats_matrix, columns)
+        dist_time      += time.perf_counter() - start_time
+
+        start_time = time.perf_counter()
+        scores.append(segdtw_sim_score(SEGDTW_IMPLEMENTATIONS[args.dtw_impl](distance_matrix, start_mask = start_mask)))
+        dtw_time  += time.perf_counter() - start_time
+
+    return labels_df.assign(prediction = scores), dist_time, dtw_time
+
+def compare(features, labels_df, queries_store, references_store, ref_durs):
+    references = labels_df["reference"].unique()
+
+    # Share of reference frames outside speech, and of window offsets that are skipped
+    n_frames        = sum(references_store.index[r][1] for r in references)
+    n_speech_frames = sum((spans[:, 1] - spans[:, 0]).sum() for spans in (references_store.speech[r] for r in references))
+    row_offsets     = [ n_window_offsets(queries_store.index[q][1], references_store.index[r][1]) for q, r in zip(labels_df["query"], labels_df["reference"]) ]
+    n_offsets       = sum(row_offsets)
+    n_speech        = sum(spans_to_mask(references_store.speech[r], references_store.index[r][1])[:n].sum() for r, n in zip(labels_df["reference"], row_offsets))
+
+    full_df, full_dist, full_dtw       = search(labels_df, queries_store, references_store, speech_only = False)
+    speech_df, speech_dist, speech_dtw = search(labels_df, queries_store, references_store, speech_only = True)
+
+    score_diff  = np.abs(full_df["prediction"] - speech_df["prediction"])
+    full_mtwv   = labels_mtwv(full_df, labels_df, ref_durs)[0]
+    speech_mtwv = labels_mtwv(speech_df, labels_df, ref_durs)[0]
+
+    result = {
+        'features' : features,
+        'rows' : labels_df.shape[0],
+        'nonspeech_frames' : 1 - n_speech_frames / max(n_frames, 1),
+        'skipped_offsets' : 1 - n_speech / max(n_offsets, 1),
+        'full_seconds' : full_dist + full_dtw,
+        'speech_seconds' : speech_dist + speech_dtw,
+        'distance_speedup' : full_dist / max(speech_dist, 1e-9),
+        'dtw_speedup' : full_dtw / max(speech_dtw, 1e-9),
+        'speedup' : (full_dist + full_dtw) / max(speech_dist + speech_dtw, 1e-9),
+        'max_score_diff' : score_diff.max(),
+        'changed_rows' : int((score_diff > 1e-9).sum()),
+        'full_mtwv' : full_mtwv,
+        'speech_mtwv' : speech_mtwv,
+        'mtwv_diff' : speech_mtwv - full_mtwv
+    }
+
+    print("{} features: {:.1%} of reference frames outside speech, {:.1%} of DTW window offsets skipped".format(features, result['nonspeech_frames'], result['skipped_offsets']))
+    print("Distance matrices: {:.2f} s (full) vs. {:.2f} s (speech only), {:.1f}x speedup; with DTW: {:.2f} s vs. {:.2f} s, {:.1f}x speedup".format(
+        full_dist, speech_dist, result['distance_speedup'], result['full_seconds'], result['speech_seconds'], result['speedup']
+    ))
+    print("Scores over {} rows: {} changed, max abs difference = {:.4f}; MTWV = {:.4f} (full) vs. {:.4f} (speech only), {:+.4f}".format(
+        labels_df.shape[0], result['changed_rows'], result['max_score_diff'], full_mtwv, speech_mtwv, result['mtwv_diff']
+    ))
+
+    return result
+
+dataset_dir = os.path.join(args.datasets_dir, args.dataset)
+labels_df   = pd.read_csv(os.path.join(dataset_dir, 'labels.csv'))
+ref_durs    = reference_durations(dataset_dir)
+
+if 0 < args.max_rows < labels_df.shape[0]:
+    labels_df = labels_df.iloc[np.sort(np.random.RandomState(args.seed).choice(labels_df.shape[0], args.max_rows, replace = False))].reset_index(drop = True)
+
+wildcard = '*' if args.features == '_all_' else args.features + "*"
+results  = []
+
+for features_dir in sorted(glob.glob(os.path.join(args.feats_dir, args.dataset, wildcard))):
+    queries_store    = load_feature_store(resolve_feats_path(os.path.join(features_dir, 'queries.npy')))
+    references_store = load_feature_store(resolve_feats_path(os.path.join(features_dir, 'references.npy')))
+
+    if references_store.speech is None:
+        print("Skipping {} features: no speech regions (extract features with --vad)".format(os.path.basename(features_dir)))
+        continue
+
+    results.append(compare(os.path.basename(features_dir), labels_df, queries_store, references_store, ref_durs))
+
+assert len(results) > 0, "No features with speech regions found for {} dataset in {}".format(args.dataset, args.feats_dir)
+
+Path(os.path.dirname(os.path.abspath(args.output_csv))).mkdir(parents = True, exist_ok = True)
+pd.DataFrame(results).to_csv(args.output_csv, index = False)
+
+print("Results written to {}".format(args.output_csv))
@@ -0,0 +1,135 @@
+import os
+import time
+import numpy as np
+import pandas as pd
+import soundfile as sf
+
+from argparse import ArgumentParser, ArgumentDefaultsHelpFormatter
+from pathlib import Path
+from segmental_dtw import iter_distance_matrices, segdtw_dists_numpy, segdtw_sim_score
+from term_weighted_value import labels_mtwv, reference_durations
+from transformers import logging
+from w2v2_featurizer import BACKENDS, KNOWN_MODELS, load_wav2vec2_featurizer
+
+parser = ArgumentParser(
+    description='Compares wav2vec 2.0 inference backends against the eager (fp32) model on a sample of a dataset: throughput, and deviation of features, DTW scores and MTWV. example: python compare_w2v2_backends.py gos-kdl --models wav2vec2-base,wav2vec2-large-xlsr-53',
+    formatter_class=ArgumentDefaultsHelpFormatter
+)
+
+parser.add_argument('dataset', help = 'name of dataset')
+
+parser.add_argument('--models', default='_all_', help = 'comma-separated models (keys of KNOWN_MODELS in w2v2_featurizer.py or paths), or _all_ for all of KNOWN_MODELS')
+parser.add_argument('--backends', default=','.join(BACKENDS[1:]), help = 'comma-separated backends to compare against eager, of: {}'.format(', '.join(BACKENDS[1:])))
+parser.add_argument('--stage', default='transformer', choices=['encoder', 'quantizer', 'transformer'], help = 'wav2vec 2.0 output stage')
+parser.add_argument('--layer', default=11, type=int, help = 'if stage is transformer, which layer of transformer')
+
+parser.add_argument('--datasets_dir', default='data/raw/datasets', help = 'directory for raw datasets and labels files')
+parser.add_argument('--max_queries', default=20, type=int, help = 'number of queries sampled from labels file (0 for all)')
+parser.add_argument('--max_references', default=50, type=int, help = 'number of references sampled from labels file (0 for all)')
+parser.add_argument('--seed', default=1, type=int, help = 'random seed for sampling queries and references')
+
+parser.add_argument('--num_threads', default=None, type=int, help='number of threads used by torch (and onnxruntime) on CPU (default: torch default)')
+parser.add_argument('--backend_cache_dir', default='data/interim/cache/models', help = 'directory for traced/exported models')
+parser.add_argument('--output_csv', default='data/processed/w2v2_backends.csv', help = 'output CSV file, with one row per model and backend')
+parser.add_argument('--hft_logging', default=40, type=int, help='HuggingFace Transformers verbosity level (40 = errors, 30 = warnings, 20 = info, 10 = debug)')
+
+args = parser.parse_args()
+
+def featurize(featurizer, wav_paths):
+    # Featurize first file once beforehand, so that one-off costs (e.g. of the first call to a traced model) are not timed
+    featurizer(wav_paths[0])
+
+    start_time = time.perf_counter()
+    feats      = { os.path.basename(p)[:-4] : featurizer(p) for p in wav_paths }
+
+    return feats, time.perf_counter() - start_time
+
+def dtw_scores(feats, labels_df):
+    # Segmental DTW scores of label rows, as by feats_to_dtw.py --batch_by_query
+    scores = pd.Series(np.nan, index = labels_df.index)
+
+    for query, query_df in labels_df.groupby("query", sort = False):
+        distance_matrices = iter_distance_matrices(feats[query], [ feats[r] for r in query_df["reference"] ])
+        scores[query_df.index] = [ segdtw_sim_score(segdtw_dists_numpy(d)) for d in distance_matrices ]
+
+    return labels_df.assign(prediction = scores.values)
+
+def compare(model, labels_df, wav_paths, audio_seconds, ref_durs):
+    layer = { 'encoder' : -2, 'quantizer' : -1 }.get(args.stage, args.layer)
+
+    rows = []
+
+    for backend in [ 'eager' ] + args.backends.split(','):
+        start_time = time.perf_counter()
+
+        try:
+            featurizer = load_wav2vec2_featurizer(model, layer = layer, num_threads = args.num_threads, backend = backend, backend_cache_dir = args.backend_cache_dir)
+        except ImportError as e:
+            print("Skipping {} backend for {}: {}".format(backend, model, e))
+            continue
+
+        load_seconds = time.perf_counter() - start_time
+
+        feats, featurize_seconds = featurize(featurizer, wav_paths)
+        results_df = dtw_scores(feats, labels_df)
+        mtwv       = labels_mtwv(results_df, labels_df, ref_durs)[0]
+
+        if backend == 'eager':
+            eager_feats, eager_seconds, eager_df, eager_mtwv = feats, featurize_seconds, results_df, mtwv
+
+        abs_diffs = [ np.abs(feats[f] - eager_feats[f]) for f in feats.keys() ]
+        cosines   = [ np.sum(feats[f] * eager_feats[f], axis = 1) / (np.linalg.norm(feats[f], axis = 1) * np.linalg.norm(eager_feats[f], axis = 1)) for f in feats.keys() ]
+
+        rows.append({
+            'model' : model,
+            'backend' : backend,
+            'load_seconds' : load_seconds,
+            'audio_seconds_per_sec' : audio_seconds / featurize_seconds,
+            'speedup' : eager_seconds / featurize_seconds,
+            'mean_abs_diff' : np.concatenate(abs_diffs).mean(),
+            'max_abs_diff' : max(d.max() for d in abs_diffs),
+            'min_cosine' : min(c.min() for c in cosines),
+            'max_score_diff' : (results_df["prediction"] - eager_df["prediction"]).abs().max(),
+            'mtwv' : mtwv,
+            'mtwv_diff' : mtwv - eager_mtwv
+        })
+
+        print("{} ({}): {:.1f} audio seconds/s ({:.2f}x eager), max abs feature diff = {:.4f}, min frame cosine similarity = {:.4f}, max abs DTW score diff = {:.4f}, MTWV = {:.4f} ({:+.4f})".format(
+            model, backend, rows[-1]['audio_seconds_per_sec'], rows[-1]['speedup'], rows[-1]['max_abs_diff'], rows[-1]['min_cosine'], rows[-1]['max_score_diff'], mtwv, rows[-1]['mtwv_diff']
+        ))
+
+    return rows
+
+def main():
+    logging.set_verbosity(args.hft_logging)
+
+    dataset_dir = os.path.join(args.datasets_dir, args.dataset)
+    labels_df   = pd.read_csv(os.path.join(dataset_dir, 'labels.csv'))
+    random      = np.random.RandomState(args.seed)
+
+    # Sample of queries and references, with all label rows pairing them
+    queries    = labels_df["query"].unique()
+    references = labels_df["reference"].unique()
+    queries    = random.choice(queries, args.max_queries, replace = False) if 0 < args.max_queries < len(queries) else queries
+    references = random.choice(references, args.max_references, replace = False) if 0 < args.max_references < len(references) else references
+    labels_df  = labels_df[labels_df["query"].isin(queries) & labels_df["reference"].isin(references)].reset_index(drop = True)
+
+    wav_paths     = [ os.path.join(dataset_dir, 'queries', q + '.wav') for q in queries ] + [ os.path.join(dataset_dir, 'references', r + '.wav') for r in references ]
+    audio_seconds = sum(sf.info(p).duration for p in wav_paths)
+    ref_durs      = reference_durations(dataset_dir)
+
+    print("Comparing backends on {} queries and {} references ({:.0f} seconds of audio, {} label rows) of {}".format(len(queries), len(references), audio_seconds, labels_df.shape[0], args.dataset))
+
+    models = list(KNOWN_MODELS.keys()) if args.models == '_all_' else args.models.split(',')
+    rows   = []
+
+    for model in models:
+        rows += compare(model, labels_df, wav_paths, audio_seconds, ref_durs)
+
+    Path(os.path.dirname(os.path.abspath(args.output_csv))).mkdir(parents = True, exist_ok = True)
+    pd.DataFrame(rows).to_csv(args.output_csv, index = False)
+
+    print("Results written to {}".format(args.output_csv))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,104 @@
+import argparse
+import heapq
+import json
+import os
+import numpy as np
+
+from run_cache import params_sha1
+
+# Splitting the label rows of a DTW run into shards that can be searched on separate machines
+# (feats_to_dtw.py --shard i/N), and the files in which each shard leaves its results for
+# merge_dtw_shards.py. Rows are assigned to shards deterministically from the labels file and
+# the frame counts in the feature indices, so that each shard computes the same assignment
+# without any coordination between machines.
+
+def parse_shard(spec):
+    """
+    Parses 'i/N' (shard i of N shards, numbered from 1) into (i, N), for use as an argparse type
+    """
+
+    try:
+        shard, n_shards = [ int(part) for part in spec.split('/') ]
+    except ValueError:
+        raise argparse.ArgumentTypeError("Shard must be given as i/N (e.g. 2/4), got: {}".format(spec))
+
+    if not 1 <= shard <= n_shards:
+        raise argparse.ArgumentTypeError("Shard number must be between 1 and the number of shards, got: {}".format(spec))
+
+    return shard, n_shards
+
+def shard_units(labels_df, by_query):
+    # Row numbers that go to the same shard: all rows of a query (so that they can be batched
+    # together, and so that each shard has all candidates for the top k of its queries), or single rows
+    if by_query:
+        return list(labels_df.groupby("query", sort = False).indices.values())
+
+    return [ np.array([ row_number ]) for row_number in range(labels_df.shape[0]) ]
+
+def assign_shards(unit_cells, n_shards):
+    """
+    Greedy longest-processing-time assignment of units to shards: units in order of decreasing cost
+    (ties in order of appearance), each to the shard with the lowest total cost so far (ties to the
+    lowest shard number). Returns the shard number (1 to n_shards) of each unit
+    """
+
+    unit_shards = np.zeros(len(unit_cells), dtype = int)
+    shard_loads = [ (0, shard) for shard in range(1, n_shards + 1) ]
+
+    for unit in np.argsort(-np.asarray(unit_cells), kind = 'stable'):
+        load, shard = heapq.heappop(shard_loads)
+        unit_shards[unit] = shard
+        heapq.heappush(shard_loads, (load + unit_cells[unit], shard))
+
+    return unit_shards
+
+def shard_rows(labels_df, row_cells, shard, n_shards, by_query):
+    """
+    Row numbers of labels_df in shard (of n_shards), given the cost of each row (query frames x reference
+    frames). Returns them with a description of the assignment, to be stored with the results of the shard
+    """
+
+    units       = shard_units(labels_df, by_query)
+    unit_cells  = [ int(row_cells[row_numbers].sum()) for row_numbers in units ]
+    unit_shards = assign_shards(unit_cells, n_shards)
+    row_numbers = np.sort(np.concatenate([ units[u] for u in np.flatnonzero(unit_shards == shard) ] + [ np.zeros(0, dtype = int) ]))
+
+    assignment = {
+        'shard' : shard,
+        'n_shards' : n_shards,
+        'unit' : 'query' if by_query else 'row',
+        # Shards only fit together if all of them were assigned from the same labels and frame counts
+        'assignment_sha1' : params_sha1(by_query, n_shards, unit_cells),
+        'n_rows' : labels_df.shape[0],
+        'shard_rows' : len(row_numbers),
+        'shard_cells' : sum(c for c, s in zip(unit_cells, unit_shards) if s == shard),
+        'total_cells' : sum(unit_cells)
+    }
+
+    return row_numbers, assignment
+
+def shard_path(output_file, shard, n_shards):
+    # e.g. data/processed/dtw/shards/mfcc_gos-kdl.shard-2-of-4.csv for data/processed/dtw/mfcc_gos-kdl.csv
+    filename = os.path.splitext(os.path.basename(output_file))[0]
+
+    return os.path.join(os.path.dirname(output_file), "shards", "{}.shard-{}-of-{}.csv".format(filename, shard, n_shards))
+
+def provenance_path(shard_csv):
+    return os.path.splitext(shard_csv)[0] + '.json'
+
+def write_shard(shard_csv, results_df, provenance):
+    """
+    Writes results of a shard (with the row number of each row in the labels file) and its provenance.
+    The provenance file is written last, so that it only exists for shards that were completed
+    """
+
+    os.makedirs(os.path.dirname(shard_csv), exist_ok = True)
+
+    # Write to temporary files then move, so that interrupted writes never leave partial results
+    for path, write in [ (shard_csv, lambda f: results_df.to_csv(f, index_label = 'row')), (provenance_path(shard_csv), lambda f: json.dump(provenance, f, indent = 2)) ]:
+        part_path = path + '.{}.part'.format(os.getpid())
+
+        with open(part_path, 'w') as f:
+            write(f)
+
+        os.replace(part_path, path)
@@ -0,0 +1,175 @@
+import argparse
+import glob
+import os
+import re
+import subprocess
+import tempfile
+import pandas as pd
+import term_weighted_value
+from concurrent.futures import ProcessPoolExecutor
+from term_weighted_value import COST_FA, COST_MISS, PRIOR, labels_mtwv
+
+parser = argparse.ArgumentParser(
+    description='Compute Maximum Term Weighted Values (MTWV) of DTW search results, as the NIST STDEval tool does for the files prepared by prep_STDEval.R. example: python dtw_to_mtwv.py _all_ gos-kdl',
+    formatter_class=argparse.ArgumentDefaultsHelpFormatter
+    )
+
+parser.add_argument('features', help='features of DTW results to evaluate, use _all_ to iterate over all')
+parser.add_argument('dataset', help = 'name of dataset, use _all_ to iterate over all')
+
+parser.add_argument('--datasets_dir', default='data/raw/datasets', help = "directory for raw datasets and labels files")
+parser.add_argument('--dtw_dir',  default='data/processed/dtw', help = "directory with output of feats_to_dtw.py (or feats_to_search.py)")
+parser.add_argument('--output_csv',  default='data/processed/STDEval/all_mtwv.csv', help = "output CSV file, in the format of gather_mtwv.R output")
+
+parser.add_argument('--prior',  default=PRIOR, type=float, help = "prior probability of a term (-p of STDEval)")
+parser.add_argument('--cost_fa',  default=COST_FA, type=float, help = "cost of a false alarm (-k of STDEval)")
+parser.add_argument('--cost_miss',  default=COST_MISS, type=float, help = "cost of a missed detection (-K of STDEval)")
+parser.add_argument('--trials_per_sec',  default=1, type=float, help = "number of trials per second of reference audio (-number-trials-per-sec of STDEval)")
+
+parser.add_argument('--num_workers',  default=os.cpu_count(), type=int, help = "number of worker processes (one results CSV per task)")
+parser.add_argument('--check_stdeval',  default=0, type=int, help = "if > 0, only compare MTWVs with those of STDEval (run with perl on files written as by prep_STDEval.R) for this many results CSVs per dataset")
+parser.add_argument('--stdeval_dir',  default='scripts/STDEval-0.7', help = "directory of the STDEval tool, for --check_stdeval")
+
+args = parser.parse_args()
+
+def reference_durations(dataset):
+    return term_weighted_value.reference_durations(os.path.join(args.datasets_dir, dataset))
+
+def evaluate(results_csv, dataset, features):
+    labels_df  = pd.read_csv(os.path.join(args.datasets_dir, dataset, 'labels.csv'))
+    results_df = pd.read_csv(results_csv)
+    ref_durs   = reference_durations(dataset)
+
+    # Occurrences of each query according to the labels file, so that those missing from
+    # results (e.g. outside the top k) count as misses; references as in the ECF file of prep_STDEval.R
+    value, p_fa, p_miss, threshold = labels_mtwv(results_df, labels_df, ref_durs, args.trials_per_sec, prior = args.prior, cost_fa = args.cost_fa, cost_miss = args.cost_miss)
+
+    return { 'dataset' : dataset, 'features' : features, 'mtwv' : value, 'p_fa' : p_fa, 'p_miss' : p_miss, 'desc_score' : threshold }
+
+# STDEval does not accept non-ASCII characters, so prep_STDEval.R replaces them in query and reference names
+ACCENTS = [ ("\u00e8", "iG"), ("\u00ec", "oG"), ("\u00f2", "eG"), ("\u00f6", "oE"), ("o\u0308", "oE") ]
+
+def convert_accents(text):
+    for accent, replacement in ACCENTS:
+        text = text.replace(accent, replacement)
+
+    return text
+
+def r_number(x):
+    # Numbers as written by glue() in prep_STDEval.R, i.e. as.character() with 15 significant digits
+    return '{:.15g}'.format(x)
+
+def write_stdeval_files(results_csv, dataset, output_dir):
+    """
+    Writes the ECF, term list, RTTM and STD list files for a results CSV, as prep_STDEval.R does
+    """
+
+    labels_df  = pd.read_csv(os.path.join(args.datasets_dir, dataset, 'labels.csv'))
+    results_df = pd.read_csv(results_csv)
+    ref_durs   = { convert_accents(r) : dur for r, dur in reference_durations(dataset).items() }
+
+    for df in [ labels_df, results_df ]:
+        df["query"]     = df["query"].map(convert_accents)
+        df["reference"] = df["reference"].map(convert_accents)
+
+    references = labels_df["reference"].unique()
+
+    with open(os.path.join(output_dir, dataset + ".ecf.xml"), "w") as ecf:
+        ecf.write('<?xml version="1.0" encoding="UTF-8"?>\n<ecf source_signal_duration="{}" version="20130512-1800">\n'.format(r_number(sum(ref_durs[r] for r in references))))
+        ecf.writelines('<excerpt audio_filename="{}.wav" channel="1" tbeg="0.000" dur="{}" language="multiple" source_type="{}" />\n'.format(r, r_number(ref_durs[r]), dataset) for r in references)
+        ecf.write('</ecf>\n')
+
+    with open(os.path.join(output_dir, dataset + ".tlist.xml"), "w") as tlist:
+        tlist.write('<?xml version="1.0" encoding="UTF-8"?>\n<termlist ecf_filename="{}.ecf.xml" language="multiple" version="20130512-1500">\n'.format(dataset))
+        tlist.writelines('<term termid="{0}"><termtext>{0}</termtext></term>\n'.format(q) for q in labels_df["query"].unique())
+        tlist.write('</termlist>\n')
+
+    # prep_STDEval.R also makes a NO_KEYWORD LEXEME line for each reference, but does not write it
+    with open(os.path.join(output_dir, dataset + ".rttm"), "w") as rttm:
+        for reference, ref_df in labels_df[labels_df["label"] == 1].groupby("reference"):
+            rttm.write('SPEAKER {} 1 0.000 {:.3f} <NA> <NA> SELF <NA>\n'.format(reference, ref_durs[reference]))
+            rttm.writelines('LEXEME {} 1 0.000 {:.3f} {} lex SELF <NA>\n'.format(reference, ref_durs[reference], q) for q in ref_df["query"])
+
+    with open(os.path.join(output_dir, "system.stdlist.xml"), "w") as stdlist:
+        stdlist.write('<?xml version="1.0" encoding="UTF-8"?>\n<stdlist termlist_filename="{}.tlist.xml" indexing_time="0.0" language="multiple" index_size="0" system_id="example">\n'.format(dataset))
+
+        for query, query_df in results_df.dropna(subset = ["prediction"]).groupby("query"):
+            stdlist.write('<detected_termlist termid="{}" term_search_time="0.0" oov_term_count="0">\n'.format(query))
+            stdlist.writelines('<term file="{}" channel="1" tbeg="0" dur="{}" score="{}" decision="{}"/>\n'.format(r, r_number(ref_durs[r]), r_number(p), "YES" if l == 1 else "NO") for r, p, l in zip(query_df["reference"], query_df["prediction"], query_df["label"]))
+            stdlist.write('</detected_termlist>\n')
+
+        stdlist.write('</stdlist>\n')
+
+def run_stdeval(results_csv, dataset):
+    """
+    MTWV, P(FA), P(Miss) and threshold reported by STDEval, read from its occurrence report as by gather_mtwv.R
+    """
+
+    stdeval_src = os.path.join(os.path.abspath(args.stdeval_dir), "src")
+
+    with tempfile.TemporaryDirectory() as stdeval_dir:
+        write_stdeval_files(results_csv, dataset, stdeval_dir)
+
+        subprocess.run([
+            "perl", "-I", stdeval_src, os.path.join(stdeval_src, "STDEval.pl"),
+            "-s", "system.stdlist.xml", "-number-trials-per-sec={}".format(r_number(args.trials_per_sec)),
+            "-e", dataset + ".ecf.xml", "-r", dataset + ".rttm", "-t", dataset + ".tlist.xml",
+            "-A", "-o", "score.mtwv.txt", "-d", "score.det", "-S", "2.0", "-F", "0.5",
+            "-p", '{:.3g}'.format(args.prior), "-k", r_number(args.cost_fa), "-K", r_number(args.cost_miss)
+        ], cwd = stdeval_dir, stdout = subprocess.DEVNULL, stderr = subprocess.DEVNULL, check = True)
+
+        all_line = [ line for line in open(os.path.join(stdeval_dir, "score.mtwv.txt")) if re.match(r"^\|\s+ALL", line) ][0]
+        values   = re.findall(r"-?[\d.]+", all_line)
+
+    # Values are MTWV, actual TWV (of decisions, unused), P(FA), P(Miss) and decision score
+    return float(values[0]), float(values[2]), float(values[3]), float(values[4])
+
+def main():
+    datasets = [ os.path.basename(p) for p in glob.glob(os.path.join(args.datasets_dir, "*")) ] if args.dataset == '_all_' else [ args.dataset ]
+
+    # Results CSVs are named {features}_{dataset}.csv
+    tasks = []
+
+    for dataset in sorted(datasets):
+        wildcard    = '*' if args.features == '_all_' else args.features + '*'
+        results_csv = sorted(glob.glob(os.path.join(args.dtw_dir, "{}_{}.csv".format(wildcard, dataset))))
+
+        if args.check_stdeval > 0:
+            results_csv = results_csv[:args.check_stdeval]
+
+        tasks += [ (csv, dataset, os.path.basename(csv)[:-len("_{}.csv".format(dataset))]) for csv in results_csv ]
+
+    assert len(tasks) > 0, "No results files found in {}".format(args.dtw_dir)
+
+    with ProcessPoolExecutor(args.num_workers) as executor:
+        results = list(executor.map(evaluate, *zip(*tasks)))
+
+    if args.check_stdeval > 0:
+        max_diff = 0
+
+        for (csv, dataset, _), result in zip(tasks, results):
+            stdeval_result = run_stdeval(csv, dataset)
+            python_result  = (result['mtwv'], result['p_fa'], result['p_miss'], result['desc_score'])
+
+            print("{}: MTWV = {:.4f} (STDEval: {:.4f}), P(FA) = {:.5f} ({:.5f}), P(Miss) = {:.3f} ({:.3f}), threshold = {:.4f} ({:.4f})".format(
+                csv, *[ v for pair in zip(python_result, stdeval_result) for v in pair ]
+            ))
+
+            max_diff = max(max_diff, abs(result['mtwv'] - stdeval_result[0]))
+
+        # STDEval reports MTWV to 3 or 4 decimal places
+        print("Max abs MTWV difference over {} results files: {:.5f}".format(len(tasks), max_diff))
+        assert max_diff <= 0.0005 + 1e-9, "MTWVs differ from those of STDEval"
+
+        return
+
+    mtwv_df = pd.DataFrame(results)
+
+    os.makedirs(os.path.dirname(os.path.abspath(args.output_csv)), exist_ok = True)
+    mtwv_df.to_csv(args.output_csv, index = False)
+
+    print(mtwv_df.to_string(index = False))
+    print("MTWVs written to {}".format(args.output_csv))
+
+if __name__ == '__main__':
+    main()
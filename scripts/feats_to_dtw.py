@@ -1,13 +1,18 @@
 import argparse
 import glob
 import os
-import pickle
+import socket
 import numpy as np
 import pandas as pd
-from dtw import dtw, StepPattern
+from datetime import datetime
+from dtw_shards import parse_shard, shard_path, shard_rows, write_shard
+from feature_store import FeatureStore, load_feature_store, resolve_feats_path
 from pathlib import Path
-from scipy.spatial.distance import cdist
-from tqdm.contrib.concurrent import process_map
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, ThreadPoolExecutor, wait
+from run_cache import ScoreCache, array_sha1, file_sha1, params_sha1
+from run_profile import RunProfiler, add_profile_args
+from segmental_dtw import SEGDTW_IMPLEMENTATIONS, SEGDTW_PARAMS, feats_to_distance_matrix, iter_distance_matrices, n_window_offsets, segdtw_sim_score, spans_to_mask, window_columns
+from tqdm import tqdm
 
 parser = argparse.ArgumentParser(
     description='example: python feats_to_dtw.py mfcc wrm-pd',
@@ -21,116 +26,469 @@ parser.add_argument('--feats_dir',  default='data/interim/features', help = "dir
 parser.add_argument('--datasets_dir', default='data/raw/datasets', help = "directory for raw datasets and labels files")
 parser.add_argument('--output_dir',  default='data/processed/dtw', help = "directory for dtw output, will create if it does not exist")
 
-parser.add_argument('--queries_file',  default='queries.pickle', help = "file with features of queries")
-parser.add_argument('--references_file',  default='references.pickle', help = "file with features of references")
+parser.add_argument('--queries_file',  default='queries.npy', help = "file with features of queries (falls back to legacy queries.pickle if not found)")
+parser.add_argument('--references_file',  default='references.npy', help = "file with features of references (falls back to legacy references.pickle if not found)")
 parser.add_argument('--labels_file',  default='labels.csv', help = "file indicating which query occurs in which reference")
 
+parser.add_argument('--dtw_impl',  default='numpy', choices=list(SEGDTW_IMPLEMENTATIONS.keys()), help = "segmental DTW implementation: vectorised numpy sweep, the same with lower bound pruning and early abandoning of offsets that cannot give the best score (numpy-pruned), or one dtw-python call per offset")
+parser.add_argument('--check_dtw',  default=0, type=int, help = "if > 0, only compare scores of --dtw_impl (numpy if dtw-python) and dtw-python on this many sampled rows per dataset/features")
+parser.add_argument('--check_tol',  default=1e-9, type=float, help = "maximum allowed absolute score difference for --check_dtw")
+parser.add_argument('--check_seed',  default=1, type=int, help = "random seed for sampling rows for --check_dtw")
+
+parser.add_argument('--batch_by_query', action='store_true', help = "group label rows by query and compute distances to all of its references in batched calls")
+parser.add_argument('--batch_frames',  default=200000, type=int, help = "maximum number of concatenated reference frames per batched distance computation")
+parser.add_argument('--speech_only', action='store_true', help = "only start DTW windows inside the speech regions of references (stored with features extracted with --vad), skipping distances and DTW over non-speech stretches")
+parser.add_argument('--top_k',  default=0, type=int, help = "if > 0, only output the k best scoring references for each query (to a top{k} subdirectory of output_dir). With --batch_by_query and --dtw_impl numpy-pruned, references that cannot make the top k are not fully scored")
+
+parser.add_argument('--num_workers',  default=os.cpu_count(), type=int, help = "number of DTW worker processes, shared by all datasets and features")
+parser.add_argument('--chunk_cells',  default=20000000, type=int, help = "maximum size of a task sent to a worker, in distance matrix cells (query frames x reference frames) summed over its label rows")
+parser.add_argument('--chunks_per_worker',  default=4, type=int, help = "minimum number of tasks per worker for each dataset/features, so that smaller ones are split into smaller tasks")
+
+parser.add_argument('--shard',  default=None, type=parse_shard, help = "i/N: only search shard i of N (e.g. 2/4) of the label rows of each dataset/features, balanced by DTW cost, and write results to a shards subdirectory of output_dir, to be combined with merge_dtw_shards.py")
+
+parser.add_argument('--cache_dir',  default=None, help = "if given, save DTW scores to a cache in this directory (keyed by hashes of query and reference features and DTW parameters), so that the run can later be resumed with --resume")
+parser.add_argument('--checkpoint_every',  default=1000, type=int, help = "number of completed label rows between writes of scores to cache")
+parser.add_argument('--resume', action='store_true', help = "reuse scores in cache (in --cache_dir, or data/interim/cache if not given; e.g. from an interrupted run or for features unchanged since a previous run), only computing new ones")
+
+add_profile_args(parser)
+
 args = parser.parse_args()
 
-datasets = [ os.path.basename(p) for p in glob.glob(os.path.join(args.datasets_dir, "*")) ] if args.dataset == '_all_' else [ args.dataset ]
+profiler    = RunProfiler.from_args(args, 'feats_to_dtw')
+
+# Scores are only cached (which needs hashes of all features searched) if asked for
+if args.resume or args.cache_dir is not None:
+    score_cache = ScoreCache(os.path.join(args.cache_dir or 'data/interim/cache', 'dtw_scores.sqlite'))
+else:
+    score_cache = None
+
+# All (dataset, features) pairs are searched by one persistent pool of workers, fed from one
+# queue of tasks (chunks of label rows). While the rows of one pair are being scored, the labels
+# and features of the next pair are loaded in a background thread, and its tasks are queued before
+# the pool runs out of work. Results of each pair are written as soon as all of its tasks are done.
+
+class SweepJob:
+    """
+    DTW search of all label rows of one dataset with one type of features
+    (score_keys are the keys of its rows in the score cache, None if scores are not cached)
+    """
+
+    def __init__(self, dataset, features, labels_df, queries_store, references_store, score_keys, provenance = None):
+        self.dataset          = dataset
+        self.features         = features
+        self.labels_df        = labels_df
+        self.queries_store    = queries_store
+        self.references_store = references_store
+        self.score_keys       = score_keys
+        self.provenance       = provenance
+
+        self.predictions   = np.full(labels_df.shape[0], np.nan)
+        self.pending_tasks = 0
+        self.n_offsets     = 0
+        self.n_pruned      = 0
+
+    @property
+    def query_names(self):
+        return self.labels_df["query"].values
+
+    @property
+    def reference_names(self):
+        return self.labels_df["reference"].values
+
+    def row_cells(self, row_numbers):
+        # Size of the distance matrix of each row, as a proxy for its DTW cost
+        query_frames     = np.array([ self.queries_store.index[q][1] for q in self.query_names[row_numbers] ])
+        reference_frames = np.array([ self.references_store.index[r][1] for r in self.reference_names[row_numbers] ])
+
+        return query_frames * reference_frames
+
+def run_segdtw(distance_matrix, segdtw_impl = args.dtw_impl, **kwargs):
+    with profiler.stage('segmental_dtw', items = 1, unit = 'pairs', matrix_shape = distance_matrix.shape):
+        return SEGDTW_IMPLEMENTATIONS[segdtw_impl](distance_matrix, **kwargs)
+
+def score_and_pruning(segdtw_dists):
+    # Pruned implementation marks offsets it skipped or abandoned as inf
+    return segdtw_sim_score(segdtw_dists), len(segdtw_dists), int(np.isinf(segdtw_dists).sum())
+
+def speech_start_mask(references_store, reference):
+    # With --speech_only, DTW windows only start inside speech regions of the reference (None: anywhere)
+    if not args.speech_only:
+        return None
+
+    return spans_to_mask(references_store.speech[reference], references_store.index[reference][1])
+
+def dtw_pair(query_feats_matrix, reference_feats_matrix, segdtw_impl = args.dtw_impl, start_mask = None):
+
+    # Only distances within windows that are searched are computed
+    columns = None if start_mask is None else window_columns(start_mask, query_feats_matrix.shape[0])
+
+    with profiler.stage('distance_matrix', items = 1, unit = 'pairs'):
+        distance_matrix = feats_to_distance_matrix(query_feats_matrix, reference_feats_matrix, columns)
+
+    # Segmental DTW: divide reference into segments by moving
+    # a window roughly the size of the query along the length
+    # of the reference and calculate a DTW alignment at each step
+    segdtw_dists = run_segdtw(distance_matrix, segdtw_impl, start_mask = start_mask)
+
+    return score_and_pruning(segdtw_dists)
+
+def dtw_query(query_feats_matrix, reference_feats_matrices, start_masks):
+
+    columns           = [ None if m is None else window_columns(m, query_feats_matrix.shape[0]) for m in start_masks ]
+    distance_matrices = profiler.timed('distance_matrix', iter_distance_matrices(query_feats_matrix, reference_feats_matrices, batch_frames = args.batch_frames, reference_columns = columns), unit = 'pairs')
+
+    if not (args.top_k > 0 and args.dtw_impl == 'numpy-pruned'):
+        return [ score_and_pruning(run_segdtw(distance_matrix, start_mask = start_mask)) for distance_matrix, start_mask in zip(distance_matrices, start_masks) ]
+
+    # Top k: once k references have been scored, the k-th best distance so far bounds those
+    # of references that can still make the top k. References whose offsets cannot beat it are
+    # abandoned and given a NaN score (not cached, and not output), other scores are exact.
+    results, top_dists = [], []
+
+    for distance_matrix, start_mask in zip(distance_matrices, start_masks):
+        max_dist     = top_dists[args.top_k - 1] if len(top_dists) >= args.top_k else np.inf
+        segdtw_dists = run_segdtw(distance_matrix, max_dist = max_dist, start_mask = start_mask)
+        score, n_offsets, n_pruned = score_and_pruning(segdtw_dists)
+
+        if 1 - score > max_dist:
+            score = np.nan
+        else:
+            top_dists = sorted(top_dists + [ 1 - score ])[:args.top_k]
+
+        results.append((score, n_offsets, n_pruned))
+
+    return results
+
+def attach_stores(queries_spec, references_spec):
+    queries_store    = FeatureStore.attach(queries_spec)
+    references_store = FeatureStore.attach(references_spec)
+
+    # Workers run tasks of all datasets and features in turn, so only keep those
+    # of the (at most two) most recently started ones attached
+    FeatureStore.detach_stale(keep = 4)
+
+    return queries_store, references_store
+
+def dtw_by_rows(task):
+
+    # Fetch features for each (query, reference) row in the chunk of labels_df
+    queries_spec, references_spec, pairs = task
+    queries_store, references_store      = attach_stores(queries_spec, references_spec)
 
-for dataset in datasets:
+    return [ dtw_pair(queries_store[query], references_store[reference], start_mask = speech_start_mask(references_store, reference)) for query, reference in pairs ]
 
-    # If "_all_" see what features have been extracted for given dataset (in case it differs from dataset to dataset)
-    wildcard = '*' if args.features == '_all_' else args.features + "*"
+def dtw_by_query(task):
 
-    extracted_feats = [ os.path.basename(p) for p in sorted(glob.glob(os.path.join(args.feats_dir, dataset, wildcard))) ]
+    # Fetch features for each query in the chunk and all references it is paired with (in labels_df order)
+    queries_spec, references_spec, query_references = task
+    queries_store, references_store                 = attach_stores(queries_spec, references_spec)
 
-    for features in extracted_feats:
+    return [ result for query, references in query_references for result in dtw_query(queries_store[query], [ references_store[r] for r in references ], [ speech_start_mask(references_store, r) for r in references ]) ]
 
-        labels_csv     = os.path.join(args.datasets_dir, dataset, 'labels.csv')
-        queries_pkl    = os.path.join(args.feats_dir, dataset, features, args.queries_file)
-        references_pkl = os.path.join(args.feats_dir, dataset, features, args.references_file)
+def load_job(dataset, features):
 
-        assert os.path.isfile(labels_csv), "Labels file does not exist at: {}".format(labels_csv)
-        assert os.path.isfile(queries_pkl), "Queries features file does not exist at: {}".format(queries_pkl)
-        assert os.path.isfile(references_pkl), "References features file does not exist at: {}".format(references_pkl)
-        Path(args.output_dir).mkdir(parents=True, exist_ok=True)
+    labels_csv     = os.path.join(args.datasets_dir, dataset, 'labels.csv')
+    queries_pkl    = resolve_feats_path(os.path.join(args.feats_dir, dataset, features, args.queries_file))
+    references_pkl = resolve_feats_path(os.path.join(args.feats_dir, dataset, features, args.references_file))
 
-        labels_df     = pd.read_csv(labels_csv)
-        queries_df    = pickle.load(open(queries_pkl, "rb"))
-        references_df = pickle.load(open(references_pkl, "rb"))
+    assert os.path.isfile(labels_csv), "Labels file does not exist at: {}".format(labels_csv)
+    assert os.path.isfile(queries_pkl), "Queries features file does not exist at: {}".format(queries_pkl)
+    assert os.path.isfile(references_pkl), "References features file does not exist at: {}".format(references_pkl)
 
-        queries_set    = set(labels_df["query"].unique())
-        references_set = set(labels_df["reference"].unique())
+    with profiler.stage('load_features'):
+        labels_df        = pd.read_csv(labels_csv)
+        queries_store    = load_feature_store(queries_pkl)
+        references_store = load_feature_store(references_pkl)
 
-        # Check that all the query-reference file pairs actually occur in the features files
-        assert queries_set.difference(set(queries_df["filename"].unique())) == set(), "Queries in {} missing from filenames in {}".format(labels_csv, queries_pkl)
-        assert references_set.difference(set(references_df["filename"].unique())) == set(), "References in {} missing from filenames {}".format(labels_csv, references_pkl)
+        # Features are in contiguous buffers indexed by filename, which DTW workers
+        # attach to instead of each holding a copy: .npy features are memory-mapped
+        # as is, legacy pickled features are copied into shared memory
+        # (each split on its own, as e.g. only queries may have been re-extracted as .npy)
+        if queries_pkl.endswith(".pickle"):
+            queries_store = queries_store.to_shared_memory()
 
-        # Add a 'prediction' column to labels dataframe, where the value is a
-        # score between 0 and 1 calculated by using DTW to calculate whether there
-        # is a region inside the reference that is spectrally similar to the query
-        # 
-        # | query | reference   | label | prediction |
-        # | hello | hello there |   1   |    0.99    |
-        # | hello | cool beans  |   0   |    0.51    |
+        if references_pkl.endswith(".pickle"):
+            references_store = references_store.to_shared_memory()
 
-        def dtw_by_row(row_number):
+    # Check that all the query-reference file pairs actually occur in the features files
+    assert set(labels_df["query"]).difference(set(queries_store.filenames)) == set(), "Queries in {} missing from filenames in {}".format(labels_csv, queries_pkl)
+    assert set(labels_df["reference"]).difference(set(references_store.filenames)) == set(), "References in {} missing from filenames {}".format(labels_csv, references_pkl)
 
-            # Fetch metadata and features for relevant row in labels_df dataframe
-            row_data               = labels_df.iloc[row_number]
-            query_feats_matrix     = queries_df.loc[queries_df["filename"]       == row_data["query"]]["features"].values[0]
-            reference_feats_matrix = references_df.loc[references_df["filename"] == row_data["reference"]]["features"].values[0]
+    provenance = None
 
-            assert query_feats_matrix.shape[1] == reference_feats_matrix.shape[1], "Query and reference feature matrices differ in number of columns"
+    if args.shard is not None:
+        labels_df, provenance = shard_labels(dataset, features, labels_csv, labels_df, queries_store, references_store)
 
-                            # For two distance matrices Q of shape (M, F) and R of shape (N, F) where M, N time frames and F feature columns
-                            # standardise each feature matrix within each feature component then compute Euclidean distance between each pair of
-                            # time frames. Produces a distance matrix of shape (M, N).
-            distance_matrix = cdist(query_feats_matrix, reference_feats_matrix, 'seuclidean', V = None)
-                            # Normalise to [0, 1] range by subtracting min, then dividing by range (ptp = peak-to-peak)
-            distance_matrix = (distance_matrix - distance_matrix.min(0)) / distance_matrix.ptp(0)
+    queries_set    = set(labels_df["query"].unique())
+    references_set = set(labels_df["reference"].unique())
 
-            # Segmental DTW: divide reference into segments by moving
-            # a window roughly the size of the query along the length
-            # of the reference and calculate a DTW alignment at each step
+    if args.speech_only:
+        assert references_store.speech is not None and references_set.issubset(references_store.speech.keys()), "No speech regions for references in {} (extract features with --vad)".format(references_pkl)
 
-            segdtw_dists = []
-            query_length, reference_length = distance_matrix.shape
+    # Scores are cached by hashes of the query and reference features and the DTW parameters,
+    # so that with --resume only pairs not scored in a previous (e.g. interrupted) run are computed
+    if score_cache is None:
+        return SweepJob(dataset, features, labels_df, queries_store, references_store, None, provenance)
 
-            # reject if alignment less than half of query size
-            # or if larger than 1.5 times query size
-            min_match_ratio, max_match_ratio = [0.5, 1.5]
+    with profiler.stage('hash_features'):
+        feats_hashes = { f : array_sha1(queries_store[f]) for f in queries_set }
+        feats_hashes.update({ f : array_sha1(references_store[f]) for f in references_set })
+        dtw_params   = params_sha1(SEGDTW_PARAMS)
 
-            window_size      = int(query_length * max_match_ratio)
-            last_segment_end = int(reference_length - (min_match_ratio * query_length))
+        # With --speech_only, scores also depend on the speech regions of the reference (other keys are unchanged)
+        speech_keys  = { r : [ params_sha1(references_store.speech[r].tolist()) ] if args.speech_only else [] for r in references_set }
+        score_keys   = [ params_sha1(feats_hashes[q], feats_hashes[r], dtw_params, *speech_keys[r]) for q, r in zip(labels_df["query"], labels_df["reference"]) ]
 
-            for r_i in range(last_segment_end):
-                
-                segment_start = r_i
-                segment_end   = min(r_i + window_size, reference_length)
+    return SweepJob(dataset, features, labels_df, queries_store, references_store, score_keys, provenance)
 
-                segment_data  = distance_matrix[:,segment_start:segment_end]
-                
-                dtw_obj = dtw(segment_data,
-                    step_pattern = "symmetricP1", # See Sakoe & Chiba (1978) for definition of step pattern
-                    open_end = True,              # Let alignment end anywhere along the segment (need not be at lower corner)
-                    distance_only = True          # Speed up dtw(), no backtracing for alignment path
-                )
+def shard_labels(dataset, features, labels_csv, labels_df, queries_store, references_store):
+    # Rows of this shard (keeping their row numbers in the labels file as index), and
+    # where they came from, to be checked by merge_dtw_shards.py
+    shard, n_shards = args.shard
 
-                match_ratio = dtw_obj.jmin / query_length
+    query_frames     = np.array([ queries_store.index[q][1] for q in labels_df["query"] ], dtype = np.int64)
+    reference_frames = np.array([ references_store.index[r][1] for r in labels_df["reference"] ], dtype = np.int64)
 
-                if match_ratio < min_match_ratio or match_ratio > max_match_ratio:
-                    segdtw_dists.append(1)
-                else:
-                    segdtw_dists.append(dtw_obj.normalizedDistance)
+    # Queries are kept whole when rows are batched by query or only the top k of each query are output
+    row_numbers, assignment = shard_rows(labels_df, query_frames * reference_frames, shard, n_shards, by_query = args.batch_by_query or args.top_k > 0)
 
-            # Convert distance (lower is better) to similary score (is higher better)
-            # makes it easier to compare with CNN output probabilities
-            #
-            # Return 0 if segdtw_dists is [] (i.e. no good alignments found)
-            sim_score = 0 if len(segdtw_dists) == 0 else 1 - min(segdtw_dists)
+    tqdm.write("Shard {} of {} of {} dataset with {} features: {} of {} rows ({:.1%} of DTW cost)".format(
+        shard, n_shards, dataset, features, assignment['shard_rows'], assignment['n_rows'], assignment['shard_cells'] / max(assignment['total_cells'], 1)
+    ))
 
-            return sim_score
+    provenance = {
+        'dataset' : dataset,
+        'features' : features,
+        'labels_file' : labels_csv,
+        'labels_sha1' : file_sha1(labels_csv),
+        **assignment,
+        'dtw_impl' : args.dtw_impl,
+        'dtw_params' : SEGDTW_PARAMS,
+        'top_k' : args.top_k,
+        'speech_only' : args.speech_only,
+        'host' : socket.gethostname(),
+        'started' : datetime.now().isoformat(timespec = 'seconds')
+    }
 
-        tqdm_desc = "Running DTW on {} dataset with {} features".format(dataset, features)
+    return labels_df.iloc[row_numbers].copy(), provenance
 
-        labels_df["prediction"] = process_map(dtw_by_row, range(labels_df.shape[0]),
-            chunksize = 1,
-            desc = tqdm_desc
-        )
+def check_job(job):
+    # Equivalence check: score a sample of rows with both the vectorised
+    # and the dtw-python implementations and compare, skipping the full run
+    sample_rows = np.random.RandomState(args.check_seed).choice(job.labels_df.shape[0], min(args.check_dtw, job.labels_df.shape[0]), replace = False)
+    check_impl  = 'numpy' if args.dtw_impl == 'dtw-python' else args.dtw_impl
 
-        output_file = os.path.join(args.output_dir, "{}_{}.csv".format(features, dataset))
+    def dtw_by_row(row_number, segdtw_impl):
+        reference = job.reference_names[row_number]
+        return dtw_pair(job.queries_store[job.query_names[row_number]], job.references_store[reference], segdtw_impl, speech_start_mask(job.references_store, reference))
 
+    numpy_scores  = np.array([ dtw_by_row(i, check_impl)[0] for i in sample_rows ])
+    python_scores = np.array([ dtw_by_row(i, 'dtw-python')[0] for i in sample_rows ])
+    max_abs_diff  = np.abs(numpy_scores - python_scores).max()
+
+    print("DTW equivalence check ({} vs. dtw-python) on {} dataset with {} features: max abs difference over {} rows = {}".format(check_impl, job.dataset, job.features, len(sample_rows), max_abs_diff))
+    job.queries_store.unlink()
+    job.references_store.unlink()
+
+    assert max_abs_diff <= args.check_tol, "Vectorised DTW scores differ from dtw-python scores by more than {}".format(args.check_tol)
+
+def job_tasks(job, pending_rows):
+    """
+    Splits pending rows of job into tasks of roughly equal DTW cost. Returns a list of
+    (row numbers, task) pairs, where task is the input of dtw_by_query or dtw_by_rows
+    """
+
+    cells = np.zeros(job.labels_df.shape[0])
+    cells[pending_rows] = job.row_cells(pending_rows)
+
+    # With --batch_by_query, a query and all of its references are scored in the same task
+    if args.batch_by_query:
+        units      = [ pending_rows[row_numbers] for row_numbers in job.labels_df.iloc[pending_rows].groupby("query", sort = False).indices.values() ]
+        unit_cells = [ cells[row_numbers].sum() for row_numbers in units ]
+    else:
+        units      = [ [ row_number ] for row_number in pending_rows ]
+        unit_cells = cells[pending_rows]
+
+    # Cap task size, but split datasets/features with fewer rows into at least
+    # chunks_per_worker tasks per worker, so that all workers stay busy
+    target_cells = min(args.chunk_cells, sum(unit_cells) / (args.chunks_per_worker * args.num_workers))
+
+    chunks, chunk, chunk_cells = [], [], 0
+
+    for row_numbers, cells in zip(units, unit_cells):
+        chunk.append(row_numbers)
+        chunk_cells += cells
+
+        if chunk_cells >= target_cells:
+            chunks.append(chunk)
+            chunk, chunk_cells = [], 0
+
+    if len(chunk) > 0:
+        chunks.append(chunk)
+
+    tasks = []
+
+    for chunk in chunks:
+        row_numbers     = np.concatenate(chunk)
+        queries_spec    = job.queries_store.subset_spec(set(job.query_names[row_numbers]))
+        references_spec = job.references_store.subset_spec(set(job.reference_names[row_numbers]))
+
+        if args.batch_by_query:
+            units = [ (job.query_names[rows[0]], list(job.reference_names[rows])) for rows in chunk ]
+        else:
+            units = list(zip(job.query_names[row_numbers], job.reference_names[row_numbers]))
+
+        tasks.append((row_numbers, (queries_spec, references_spec, units)))
+
+    return tasks
+
+def speech_offsets(job):
+    # Numbers of DTW window offsets over all rows of job, and of those inside speech regions of the references
+    references    = set(job.reference_names)
+    speech_starts = { r : np.concatenate([[0], np.cumsum(speech_start_mask(job.references_store, r))]) for r in references }
+    row_offsets   = [ n_window_offsets(job.queries_store.index[q][1], job.references_store.index[r][1]) for q, r in zip(job.query_names, job.reference_names) ]
+
+    return sum(row_offsets), sum(speech_starts[r][n] for r, n in zip(job.reference_names, row_offsets))
+
+def finish_job(job):
+
+    if args.dtw_impl == 'numpy-pruned':
+        tqdm.write("Pruned or abandoned {} of {} DTW window offsets ({:.1%}) on {} dataset with {} features".format(job.n_pruned, job.n_offsets, job.n_pruned / max(job.n_offsets, 1), job.dataset, job.features))
+
+    if args.speech_only:
+        n_offsets, n_speech = speech_offsets(job)
+        tqdm.write("Skipped {} of {} DTW window offsets ({:.1%}) outside speech regions on {} dataset with {} features".format(n_offsets - n_speech, n_offsets, (n_offsets - n_speech) / max(n_offsets, 1), job.dataset, job.features))
+
+    # Add a 'prediction' column to labels dataframe, where the value is a
+    # score between 0 and 1 calculated by using DTW to calculate whether there
+    # is a region inside the reference that is spectrally similar to the query
+    #
+    # | query | reference   | label | prediction |
+    # | hello | hello there |   1   |    0.99    |
+    # | hello | cool beans  |   0   |    0.51    |
+    labels_df = job.labels_df
+    labels_df["prediction"] = job.predictions
+
+    job.queries_store.unlink()
+    job.references_store.unlink()
+
+    output_file = os.path.join(args.output_dir, "{}_{}.csv".format(job.features, job.dataset))
+
+    if args.top_k > 0:
+        # Kept out of output_dir itself, which prep_STDEval.R expects to hold full results
+        labels_df   = labels_df.dropna(subset = ["prediction"]).sort_values("prediction", ascending = False, kind = "stable").groupby("query", sort = False).head(args.top_k).sort_index()
+        output_file = os.path.join(args.output_dir, "top{}".format(args.top_k), os.path.basename(output_file))
+        Path(os.path.dirname(output_file)).mkdir(parents=True, exist_ok=True)
+
+    if job.provenance is not None:
+        output_file = shard_path(output_file, job.provenance['shard'], job.provenance['n_shards'])
+        write_shard(output_file, labels_df, { **job.provenance, 'rows_written' : labels_df.shape[0], 'finished' : datetime.now().isoformat(timespec = 'seconds') })
+    else:
         labels_df.to_csv(output_file, index = False)
+
+    tqdm.write("Wrote DTW results for {} dataset with {} features to {}".format(job.dataset, job.features, output_file))
+
+def sweep(jobs):
+    task_fn  = dtw_by_query if args.batch_by_query else dtw_by_rows
+    loader   = ThreadPoolExecutor(1)
+    jobs     = iter(jobs)
+    running  = {}
+    low_mark = 2 * args.num_workers
+
+    def load_next():
+        job = next(jobs, None)
+        return None if job is None else loader.submit(load_job, *job)
+
+    def queue_job(job, executor, pbar):
+        if args.resume:
+            with profiler.stage('read_score_cache'):
+                cached_scores   = score_cache.get_many(set(job.score_keys))
+                job.predictions = np.array([ cached_scores.get(k, np.nan) for k in job.score_keys ])
+
+        pending_rows = np.flatnonzero(np.isnan(job.predictions))
+
+        if args.resume:
+            tqdm.write("Resuming DTW on {} dataset with {} features: {} of {} rows already scored".format(job.dataset, job.features, job.labels_df.shape[0] - len(pending_rows), job.labels_df.shape[0]))
+
+        if len(pending_rows) == 0:
+            finish_job(job)
+            return
+
+        for row_numbers, task in job_tasks(job, pending_rows):
+            running[profiler.submit(executor, task_fn, task)] = (job, row_numbers)
+            job.pending_tasks += 1
+
+        pbar.total += len(pending_rows)
+        pbar.refresh()
+
+    next_load = load_next()
+
+    with profiler.stage('run_dtw', unit = 'pairs') as run_counts, ProcessPoolExecutor(args.num_workers) as executor, tqdm(total = 0, desc = "Running DTW") as pbar:
+        n_since_checkpoint = 0
+
+        while next_load is not None or len(running) > 0:
+
+            # Queue tasks of the next dataset/features once it is loaded and the pool is running low on
+            # tasks, then start loading the one after. Only waits for loading if the pool is idle.
+            if next_load is not None and len(running) <= low_mark and (next_load.done() or len(running) == 0):
+                queue_job(next_load.result(), executor, pbar)
+                next_load = load_next()
+                continue
+
+            waiting = set(running)
+
+            if next_load is not None and len(running) <= low_mark:
+                waiting.add(next_load)
+
+            done, _ = wait(waiting, return_when = FIRST_COMPLETED)
+
+            for future in done:
+                if future not in running:
+                    continue
+
+                job, row_numbers = running.pop(future)
+
+                for row_number, (score, row_offsets, row_pruned) in zip(row_numbers, profiler.result(future)):
+                    job.predictions[row_number] = score
+                    job.n_offsets += row_offsets
+                    job.n_pruned  += row_pruned
+
+                    # Scores of references abandoned in top k mode are NaN, i.e. unknown
+                    if score_cache is not None and not np.isnan(score):
+                        score_cache.put(job.score_keys[row_number], score)
+
+                pbar.update(len(row_numbers))
+                run_counts['items'] += len(row_numbers)
+                n_since_checkpoint  += len(row_numbers)
+                job.pending_tasks   -= 1
+
+                if score_cache is not None and (job.pending_tasks == 0 or n_since_checkpoint >= args.checkpoint_every):
+                    with profiler.stage('write_score_cache'):
+                        score_cache.checkpoint()
+
+                    n_since_checkpoint = 0
+
+                if job.pending_tasks == 0:
+                    finish_job(job)
+
+    loader.shutdown()
+
+datasets = [ os.path.basename(p) for p in glob.glob(os.path.join(args.datasets_dir, "*")) ] if args.dataset == '_all_' else [ args.dataset ]
+
+# If "_all_" see what features have been extracted for given dataset (in case it differs from dataset to dataset)
+wildcard = '*' if args.features == '_all_' else args.features + "*"
+
+jobs = [ (dataset, os.path.basename(p)) for dataset in datasets for p in sorted(glob.glob(os.path.join(args.feats_dir, dataset, wildcard))) ]
+
+Path(args.output_dir).mkdir(parents=True, exist_ok=True)
+
+if args.check_dtw > 0:
+    for dataset, features in jobs:
+        check_job(load_job(dataset, features))
+else:
+    sweep(jobs)
+
+if score_cache is not None:
+    score_cache.close()
+
+profiler.report()
@@ -0,0 +1,157 @@
+import argparse
+import glob
+import os
+import time
+import numpy as np
+import pandas as pd
+from feature_store import FeatureWriter, load_feature_store, resolve_feats_path
+from pathlib import Path
+from segmental_dtw import SEGDTW_IMPLEMENTATIONS, feats_to_distance_matrix, segdtw_sim_score
+from sklearn.decomposition import PCA
+from sklearn.metrics import roc_auc_score
+from term_weighted_value import labels_mtwv, reference_durations
+
+parser = argparse.ArgumentParser(
+    description='Reduce features with PCA (fitted on reference frames) and store them as a new set of features. example: python feats_to_pca-feats.py wav2vec2-large_transformer-L11 gos-kdl --n_components 64 --feats_dtype int8',
+    formatter_class=argparse.ArgumentDefaultsHelpFormatter
+    )
+
+parser.add_argument('features', help='features to reduce, use _all_ to iterate over all (except already reduced ones)')
+parser.add_argument('dataset', help = 'name of dataset, use _all_ to iterate over all')
+
+parser.add_argument('--feats_dir',  default='data/interim/features', help = "directory for features")
+parser.add_argument('--datasets_dir', default='data/raw/datasets', help = "directory for raw datasets and labels files (used by --check_rows)")
+
+parser.add_argument('--queries_file',  default='queries.npy', help = "file with features of queries (falls back to legacy queries.pickle if not found)")
+parser.add_argument('--references_file',  default='references.npy', help = "file with features of references (falls back to legacy references.pickle if not found)")
+
+parser.add_argument('--n_components',  default=64, type=int, help = "number of principal components to keep")
+parser.add_argument('--whiten', action='store_true', help = "scale components to unit variance (does not change seuclidean distances used by DTW, which standardise each component)")
+parser.add_argument('--feats_dtype',  default='float32', choices=['float32', 'float16', 'int8'], help = "storage data type of reduced features (int8 with a scale per component)")
+parser.add_argument('--sample_frames',  default=200000, type=int, help = "maximum number of reference frames sampled to fit PCA")
+parser.add_argument('--seed',  default=1, type=int, help = "random seed for sampling frames")
+
+parser.add_argument('--check_rows',  default=0, type=int, help = "if > 0, report DTW time and score differences between full and reduced features on this many sampled rows of the labels file")
+
+args = parser.parse_args()
+
+def reduced_name(features):
+    # e.g. wav2vec2-large_transformer-L11_pca64-int8
+    name = "{}_pca{}{}".format(features, args.n_components, "w" if args.whiten else "")
+    return name if args.feats_dtype == 'float32' else "{}-{}".format(name, args.feats_dtype)
+
+def fit_pca(references_store):
+    n_frames = references_store.data.shape[0]
+    rows     = np.sort(np.random.RandomState(args.seed).choice(n_frames, min(args.sample_frames, n_frames), replace = False))
+    frames   = np.asarray(references_store.data[rows], dtype = np.float64)
+
+    if references_store.scale is not None:
+        frames = frames * references_store.scale
+
+    n_components = min(args.n_components, frames.shape[0], frames.shape[1])
+
+    return PCA(n_components = n_components, whiten = args.whiten, random_state = args.seed).fit(frames)
+
+def check_rows(labels_df, ref_durs, full_stores, reduced_stores):
+    '''
+    Times distance matrix and segmental DTW computations with the full and the reduced features
+    on a sample of label rows, and reports how much the scores change, as well as how well
+    they separate labelled occurrences from other pairs (ROC AUC) and the MTWV on the sample
+    for either set of features
+    '''
+
+    sample_rows = np.random.RandomState(args.seed).choice(labels_df.shape[0], min(args.check_rows, labels_df.shape[0]), replace = False)
+    results     = {}
+
+    for name, (queries_store, references_store) in [ ('full', full_stores), ('reduced', reduced_stores) ]:
+        dist_time, dtw_time, scores = 0, 0, []
+
+        for row in sample_rows:
+            query_feats_matrix     = queries_store[labels_df["query"].iloc[row]]
+            reference_feats_matrix = references_store[labels_df["reference"].iloc[row]]
+
+            start_time      = time.time()
+            distance_matrix = feats_to_distance_matrix(query_feats_matrix, reference_feats_matrix)
+            dist_time      += time.time() - start_time
+
+            start_time = time.time()
+            scores.append(segdtw_sim_score(SEGDTW_IMPLEMENTATIONS['numpy'](distance_matrix)))
+            dtw_time  += time.time() - start_time
+
+        results[name] = (dist_time, dtw_time, np.array(scores))
+
+    (full_dist, full_dtw, full_scores), (red_dist, red_dtw, red_scores) = results['full'], results['reduced']
+    score_diff = np.abs(full_scores - red_scores)
+    rank_corr  = pd.Series(full_scores).corr(pd.Series(red_scores), method = 'spearman')
+
+    print("Distance matrices: {:.2f} s (full) vs. {:.2f} s (reduced), {:.1f}x speedup; with DTW: {:.2f} s vs. {:.2f} s, {:.1f}x speedup".format(
+        full_dist, red_dist, full_dist / max(red_dist, 1e-9), full_dist + full_dtw, red_dist + red_dtw, (full_dist + full_dtw) / max(red_dist + red_dtw, 1e-9)
+    ))
+    print("Scores over {} rows: mean abs difference = {:.4f}, max abs difference = {:.4f}, Spearman correlation = {:.4f}".format(len(sample_rows), score_diff.mean(), score_diff.max(), rank_corr))
+
+    labels = labels_df["label"].values[sample_rows]
+
+    if len(np.unique(labels)) == 2:
+        print("ROC AUC of scores for labelled occurrences: {:.4f} (full) vs. {:.4f} (reduced)".format(roc_auc_score(labels, full_scores), roc_auc_score(labels, red_scores)))
+
+    sample_df = labels_df.iloc[sample_rows]
+    full_mtwv = labels_mtwv(sample_df.assign(prediction = full_scores), sample_df, ref_durs)[0]
+    red_mtwv  = labels_mtwv(sample_df.assign(prediction = red_scores), sample_df, ref_durs)[0]
+
+    print("MTWV on sampled rows: {:.4f} (full) vs. {:.4f} (reduced), {:+.4f}".format(full_mtwv, red_mtwv, red_mtwv - full_mtwv))
+
+datasets = [ os.path.basename(p) for p in glob.glob(os.path.join(args.feats_dir, "*")) ] if args.dataset == '_all_' else [ args.dataset ]
+
+for dataset in datasets:
+
+    if args.features == '_all_':
+        extracted_feats = [ os.path.basename(p) for p in sorted(glob.glob(os.path.join(args.feats_dir, dataset, "*"))) if "_pca" not in os.path.basename(p) ]
+    else:
+        extracted_feats = [ args.features ]
+
+    for features in extracted_feats:
+
+        queries_path    = resolve_feats_path(os.path.join(args.feats_dir, dataset, features, args.queries_file))
+        references_path = resolve_feats_path(os.path.join(args.feats_dir, dataset, features, args.references_file))
+
+        assert os.path.isfile(queries_path), "Queries features file does not exist at: {}".format(queries_path)
+        assert os.path.isfile(references_path), "References features file does not exist at: {}".format(references_path)
+
+        queries_store    = load_feature_store(queries_path)
+        references_store = load_feature_store(references_path)
+
+        pca = fit_pca(references_store)
+
+        output_dir = os.path.join(args.feats_dir, dataset, reduced_name(features))
+        Path(output_dir).mkdir(parents=True, exist_ok=True)
+
+        # Parameters needed to reduce further files in the same way
+        np.savez(os.path.join(output_dir, "pca.npz"), mean = pca.mean_, components = pca.components_, explained_variance = pca.explained_variance_, whiten = args.whiten)
+
+        def reduce(store, filename):
+            return pca.transform(np.asarray(store[filename], dtype = np.float64)).astype(np.float32)
+
+        # Scale each component so that its largest absolute value over both splits fits in the int8 range
+        scale = None
+
+        if args.feats_dtype == 'int8':
+            max_abs = np.max([ np.abs(reduce(store, f)).max(0) for store in [ queries_store, references_store ] for f in store.filenames ], axis = 0)
+            scale   = np.where(max_abs > 0, max_abs / np.iinfo(np.int8).max, 1)
+
+        for split, store in [ ('queries', queries_store), ('references', references_store) ]:
+            with FeatureWriter(os.path.join(output_dir, split + ".npy"), dtype = args.feats_dtype, scale = scale) as writer:
+                # Frames are unchanged, so speech regions (if any) carry over
+                for filename in store.filenames:
+                    writer.append(filename, reduce(store, filename), speech = None if store.speech is None else store.speech[filename])
+
+        print("{} features of {} reduced from {} to {} dimensions ({:.1%} of variance), written to {}".format(
+            features, dataset, pca.components_.shape[1], pca.n_components_, pca.explained_variance_ratio_.sum(), output_dir
+        ))
+
+        if args.check_rows > 0:
+            labels_df = pd.read_csv(os.path.join(args.datasets_dir, dataset, 'labels.csv'))
+            ref_durs  = reference_durations(os.path.join(args.datasets_dir, dataset))
+
+            reduced_stores = tuple(load_feature_store(os.path.join(output_dir, split + ".npy")) for split in [ 'queries', 'references' ])
+
+            check_rows(labels_df, ref_durs, (queries_store, references_store), reduced_stores)
@@ -0,0 +1,170 @@
+import argparse
+import glob
+import os
+import time
+import numpy as np
+import pandas as pd
+from feature_store import FeatureStore, load_feature_store, resolve_feats_path
+from frame_index import FrameIndex
+from pathlib import Path
+from segmental_dtw import MAX_MATCH_RATIO, SEGDTW_IMPLEMENTATIONS, iter_distance_matrices, segdtw_sim_score
+from tqdm.contrib.concurrent import process_map
+
+parser = argparse.ArgumentParser(
+    description='example: python feats_to_search.py mfcc wrm-pd',
+    formatter_class=argparse.ArgumentDefaultsHelpFormatter
+    )
+
+parser.add_argument('features', help='features to use in search, use _all_ to iterate over all')
+parser.add_argument('dataset', help = 'name of dataset, use _all_ to iterate over all')
+
+parser.add_argument('--feats_dir',  default='data/interim/features', help = "directory for features")
+parser.add_argument('--datasets_dir', default='data/raw/datasets', help = "directory for raw datasets and labels files")
+parser.add_argument('--output_dir',  default='data/processed/search', help = "directory for search output, will create if it does not exist")
+parser.add_argument('--exhaustive_dir',  default='data/processed/dtw', help = "directory with output of feats_to_dtw.py, used to report recall of the shortlists if available")
+
+parser.add_argument('--queries_file',  default='queries.npy', help = "file with features of queries (falls back to legacy queries.pickle if not found)")
+parser.add_argument('--references_file',  default='references.npy', help = "file with features of references to search (falls back to legacy references.pickle if not found)")
+parser.add_argument('--labels_file',  default='labels.csv', help = "file indicating which query occurs in which reference")
+
+parser.add_argument('--n_tables',  default=8, type=int, help = "number of hash tables in frame index")
+parser.add_argument('--n_bits',  default=16, type=int, help = "number of random hyperplanes (bits of hash code) per hash table")
+parser.add_argument('--max_bucket',  default=5000, type=int, help = "ignore hash buckets with more than this many frames")
+parser.add_argument('--seed',  default=1, type=int, help = "random seed for hash hyperplanes")
+
+parser.add_argument('--shortlist',  default=20, type=int, help = "number of references per query to rescore with DTW")
+parser.add_argument('--n_offsets',  default=3, type=int, help = "number of candidate offsets kept per shortlisted reference")
+parser.add_argument('--offset_margin',  default=-1, type=int, help = "if >= 0, only run DTW within this many frames around the candidate offsets in each reference, otherwise on the whole reference")
+
+parser.add_argument('--dtw_impl',  default='numpy', choices=list(SEGDTW_IMPLEMENTATIONS.keys()), help = "segmental DTW implementation (see feats_to_dtw.py)")
+parser.add_argument('--batch_frames',  default=200000, type=int, help = "maximum number of concatenated reference frames per batched distance computation")
+parser.add_argument('--recall_k',  default=10, type=int, help = "report recall of the exhaustive top k references per query")
+
+args = parser.parse_args()
+
+datasets = [ os.path.basename(p) for p in glob.glob(os.path.join(args.datasets_dir, "*")) ] if args.dataset == '_all_' else [ args.dataset ]
+
+for dataset in datasets:
+
+    wildcard = '*' if args.features == '_all_' else args.features + "*"
+
+    extracted_feats = [ os.path.basename(p) for p in sorted(glob.glob(os.path.join(args.feats_dir, dataset, wildcard))) ]
+
+    for features in extracted_feats:
+
+        labels_csv     = os.path.join(args.datasets_dir, dataset, args.labels_file)
+        queries_pkl    = resolve_feats_path(os.path.join(args.feats_dir, dataset, features, args.queries_file))
+        references_pkl = resolve_feats_path(os.path.join(args.feats_dir, dataset, features, args.references_file))
+
+        assert os.path.isfile(labels_csv), "Labels file does not exist at: {}".format(labels_csv)
+        assert os.path.isfile(queries_pkl), "Queries features file does not exist at: {}".format(queries_pkl)
+        assert os.path.isfile(references_pkl), "References features file does not exist at: {}".format(references_pkl)
+        Path(args.output_dir).mkdir(parents=True, exist_ok=True)
+
+        labels_df        = pd.read_csv(labels_csv)
+        queries_store    = load_feature_store(queries_pkl)
+        references_store = load_feature_store(references_pkl)
+
+        # Legacy pickled features are copied into shared memory for workers, each split on its own
+        # (e.g. only queries may have been re-extracted as .npy)
+        if queries_pkl.endswith(".pickle"):
+            queries_store = queries_store.to_shared_memory()
+
+        if references_pkl.endswith(".pickle"):
+            references_store = references_store.to_shared_memory()
+
+        queries_spec    = queries_store.spec
+        references_spec = references_store.spec
+
+        queries = list(labels_df["query"].unique())
+
+        assert set(queries).difference(set(queries_store.filenames)) == set(), "Queries in {} missing from filenames in {}".format(labels_csv, queries_pkl)
+
+        # Stage 1: shortlist references (and offsets within them) for each query from frame index hits
+
+        start_time = time.time()
+        index      = FrameIndex(references_store, n_tables = args.n_tables, n_bits = args.n_bits, max_bucket = args.max_bucket, seed = args.seed)
+        index_time = time.time() - start_time
+
+        start_time = time.time()
+        shortlists = [ (query, index.shortlist(queries_store[query], args.shortlist, n_offsets = args.n_offsets)) for query in queries ]
+        shortlist_time = time.time() - start_time
+
+        # Stage 2: exact segmental DTW on the shortlisted references
+
+        def dtw_by_shortlist(query_shortlist):
+
+            query, shortlist         = query_shortlist
+            query_feats_matrix       = FeatureStore.attach(queries_spec)[query]
+            reference_feats_matrices = [ FeatureStore.attach(references_spec)[reference] for reference, _, _ in shortlist ]
+
+            distance_matrices = iter_distance_matrices(query_feats_matrix, reference_feats_matrices, batch_frames = args.batch_frames)
+            segdtw_impl       = SEGDTW_IMPLEMENTATIONS[args.dtw_impl]
+
+            scores = []
+
+            for (reference, votes, offsets), distance_matrix in zip(shortlist, distance_matrices):
+
+                if args.offset_margin < 0:
+                    scores.append(segdtw_sim_score(segdtw_impl(distance_matrix)))
+                    continue
+
+                # Only search windows starting near the candidate offsets (offsets are the starts
+                # of bins of half the query length, see FrameIndex.shortlist), merging overlapping spans
+                query_length = distance_matrix.shape[0]
+                span_length  = max(query_length // 2, 1) + int(query_length * MAX_MATCH_RATIO) + 2 * args.offset_margin
+                spans        = []
+
+                for offset in sorted(offsets):
+                    span_start = max(offset - args.offset_margin, 0)
+                    span_end   = min(span_start + span_length, distance_matrix.shape[1])
+
+                    if len(spans) > 0 and span_start <= spans[-1][1]:
+                        spans[-1][1] = max(spans[-1][1], span_end)
+                    else:
+                        spans.append([ span_start, span_end ])
+
+                segdtw_dists = np.concatenate([ segdtw_impl(distance_matrix[:, span_start:span_end]) for span_start, span_end in spans ])
+                scores.append(segdtw_sim_score(segdtw_dists))
+
+            return [ (query, reference, votes, score) for (reference, votes, _), score in zip(shortlist, scores) ]
+
+        start_time = time.time()
+        results    = process_map(dtw_by_shortlist, shortlists, chunksize = 1, desc = "Rescoring shortlists for {} dataset with {} features".format(dataset, features))
+        dtw_time   = time.time() - start_time
+
+        queries_store.unlink()
+        references_store.unlink()
+
+        shortlist_df = pd.DataFrame([ r for query_results in results for r in query_results ], columns = ["query", "reference", "votes", "prediction"])
+        shortlist_df.to_csv(os.path.join(args.output_dir, "{}_{}_shortlist.csv".format(features, dataset)), index = False)
+
+        # Same format as feats_to_dtw.py output (one row per row of labels file), so that it can be
+        # evaluated in the same way. Pairs not shortlisted get a score of 0, as for references
+        # with no accepted DTW alignment
+        labels_df = labels_df.merge(shortlist_df[["query", "reference", "prediction"]], on = ["query", "reference"], how = "left")
+        labels_df["prediction"] = labels_df["prediction"].fillna(0)
+        labels_df.to_csv(os.path.join(args.output_dir, "{}_{}.csv".format(features, dataset)), index = False)
+
+        print("Search on {} dataset with {} features: indexed {} reference frames in {:.1f} s, shortlisted in {:.1f} s, rescored {} pairs with DTW in {:.1f} s".format(
+            dataset, features, len(index.frame_file), index_time, shortlist_time, shortlist_df.shape[0], dtw_time
+        ))
+
+        # Recall of shortlists against exhaustive DTW scores, if available
+        exhaustive_csv = os.path.join(args.exhaustive_dir, "{}_{}.csv".format(features, dataset))
+
+        if not os.path.isfile(exhaustive_csv):
+            print("No exhaustive DTW results at {}, skipping recall report".format(exhaustive_csv))
+            continue
+
+        exhaustive_df = pd.read_csv(exhaustive_csv)
+        shortlisted   = set(zip(shortlist_df["query"], shortlist_df["reference"]))
+        in_shortlist  = np.array([ pair in shortlisted for pair in zip(exhaustive_df["query"], exhaustive_df["reference"]) ])
+
+        top_k_df      = exhaustive_df.assign(in_shortlist = in_shortlist).sort_values("prediction", ascending = False, kind = "stable").groupby("query", sort = False).head(args.recall_k)
+        positives     = exhaustive_df["label"] == 1
+        score_diff    = (labels_df["prediction"] - exhaustive_df["prediction"]).abs()[in_shortlist]
+
+        print("Recall of exhaustive top {} references per query: {:.3f}, recall of labelled occurrences: {:.3f}, {:.1%} of pairs rescored (max abs score difference: {:.2e})".format(
+            args.recall_k, top_k_df["in_shortlist"].mean(), in_shortlist[positives].mean() if positives.any() else np.nan, in_shortlist.mean(), score_diff.max() if len(score_diff) > 0 else 0
+        ))
@@ -0,0 +1,360 @@
+import os
+import pickle
+import numpy as np
+import pandas as pd
+from collections import OrderedDict
+from multiprocessing import shared_memory
+
+# On-disk feature format: for a split (e.g. queries), features of all files are stored
+# back to back in one (total frames, feature columns) array in queries.npy, which can be
+# opened with np.load(..., mmap_mode='r'), and queries.index.csv gives the rows for each file:
+#
+# | filename   | offset | length |
+# | ED_aapmoal | 0      | 52     |
+# | ED_achter  | 52     | 38     |
+#
+# Features stored as integers (e.g. int8) have per-column scales in queries.scale.npy, so that
+# the features are the stored values times the scales.
+#
+# Features extracted with voice activity detection (--vad) have the speech regions of each file in
+# queries.speech.csv, as [start, end) rows of its feature matrix (a file without speech has one
+# row with start = end = 0):
+#
+# | filename   | start | end |
+# | ED_aapmoal | 3     | 49  |
+#
+# The legacy format, queries.pickle, is a pickled data frame with 'filename' and 'features' columns.
+
+FEATS_EXT        = '.npy'
+INDEX_EXT        = '.index.csv'
+SCALE_EXT        = '.scale.npy'
+SPEECH_EXT       = '.speech.csv'
+LEGACY_FEATS_EXT = '.pickle'
+
+class FeatureStore:
+    """
+    Features for all files in a split (e.g. queries or references) held in one contiguous
+    (total frames, feature columns) buffer, with a filename -> (offset, length) index so that
+    looking up a file's feature matrix is a dict lookup returning a zero-copy view.
+
+    Example:
+
+        store = FeatureStore.from_dataframe(pickle.load(open("queries.pickle", "rb")))
+        store["ED_aapmoal"] # => array of shape (frames, features)
+    """
+
+    def __init__(self, data, index, shm = None, path = None, scale = None, speech = None):
+        self.data   = data
+        self.index  = index
+        self.scale  = scale
+        self.speech = speech
+        self._shm  = shm
+        self._path = path
+
+    @classmethod
+    def from_dataframe(cls, feats_df, dtype = np.float32):
+        """
+        Build store from a data frame with 'filename' and 'features' columns (format of queries.pickle/references.pickle)
+        """
+
+        lengths = [ f.shape[0] for f in feats_df["features"] ]
+        offsets = np.concatenate([[0], np.cumsum(lengths)[:-1]]).astype(int)
+
+        data  = np.concatenate(list(feats_df["features"]), axis = 0).astype(dtype, copy = False)
+        index = { filename : (int(offset), int(length)) for filename, offset, length in zip(feats_df["filename"], offsets, lengths) }
+
+        return cls(data, index)
+
+    @classmethod
+    def from_npy(cls, feats_path):
+        """
+        Open store written by FeatureWriter, memory-mapping the features file (read-only)
+        """
+
+        data     = np.load(feats_path, mmap_mode = 'r')
+        index_df = pd.read_csv(_index_path(feats_path), dtype = { 'filename' : str }, keep_default_na = False)
+        index    = { filename : (int(offset), int(length)) for filename, offset, length in zip(index_df["filename"], index_df["offset"], index_df["length"]) }
+
+        return cls(data, index, path = feats_path, scale = _load_scale(feats_path), speech = _load_speech(feats_path))
+
+    def __getitem__(self, filename):
+        offset, length = self.index[filename]
+
+        # Quantised features are scaled back on lookup (a copy rather than a view)
+        if self.scale is not None:
+            return self.data[offset:offset + length] * self.scale
+
+        return self.data[offset:offset + length]
+
+    def __contains__(self, filename):
+        return filename in self.index
+
+    def __len__(self):
+        return len(self.index)
+
+    @property
+    def filenames(self):
+        return list(self.index.keys())
+
+    def to_dataframe(self):
+        """
+        Return features in legacy data frame format ('filename' and 'features' columns)
+        """
+
+        return pd.DataFrame({
+            'filename' : self.filenames,
+            'features' : [ np.array(self[f]) for f in self.filenames ]
+        })
+
+    def to_shared_memory(self):
+        """
+        Copy buffer into a multiprocessing.shared_memory block and return a store backed by it.
+        Worker processes can then use FeatureStore.attach(store.spec) to get the same store without copying.
+        The creating process should call unlink() once all workers are done.
+        """
+
+        shm  = shared_memory.SharedMemory(create = True, size = max(self.data.nbytes, 1))
+        data = np.ndarray(self.data.shape, dtype = self.data.dtype, buffer = shm.buf)
+        data[:] = self.data
+
+        store = FeatureStore(data, self.index, shm = shm, scale = self.scale, speech = self.speech)
+        _attached_stores[shm.name] = store
+
+        return store
+
+    @property
+    def spec(self):
+        """
+        Picklable description of a shared memory or memory-mapped store, for use with FeatureStore.attach()
+        """
+
+        assert self._shm is not None or self._path is not None, "Only stores in shared memory or opened with from_npy() can be attached to"
+
+        if self._shm is None:
+            return { 'path' : self._path, 'index' : self.index, 'scale' : self.scale, 'speech' : self.speech }
+
+        return { 'name' : self._shm.name, 'shape' : self.data.shape, 'dtype' : self.data.dtype.str, 'index' : self.index, 'scale' : self.scale, 'speech' : self.speech }
+
+    def subset_spec(self, filenames):
+        """
+        spec with the index restricted to filenames, e.g. so that tasks sent to worker processes
+        only carry the index entries they use rather than that of the whole split
+        """
+
+        spec = self.spec
+        spec['index'] = { f : self.index[f] for f in filenames }
+
+        if self.speech is not None:
+            spec['speech'] = { f : self.speech[f] for f in filenames if f in self.speech }
+
+        return spec
+
+    @classmethod
+    def attach(cls, spec):
+        """
+        Attach to store described by spec (cached, so each process only attaches once per store).
+        Index entries of spec are added to those of a store already attached to, so that specs
+        from subset_spec() can be used.
+        """
+
+        key = spec.get('name', spec.get('path'))
+
+        if key in _attached_stores:
+            _attached_stores.move_to_end(key)
+            _attached_stores[key].index.update(spec['index'])
+
+            if spec['speech'] is not None:
+                _attached_stores[key].speech.update(spec['speech'])
+        else:
+            if 'path' in spec:
+                _attached_stores[key] = cls(np.load(spec['path'], mmap_mode = 'r'), spec['index'], path = spec['path'], scale = spec['scale'], speech = spec['speech'])
+            else:
+                shm  = shared_memory.SharedMemory(name = spec['name'])
+                data = np.ndarray(spec['shape'], dtype = np.dtype(spec['dtype']), buffer = shm.buf)
+                _attached_stores[key] = cls(data, spec['index'], shm = shm, scale = spec['scale'], speech = spec['speech'])
+
+        return _attached_stores[key]
+
+    @classmethod
+    def detach_stale(cls, keep):
+        """
+        Close all but the keep most recently attached stores, for long-lived worker processes
+        that attach to the stores of many splits in turn (so that shared memory blocks the
+        creating process has unlinked are actually freed)
+        """
+
+        while len(_attached_stores) > keep:
+            _, store = _attached_stores.popitem(last = False)
+            store.data = None
+
+            if store._shm is not None:
+                store._shm.close()
+                store._shm = None
+
+    def unlink(self):
+        """
+        Release shared memory block (no-op for stores not backed by shared memory)
+        """
+
+        if self._shm is not None:
+            _attached_stores.pop(self._shm.name, None)
+            self.data = None
+            self._shm.close()
+            self._shm.unlink()
+            self._shm = None
+
+_attached_stores = OrderedDict()
+
+class FeatureWriter:
+    """
+    Incrementally writes features to the on-disk format read by FeatureStore.from_npy(),
+    appending each file's features as it is extracted so that all features never need
+    to be held in memory at once.
+
+    Example:
+
+        with FeatureWriter("data/interim/features/gos-kdl/mfcc/queries.npy", dtype = "float16") as writer:
+            for wav_path in wav_paths:
+                writer.append(filename, extract(wav_path))
+
+    If scale (one value per feature column) is given, features are divided by it before
+    storage, and for integer dtypes (e.g. int8) also rounded and clipped to the dtype's range.
+    FeatureStore.from_npy() multiplies them by the scale again when they are looked up.
+
+    If speech regions ((regions, 2) array of [start, end) frames, see voice_activity.py) are
+    appended with the features of each file, they are written to the .speech.csv file.
+    """
+
+    # Space reserved at start of file for the .npy header, which can only
+    # be written once the total number of frames is known
+    HEADER_SIZE = 128
+
+    def __init__(self, feats_path, dtype = np.float32, scale = None):
+        self.feats_path = feats_path
+        self.dtype      = np.dtype(dtype)
+        self.scale      = None if scale is None else np.asarray(scale, dtype = np.float32)
+
+        self._part_path = feats_path + '.part'
+        self._file      = open(self._part_path, 'wb')
+        self._file.write(b'\x00' * self.HEADER_SIZE)
+
+        self._filenames = []
+        self._lengths   = []
+        self._n_cols    = None
+        self._speech    = []
+
+    def append(self, filename, features, speech = None):
+        if self.scale is not None:
+            features = np.asarray(features) / self.scale
+
+            if np.issubdtype(self.dtype, np.integer):
+                features = np.clip(np.round(features), np.iinfo(self.dtype).min, np.iinfo(self.dtype).max)
+
+        features = np.ascontiguousarray(features, dtype = self.dtype)
+
+        assert features.ndim == 2, "Expected 2D feature matrix for {}, got shape {}".format(filename, features.shape)
+
+        if self._n_cols is None:
+            self._n_cols = features.shape[1]
+
+        assert features.shape[1] == self._n_cols, "Feature matrix for {} has {} columns, expected {}".format(filename, features.shape[1], self._n_cols)
+
+        self._file.write(features.tobytes())
+        self._filenames.append(filename)
+        self._lengths.append(features.shape[0])
+
+        if speech is not None:
+            speech = np.asarray(speech, dtype = int).reshape(-1, 2)
+            assert speech.size == 0 or (speech.min() >= 0 and speech.max() <= features.shape[0]), "Speech regions for {} outside its {} frames".format(filename, features.shape[0])
+
+            # Files without speech are recorded with an empty region, so that they are not taken for files without regions
+            self._speech += [ (filename, start, end) for start, end in speech ] if len(speech) > 0 else [ (filename, 0, 0) ]
+
+    def close(self):
+        shape  = (int(sum(self._lengths)), self._n_cols or 0)
+        header = "{{'descr': {!r}, 'fortran_order': False, 'shape': {!r}, }}".format(self.dtype.str, shape)
+
+        # Version 1.0 header: magic string, 2-byte header length, header dict padded with spaces and ending in a newline
+        header_len = self.HEADER_SIZE - len(np.lib.format.magic(1, 0)) - 2
+        header     = header.ljust(header_len - 1) + '\n'
+
+        self._file.seek(0)
+        self._file.write(np.lib.format.magic(1, 0))
+        self._file.write(np.uint16(header_len).astype('<u2').tobytes())
+        self._file.write(header.encode('latin1'))
+        self._file.close()
+
+        os.replace(self._part_path, self.feats_path)
+
+        if self.scale is not None:
+            np.save(_scale_path(self.feats_path), self.scale)
+        elif os.path.isfile(_scale_path(self.feats_path)):
+            os.remove(_scale_path(self.feats_path))
+
+        if len(self._speech) > 0:
+            pd.DataFrame(self._speech, columns = ['filename', 'start', 'end']).to_csv(_speech_path(self.feats_path), index = False)
+        elif os.path.isfile(_speech_path(self.feats_path)):
+            os.remove(_speech_path(self.feats_path))
+
+        offsets = np.concatenate([[0], np.cumsum(self._lengths)[:-1]]).astype(int)
+
+        pd.DataFrame({
+            'filename' : self._filenames,
+            'offset'   : offsets[:len(self._lengths)], # offsets is [0] if nothing was appended
+            'length'   : self._lengths
+        }).to_csv(_index_path(self.feats_path), index = False)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.close()
+        else:
+            self._file.close()
+            os.remove(self._part_path)
+
+def _index_path(feats_path):
+    return os.path.splitext(feats_path)[0] + INDEX_EXT
+
+def _scale_path(feats_path):
+    return os.path.splitext(feats_path)[0] + SCALE_EXT
+
+def _load_scale(feats_path):
+    return np.load(_scale_path(feats_path)) if os.path.isfile(_scale_path(feats_path)) else None
+
+def _speech_path(feats_path):
+    return os.path.splitext(feats_path)[0] + SPEECH_EXT
+
+def _load_speech(feats_path):
+    # filename -> (regions, 2) array of [start, end) frames, or None if features have no speech regions
+    if not os.path.isfile(_speech_path(feats_path)):
+        return None
+
+    speech_df = pd.read_csv(_speech_path(feats_path), dtype = { 'filename' : str }, keep_default_na = False)
+
+    return { filename : rows[["start", "end"]].values[rows["end"].values > rows["start"].values] for filename, rows in speech_df.groupby("filename", sort = False) }
+
+def resolve_feats_path(feats_path):
+    """
+    Return feats_path if it exists, otherwise the same split in the other format
+    (e.g. queries.pickle for queries.npy), so that legacy pickles are still found
+    """
+
+    if os.path.isfile(feats_path):
+        return feats_path
+
+    stem, ext = os.path.splitext(feats_path)
+    alt_path  = stem + (LEGACY_FEATS_EXT if ext == FEATS_EXT else FEATS_EXT)
+
+    return alt_path if os.path.isfile(alt_path) else feats_path
+
+def load_feature_store(feats_path, dtype = np.float32):
+    """
+    Load store from either format: .npy files are memory-mapped, legacy .pickle files are read into memory
+    """
+
+    if feats_path.endswith(FEATS_EXT):
+        return FeatureStore.from_npy(feats_path)
+
+    return FeatureStore.from_dataframe(pickle.load(open(feats_path, "rb")), dtype = dtype)
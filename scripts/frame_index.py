@@ -0,0 +1,137 @@
+import numpy as np
+
+class FrameIndex:
+    """
+    Approximate nearest neighbour index over the frames of all files in a FeatureStore
+    (e.g. all references in a dataset), used to shortlist the files, and the offsets
+    within them, at which a query may occur before running segmental DTW on the shortlist.
+
+    Frames are standardised (as for the seuclidean distance used by DTW) and hashed with
+    random hyperplanes (Charikar, 2002): each of n_tables hash tables uses n_bits random
+    hyperplanes through the origin, and a frame's code in a table is the side of each
+    hyperplane it lies on, so that frames with a small angle between them tend to share codes.
+    Frames of the query then 'hit' all indexed frames with the same code in any table.
+
+    Example:
+
+        index = FrameIndex(references_store)
+        index.shortlist(queries_store["ED_aapmoal"], n_files = 20)
+        # => [ ("OV-aapmoal-verschillend...", 31, [ 120, 144 ]), ... ]
+    """
+
+    def __init__(self, store, n_tables = 8, n_bits = 16, max_bucket = 5000, seed = 1, chunk_frames = 1_000_000):
+        self.filenames  = store.filenames
+        self.n_tables   = n_tables
+        self.n_bits     = n_bits
+        self.max_bucket = max_bucket
+
+        n_frames, n_cols = store.data.shape
+
+        # File number and position within the file of each indexed frame
+        self.frame_file = np.zeros(n_frames, dtype = np.int32)
+        self.frame_pos  = np.zeros(n_frames, dtype = np.int32)
+
+        for file_number, filename in enumerate(self.filenames):
+            offset, length = store.index[filename]
+            self.frame_file[offset:offset + length] = file_number
+            self.frame_pos[offset:offset + length]  = np.arange(length)
+
+        # Mean and standard deviation of each feature column, accumulated over chunks of
+        # frames so that memory-mapped features are not loaded into memory in full
+        col_sum, col_sum_sq = np.zeros(n_cols), np.zeros(n_cols)
+
+        for start in range(0, n_frames, chunk_frames):
+            chunk       = np.asarray(store.data[start:start + chunk_frames], dtype = np.float64)
+            col_sum    += chunk.sum(0)
+            col_sum_sq += (chunk ** 2).sum(0)
+
+        self.mean  = col_sum / max(n_frames, 1)
+        self.scale = np.sqrt(np.maximum(col_sum_sq / max(n_frames, 1) - self.mean ** 2, 0))
+        self.scale[self.scale == 0] = 1
+
+        self.planes = np.random.RandomState(seed).normal(size = (n_cols, n_tables * n_bits))
+
+        codes = np.concatenate([ self._codes(store.data[start:start + chunk_frames]) for start in range(0, n_frames, chunk_frames) ]) if n_frames > 0 else np.zeros((0, n_tables), dtype = np.int64)
+
+        # Frames sorted by code in each table, so that a bucket is a range found by binary search
+        self._order        = [ np.argsort(codes[:, t], kind = 'stable') for t in range(n_tables) ]
+        self._sorted_codes = [ codes[order, t] for t, order in enumerate(self._order) ]
+
+    def _codes(self, frames):
+        """
+        (frames, n_tables) array of hash codes
+        """
+
+        frames = (np.asarray(frames, dtype = np.float64) - self.mean) / self.scale
+        bits   = (frames @ self.planes > 0).reshape(-1, self.n_tables, self.n_bits)
+
+        return bits.astype(np.int64) @ (1 << np.arange(self.n_bits, dtype = np.int64))
+
+    def hits(self, query_frames):
+        """
+        Returns arrays (query_pos, frame) of query frame positions and the indexed frames
+        sharing a code with them in any table. Buckets with more than max_bucket frames
+        (e.g. silence, which is common to all files) are ignored.
+        """
+
+        codes = self._codes(query_frames)
+
+        query_pos, frames = [], []
+
+        for t in range(self.n_tables):
+            starts = np.searchsorted(self._sorted_codes[t], codes[:, t], side = 'left')
+            ends   = np.searchsorted(self._sorted_codes[t], codes[:, t], side = 'right')
+            sizes  = ends - starts
+            sizes[sizes > self.max_bucket] = 0
+
+            # Positions in the sorted frames of every bucket member, for all query frames at once
+            owner     = np.repeat(np.arange(len(codes)), sizes)
+            positions = np.arange(sizes.sum()) - np.repeat(np.cumsum(sizes) - sizes, sizes) + np.repeat(starts, sizes)
+
+            query_pos.append(owner)
+            frames.append(self._order[t][positions])
+
+        query_pos, frames = np.concatenate(query_pos), np.concatenate(frames)
+
+        # A frame found in several tables only counts once
+        pairs = np.unique(np.stack([ query_pos, frames ], axis = 1), axis = 0)
+
+        return pairs[:, 0], pairs[:, 1]
+
+    def shortlist(self, query_frames, n_files, offset_bin = None, n_offsets = 3):
+        """
+        Files in which the query is most likely to occur, as a list of (filename, votes, offsets)
+        in descending order of votes. Each hit implies a start offset of the query in the file
+        (frame position in the file minus that in the query), and hits are binned by start
+        offset (in bins of offset_bin frames, default: half the query length). The votes for
+        a file are the number of distinct query frames hitting its best bin, and offsets are
+        the starts of the n_offsets bins with the most votes.
+        """
+
+        query_pos, frames = self.hits(query_frames)
+
+        if len(frames) == 0:
+            return []
+
+        offset_bin  = offset_bin or max(len(query_frames) // 2, 1)
+        file_number = self.frame_file[frames].astype(np.int64)
+        offset_bins = np.floor_divide(self.frame_pos[frames].astype(np.int64) - query_pos, offset_bin)
+
+        # Votes for each (file, offset bin): number of distinct query frames hitting it
+        file_bins, votes = np.unique(np.unique(np.stack([ file_number, offset_bins, query_pos ], axis = 1), axis = 0)[:, :2], axis = 0, return_counts = True)
+
+        # Order by file, then by descending votes within file
+        order = np.lexsort((-votes, file_bins[:, 0]))
+        file_bins, votes = file_bins[order], votes[order]
+
+        files, first = np.unique(file_bins[:, 0], return_index = True)
+        best_files   = np.argsort(-votes[first], kind = 'stable')[:n_files]
+
+        shortlist = []
+
+        for k in best_files:
+            start, end = first[k], first[k + 1] if k + 1 < len(first) else len(votes)
+            offsets    = [ max(int(b) * offset_bin, 0) for b in file_bins[start:min(start + n_offsets, end), 1] ]
+            shortlist.append((self.filenames[files[k]], int(votes[start]), offsets))
+
+        return shortlist
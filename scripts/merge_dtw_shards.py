@@ -0,0 +1,98 @@
+import argparse
+import glob
+import json
+import os
+import pandas as pd
+
+from run_cache import file_sha1
+
+parser = argparse.ArgumentParser(
+    description='Merges results of feats_to_dtw.py --shard i/N runs into the results of a single run. example: python merge_dtw_shards.py mfcc gos-kdl',
+    formatter_class=argparse.ArgumentDefaultsHelpFormatter
+    )
+
+parser.add_argument('features', help='features of results to merge, use _all_ to merge all found in shards directory')
+parser.add_argument('dataset', help = 'name of dataset, use _all_ to merge all found in shards directory')
+
+parser.add_argument('--datasets_dir', default='data/raw/datasets', help = "directory for raw datasets and labels files")
+parser.add_argument('--output_dir',  default='data/processed/dtw', help = "directory for dtw output, as given to feats_to_dtw.py (shards are read from its shards subdirectory)")
+parser.add_argument('--labels_file',  default='labels.csv', help = "file indicating which query occurs in which reference")
+parser.add_argument('--top_k',  default=0, type=int, help = "merge results of feats_to_dtw.py --top_k runs (in the top{k} subdirectory of output_dir)")
+
+args = parser.parse_args()
+
+def read_provenance(shards_dir):
+    # Provenance files of completed shards, by (features, dataset)
+    groups = {}
+
+    for path in sorted(glob.glob(os.path.join(shards_dir, "*.shard-*-of-*.json"))):
+        with open(path) as f:
+            provenance = json.load(f)
+
+        provenance['csv'] = os.path.splitext(path)[0] + '.csv'
+        groups.setdefault((provenance['features'], provenance['dataset']), []).append(provenance)
+
+    return groups
+
+def check_shards(features, dataset, shards, labels_csv):
+    # All shards must have been assigned from the same labels and features and searched with the same DTW settings
+    settings = [ 'n_shards', 'unit', 'assignment_sha1', 'labels_sha1', 'n_rows', 'dtw_impl', 'dtw_params', 'top_k', 'speech_only' ]
+
+    for shard in shards[1:]:
+        differing = [ s for s in settings if shard.get(s) != shards[0].get(s) ]
+        assert len(differing) == 0, "Shards {} and {} of {} dataset with {} features differ in {} (left over from an earlier run?)".format(shards[0]['csv'], shard['csv'], dataset, features, ", ".join(differing))
+
+    n_shards = shards[0]['n_shards']
+    missing  = sorted(set(range(1, n_shards + 1)).difference(s['shard'] for s in shards))
+
+    assert len(missing) == 0, "Shards {} of {} of {} dataset with {} features are missing or incomplete".format(", ".join(str(s) for s in missing), n_shards, dataset, features)
+    assert shards[0]['top_k'] == args.top_k, "Shards of {} dataset with {} features were run with --top_k {}, not {}".format(dataset, features, shards[0]['top_k'], args.top_k)
+
+    # Rows are put back in their order in the labels file, which must be the one the shards were assigned from
+    assert os.path.isfile(labels_csv), "Labels file does not exist at: {}".format(labels_csv)
+    assert file_sha1(labels_csv) == shards[0]['labels_sha1'], "Labels file {} has changed since shards of {} dataset with {} features were run".format(labels_csv, dataset, features)
+
+def merge_shards(features, dataset, shards, output_file):
+    labels_csv = os.path.join(args.datasets_dir, dataset, args.labels_file)
+    check_shards(features, dataset, shards, labels_csv)
+
+    labels_df   = pd.read_csv(labels_csv)
+    predictions = []
+
+    for shard in sorted(shards, key = lambda s: s['shard']):
+        # Read scores exactly as written, so that the merged file is identical to that of a single run
+        shard_df = pd.read_csv(shard['csv'], index_col = 'row', float_precision = 'round_trip')
+
+        assert shard_df.shape[0] == shard['rows_written'], "Shard file {} has {} rows, expected {}".format(shard['csv'], shard_df.shape[0], shard['rows_written'])
+        assert shard_df.index.isin(labels_df.index).all(), "Shard file {} has row numbers not in {}".format(shard['csv'], labels_csv)
+        assert (shard_df[["query", "reference"]].values == labels_df.loc[shard_df.index, ["query", "reference"]].values).all(), "Queries and references in {} do not match those in {}".format(shard['csv'], labels_csv)
+
+        predictions.append(shard_df["prediction"])
+
+    predictions = pd.concat(predictions)
+
+    assert not predictions.index.duplicated().any(), "Rows of {} dataset with {} features occur in more than one shard".format(dataset, features)
+
+    if args.top_k > 0:
+        # Each shard holds all rows of its queries, so its top k rows are those of the full run
+        labels_df = labels_df.loc[predictions.index.sort_values()].copy()
+    else:
+        assert predictions.shape[0] == labels_df.shape[0], "Shards of {} dataset with {} features have {} of {} rows".format(dataset, features, predictions.shape[0], labels_df.shape[0])
+
+    labels_df["prediction"] = predictions
+    labels_df.to_csv(output_file, index = False)
+
+    print("Merged {} shards of {} dataset with {} features ({} rows, from {}) into {}".format(
+        len(shards), dataset, features, labels_df.shape[0], ", ".join(sorted(set(s['host'] for s in shards))), output_file
+    ))
+
+output_dir = os.path.join(args.output_dir, "top{}".format(args.top_k)) if args.top_k > 0 else args.output_dir
+groups     = read_provenance(os.path.join(output_dir, "shards"))
+
+# As in feats_to_dtw.py, features are matched by prefix
+groups = { (features, dataset) : shards for (features, dataset), shards in groups.items() if (args.features == '_all_' or features.startswith(args.features)) and args.dataset in ['_all_', dataset] }
+
+assert len(groups) > 0, "No completed shards for {} dataset with {} features found in {}".format(args.dataset, args.features, os.path.join(output_dir, "shards"))
+
+for (features, dataset), shards in sorted(groups.items()):
+    merge_shards(features, dataset, shards, os.path.join(output_dir, "{}_{}.csv".format(features, dataset)))
@@ -0,0 +1,39 @@
+import argparse
+import glob
+import os
+import pickle
+from feature_store import FEATS_EXT, LEGACY_FEATS_EXT, FeatureWriter
+
+parser = argparse.ArgumentParser(
+    description='Convert legacy queries.pickle/references.pickle features into memory-mappable .npy features. example: python pickle_to_npy-feats.py mfcc wrm-pd',
+    formatter_class=argparse.ArgumentDefaultsHelpFormatter
+    )
+
+parser.add_argument('features', help='features to convert, use _all_ to iterate over all')
+parser.add_argument('dataset', help = 'name of dataset, use _all_ to iterate over all')
+
+parser.add_argument('--feats_dir',  default='data/interim/features', help = "directory for features")
+parser.add_argument('--feats_dtype',  default='float32', choices=['float32', 'float16'], help = "storage data type of converted features")
+parser.add_argument('--remove_pickles', action='store_true', help = "remove pickle files once converted")
+
+args = parser.parse_args()
+
+datasets = [ os.path.basename(p) for p in glob.glob(os.path.join(args.feats_dir, "*")) ] if args.dataset == '_all_' else [ args.dataset ]
+
+for dataset in datasets:
+
+    wildcard = '*' if args.features == '_all_' else args.features + "*"
+
+    for pickle_path in sorted(glob.glob(os.path.join(args.feats_dir, dataset, wildcard, "*" + LEGACY_FEATS_EXT))):
+
+        npy_path = os.path.splitext(pickle_path)[0] + FEATS_EXT
+        feats_df = pickle.load(open(pickle_path, "rb"))
+
+        with FeatureWriter(npy_path, dtype = args.feats_dtype) as writer:
+            for filename, features in zip(feats_df["filename"], feats_df["features"]):
+                writer.append(filename, features)
+
+        print("Features in {} written to {}".format(pickle_path, npy_path))
+
+        if args.remove_pickles:
+            os.remove(pickle_path)
@@ -0,0 +1,96 @@
+import http.client
+import json
+import os
+import socket
+import time
+import numpy as np
+
+from argparse import ArgumentParser, ArgumentDefaultsHelpFormatter
+from concurrent.futures import ThreadPoolExecutor
+from glob import glob
+
+parser = ArgumentParser(
+    description='Sends queries to query_server.py and reports hits and latencies. example: python query_client.py data/raw/datasets/gos-kdl/queries --repeat 3',
+    formatter_class=ArgumentDefaultsHelpFormatter
+)
+
+parser.add_argument('wav_paths', nargs='+', help = 'query .wav files, or directories of them')
+
+parser.add_argument('--host', default='127.0.0.1', help = 'address of server')
+parser.add_argument('--port', default=8765, type=int, help = 'port of server')
+parser.add_argument('--socket', default=None, help = 'if given, connect to server on this Unix socket instead of host and port')
+
+parser.add_argument('--top_k', default=5, type=int, help = 'number of references to request per query')
+parser.add_argument('--show_hits', default=3, type=int, help = 'number of hits to print per query')
+parser.add_argument('--repeat', default=1, type=int, help = 'number of times to send each query')
+parser.add_argument('--concurrency', default=1, type=int, help = 'number of requests sent at a time')
+
+args = parser.parse_args()
+
+class UnixHTTPConnection(http.client.HTTPConnection):
+
+    def __init__(self, socket_path):
+        super().__init__('localhost')
+        self.socket_path = socket_path
+
+    def connect(self):
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.sock.connect(self.socket_path)
+
+def request(method, path, body = None):
+    connection = UnixHTTPConnection(args.socket) if args.socket is not None else http.client.HTTPConnection(args.host, args.port)
+
+    try:
+        connection.request(method, path, body = body, headers = { 'Content-Type' : 'audio/wav' } if body is not None else {})
+        response = connection.getresponse()
+        return response.status, json.loads(response.read())
+    finally:
+        connection.close()
+
+def search(wav_path):
+    with open(wav_path, 'rb') as f:
+        wav_bytes = f.read()
+
+    start_time = time.perf_counter()
+    status, response = request('POST', '/search?top_k={}'.format(args.top_k), wav_bytes)
+
+    return wav_path, status, response, time.perf_counter() - start_time
+
+def main():
+    wav_paths = []
+
+    for path in args.wav_paths:
+        wav_paths += sorted(glob(os.path.join(path, '*.wav'))) if os.path.isdir(path) else [ path ]
+
+    assert len(wav_paths) > 0, 'No wav files found in {}'.format(args.wav_paths)
+
+    latencies = []
+
+    with ThreadPoolExecutor(args.concurrency) as executor:
+        for wav_path, status, response, latency in executor.map(search, wav_paths * args.repeat):
+
+            if status != 200:
+                print("{}: error {}: {}".format(wav_path, status, response['error']))
+                continue
+
+            latencies.append(latency)
+
+            hits = ", ".join("{} ({:.3f} at {:.2f} s)".format(h['reference'], h['score'], h['offset_seconds']) for h in response['hits'][:args.show_hits])
+            print("{} ({:.1f} s): {:.3f} s (featurize {:.3f} s, search {:.3f} s): {}".format(
+                os.path.basename(wav_path), response['query_seconds'], latency, response['timings']['featurize_seconds'], response['timings']['search_seconds'], hits
+            ))
+
+    if len(latencies) > 0:
+        print("Client latency over {} requests: p50 = {:.3f} s, p90 = {:.3f} s, p99 = {:.3f} s, max = {:.3f} s".format(
+            len(latencies), *np.percentile(latencies, [50, 90, 99]), max(latencies)
+        ))
+
+    _, stats = request('GET', '/stats')
+
+    print("Server latency over {} most recent of {} requests:".format(min(stats['requests'], stats['window']), stats['requests']))
+
+    for stage, percentiles in stats['latency_seconds'].items():
+        print("  {}: {}".format(stage, ", ".join("{} = {:.3f}".format(p, v) for p, v in percentiles.items())))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,302 @@
+import io
+import json
+import os
+import signal
+import threading
+import time
+import numpy as np
+import soundfile as sf
+
+from argparse import ArgumentParser, ArgumentDefaultsHelpFormatter
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from feature_store import FeatureStore, load_feature_store, resolve_feats_path
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from socketserver import ThreadingMixIn, UnixStreamServer
+from transformers import logging
+from urllib.parse import parse_qs, urlparse
+from segmental_dtw import SEGDTW_IMPLEMENTATIONS, iter_distance_matrices, segdtw_sim_score
+from w2v2_featurizer import BACKENDS, SAMPLE_RATE, load_wav2vec2_featurizer
+
+parser = ArgumentParser(
+    description='Serves QbE-STD searches over the references of one dataset: queries are wav files sent over HTTP, featurized with wav2vec 2.0 and searched with segmental DTW. example: python query_server.py gos-kdl --model wav2vec2-large-xlsr-53 --layer 11',
+    formatter_class=ArgumentDefaultsHelpFormatter
+)
+
+parser.add_argument('dataset', help = 'name of dataset whose reference features are searched')
+
+parser.add_argument('--model', default='wav2vec2-large-xlsr-53', help = 'wav2vec 2.0 model used to featurize queries (as for wav_to_w2v2-feats.py)')
+parser.add_argument('--stage', default='transformer', choices=['encoder', 'quantizer', 'transformer'], help = 'wav2vec 2.0 output stage')
+parser.add_argument('--layer', default=11, type=int, help = 'if stage is transformer, which layer of transformer')
+parser.add_argument('--features', default=None, help = 'name of reference features directory (default: that written by wav_to_w2v2-feats.py for model, stage and layer, e.g. wav2vec2-large-xlsr-53_transformer-L11)')
+
+parser.add_argument('--feats_dir',  default='data/interim/features', help = "directory for features")
+parser.add_argument('--references_file',  default='references.npy', help = "file with features of references (falls back to legacy references.pickle if not found)")
+
+parser.add_argument('--host', default='127.0.0.1', help = 'address to listen on')
+parser.add_argument('--port', default=8765, type=int, help = 'port to listen on')
+parser.add_argument('--socket', default=None, help = 'if given, listen on this Unix socket instead of host and port')
+
+parser.add_argument('--top_k', default=10, type=int, help = 'number of references returned per query (unless given in request)')
+parser.add_argument('--dtw_impl',  default='numpy-pruned', choices=list(SEGDTW_IMPLEMENTATIONS.keys()), help = "segmental DTW implementation (see feats_to_dtw.py). With numpy-pruned, references that cannot make the top k are abandoned early")
+parser.add_argument('--batch_frames',  default=200000, type=int, help = "maximum number of concatenated reference frames per batched distance computation")
+parser.add_argument('--num_workers', default=os.cpu_count(), type=int, help = 'number of DTW worker processes')
+parser.add_argument('--chunks_per_worker', default=2, type=int, help = 'number of reference chunks (tasks) per worker for each query')
+parser.add_argument('--num_threads', default=None, type=int, help='number of threads used by torch on CPU to featurize queries (default: torch default)')
+parser.add_argument('--backend', default='eager', choices=BACKENDS, help='inference backend used to featurize queries (see w2v2_featurizer.py)')
+parser.add_argument('--backend_cache_dir', default='data/interim/cache/models', help='directory for models traced or exported by the torchscript and onnx backends')
+parser.add_argument('--latency_window', default=1000, type=int, help = 'number of most recent requests over which latency percentiles are reported')
+parser.add_argument('--hft_logging', default=40, type=int, help='HuggingFace Transformers verbosity level (40 = errors, 30 = warnings, 20 = info, 10 = debug)')
+
+args = parser.parse_args()
+
+assert args.top_k >= 1, "--top_k must be at least 1, got {}".format(args.top_k)
+
+# Endpoints:
+#
+# POST /search?top_k=5  body: 16 kHz mono wav file of query
+#     -> { "query_seconds" : ..., "hits" : [ { "reference" : ..., "score" : ..., "offset_seconds" : ... }, ... ],
+#          "timings" : { "featurize_seconds" : ..., "search_seconds" : ..., "total_seconds" : ... } }
+#
+#     hits are sorted by score (as in feats_to_dtw.py, 1 - best segmental DTW distance), and offset_seconds
+#     is the start of the best matching window in the reference
+#
+# GET /stats -> number of requests served and latency percentiles of recent requests
+
+# Duration of a wav2vec 2.0 output frame (CNN encoder stride of 320 samples at 16 kHz)
+FRAME_SECONDS = 320 / SAMPLE_RATE
+
+def features_name():
+    if args.features is not None:
+        return args.features
+
+    # As named by wav_to_w2v2-feats.py, e.g. wav2vec2-large-xlsr-53_transformer-L11
+    if args.stage == 'transformer':
+        return "{}_transformer-L{}".format(args.model, str(args.layer).zfill(2))
+
+    return "{}_{}".format(args.model, args.stage)
+
+def search_chunk(task):
+    """
+    Segmental DTW of a query against a chunk of references, returning (reference, score, offset)
+    for the top_k best scoring references of the chunk (the overall top k are among those of all chunks)
+    """
+
+    query_feats_matrix, references_spec, references, top_k = task
+
+    references_store  = FeatureStore.attach(references_spec)
+    distance_matrices = iter_distance_matrices(query_feats_matrix, [ references_store[r] for r in references ], batch_frames = args.batch_frames)
+    segdtw_impl       = SEGDTW_IMPLEMENTATIONS[args.dtw_impl]
+
+    hits, top_dists = [], []
+
+    for reference, distance_matrix in zip(references, distance_matrices):
+        if args.dtw_impl == 'numpy-pruned':
+            # Once top_k references have been scored, abandon those that cannot beat the k-th best
+            max_dist     = top_dists[top_k - 1] if len(top_dists) >= top_k else np.inf
+            segdtw_dists = segdtw_impl(distance_matrix, max_dist = max_dist)
+        else:
+            segdtw_dists = segdtw_impl(distance_matrix)
+
+        if len(segdtw_dists) == 0:
+            continue
+
+        score = segdtw_sim_score(segdtw_dists)
+
+        if len(top_dists) >= top_k and 1 - score > top_dists[top_k - 1]:
+            continue
+
+        top_dists = sorted(top_dists + [ 1 - score ])[:top_k]
+        hits.append((reference, float(score), int(np.argmin(segdtw_dists))))
+
+    return sorted(hits, key = lambda hit: -hit[1])[:top_k]
+
+def ignore_interrupts():
+    # Workers are stopped by the server on Ctrl+C (which is sent to all processes in the foreground group)
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+
+class LatencyStats:
+    """
+    Latencies of the most recent requests for each timed stage (e.g. featurize, search, total)
+    """
+
+    def __init__(self, window):
+        self.window    = window
+        self.requests  = 0
+        self.latencies = {}
+        self._lock     = threading.Lock()
+
+    def add(self, timings):
+        with self._lock:
+            self.requests += 1
+
+            for stage, seconds in timings.items():
+                self.latencies.setdefault(stage, deque(maxlen = self.window)).append(seconds)
+
+    def summary(self):
+        with self._lock:
+            latencies = { stage : np.array(values) for stage, values in self.latencies.items() }
+
+        return {
+            'requests' : self.requests,
+            'window' : self.window,
+            'latency_seconds' : {
+                stage : { 'mean' : float(values.mean()), **{ 'p{}'.format(p) : float(np.percentile(values, p)) for p in [50, 90, 95, 99] }, 'max' : float(values.max()) }
+                for stage, values in latencies.items()
+            }
+        }
+
+class SearchService:
+    """
+    Holds the featurizer, reference features and DTW worker pool for the lifetime of the server
+    """
+
+    def __init__(self):
+        references_path = resolve_feats_path(os.path.join(args.feats_dir, args.dataset, features_name(), args.references_file))
+        assert os.path.isfile(references_path), "References features file does not exist at: {}".format(references_path)
+
+        # As in feats_to_dtw.py, workers attach to the reference features instead of each
+        # holding a copy: .npy features are memory-mapped, legacy pickles put in shared memory
+        self.references_store = load_feature_store(references_path)
+
+        if references_path.endswith(".pickle"):
+            self.references_store = self.references_store.to_shared_memory()
+
+        # Contiguous chunks of references with similar numbers of frames, one DTW task each
+        references     = self.references_store.filenames
+        frames         = np.cumsum([ self.references_store.index[r][1] for r in references ])
+        n_chunks       = min(args.num_workers * args.chunks_per_worker, len(references))
+        chunk_starts   = np.searchsorted(frames, frames[-1] * np.arange(n_chunks) / n_chunks, side = 'right')
+        chunk_bounds   = [ int(b) for b in np.unique(chunk_starts) ] + [ len(references) ]
+        self.chunks    = [ (self.references_store.subset_spec(references[start:end]), references[start:end]) for start, end in zip(chunk_bounds[:-1], chunk_bounds[1:]) if end > start ]
+
+        # Start workers before loading the model, so that they do not inherit it (or torch's threads)
+        self.executor = ProcessPoolExecutor(args.num_workers, initializer = ignore_interrupts)
+        [ f.result() for f in [ self.executor.submit(os.getpid) for _ in range(args.num_workers) ] ]
+
+        layer = { 'encoder' : -2, 'quantizer' : -1 }.get(args.stage, args.layer)
+
+        self.featurizer     = load_wav2vec2_featurizer(args.model, layer = layer, num_threads = args.num_threads, backend = args.backend, backend_cache_dir = args.backend_cache_dir)
+        self.featurize_lock = threading.Lock()
+        self.stats          = LatencyStats(args.latency_window)
+
+        print("Loaded {} with {} features of {} references ({} frames) in {} chunks over {} workers".format(
+            args.model, features_name(), len(references), frames[-1], len(self.chunks), args.num_workers
+        ))
+
+    def search(self, wav_bytes, top_k):
+        start_time = time.perf_counter()
+
+        wav_info = sf.info(io.BytesIO(wav_bytes))
+        assert wav_info.samplerate == SAMPLE_RATE, "Query audio must be sampled at {} Hz, got {} Hz".format(SAMPLE_RATE, wav_info.samplerate)
+        assert wav_info.channels == 1, "Query audio must be mono, got {} channels".format(wav_info.channels)
+
+        # One forward pass at a time, each using torch's intra-op threads
+        with self.featurize_lock:
+            query_feats_matrix = self.featurizer(io.BytesIO(wav_bytes))
+
+        featurize_time = time.perf_counter()
+
+        futures = [ self.executor.submit(search_chunk, (query_feats_matrix, references_spec, references, top_k)) for references_spec, references in self.chunks ]
+        hits    = sorted([ hit for future in futures for hit in future.result() ], key = lambda hit: -hit[1])[:top_k]
+
+        end_time = time.perf_counter()
+
+        timings = {
+            'featurize_seconds' : featurize_time - start_time,
+            'search_seconds' : end_time - featurize_time,
+            'total_seconds' : end_time - start_time
+        }
+
+        self.stats.add(timings)
+
+        return {
+            'query_seconds' : wav_info.duration,
+            'query_frames' : int(query_feats_matrix.shape[0]),
+            'hits' : [ { 'reference' : reference, 'score' : score, 'offset_seconds' : round(offset * FRAME_SECONDS, 3) } for reference, score, offset in hits ],
+            'timings' : timings
+        }
+
+    def close(self):
+        self.executor.shutdown()
+        self.references_store.unlink()
+
+class SearchHandler(BaseHTTPRequestHandler):
+
+    service = None
+
+    def do_GET(self):
+        if urlparse(self.path).path == '/stats':
+            self._send_json(200, self.service.stats.summary())
+        else:
+            self._send_json(404, { 'error' : 'Unknown path: {}'.format(self.path) })
+
+    def do_POST(self):
+        url = urlparse(self.path)
+
+        if url.path != '/search':
+            self._send_json(404, { 'error' : 'Unknown path: {}'.format(self.path) })
+            return
+
+        try:
+            wav_bytes = self.rfile.read(int(self.headers['Content-Length']))
+            top_k     = int(parse_qs(url.query).get('top_k', [ args.top_k ])[0])
+
+            assert top_k >= 1, "top_k must be at least 1, got {}".format(top_k)
+
+            response = self.service.search(wav_bytes, top_k)
+        except (AssertionError, RuntimeError, TypeError, ValueError) as e:
+            self._send_json(400, { 'error' : str(e) })
+            return
+
+        self._send_json(200, response)
+
+    def _send_json(self, status, body):
+        body = json.dumps(body).encode()
+
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def address_string(self):
+        # Clients of a Unix socket have no address
+        return self.client_address[0] if type(self.client_address) is tuple else args.socket
+
+class ThreadingUnixHTTPServer(ThreadingMixIn, UnixStreamServer):
+    daemon_threads = True
+
+def main():
+    logging.set_verbosity(args.hft_logging)
+
+    SearchHandler.service = SearchService()
+
+    # Shut down as on Ctrl+C when stopped by e.g. kill or docker stop
+    signal.signal(signal.SIGTERM, signal.default_int_handler)
+
+    if args.socket is not None:
+        if os.path.exists(args.socket):
+            os.remove(args.socket)
+
+        server = ThreadingUnixHTTPServer(args.socket, SearchHandler)
+        print("Listening on {}".format(args.socket))
+    else:
+        server = ThreadingHTTPServer((args.host, args.port), SearchHandler)
+        print("Listening on http://{}:{}".format(args.host, args.port))
+
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        print(json.dumps(SearchHandler.service.stats.summary(), indent = 2))
+
+        server.server_close()
+        SearchHandler.service.close()
+
+        if args.socket is not None:
+            os.remove(args.socket)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,108 @@
+import hashlib
+import json
+import os
+import sqlite3
+import numpy as np
+
+# Content-addressed caches so that interrupted or incremental runs only compute what is new:
+#
+# - FeatureCache: features of one wav file, keyed by a hash of the wav file's contents and
+#   the extraction parameters (e.g. model, revision and layer)
+# - ScoreCache: DTW scores of a query-reference pair, keyed by a hash of the query and
+#   reference features and the DTW parameters
+
+def file_sha1(path, block_size = 1 << 20):
+    sha1 = hashlib.sha1()
+
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(block_size), b''):
+            sha1.update(block)
+
+    return sha1.hexdigest()
+
+def array_sha1(array):
+    array = np.ascontiguousarray(array)
+
+    sha1 = hashlib.sha1(str((array.dtype.str, array.shape)).encode())
+    sha1.update(array.data)
+
+    return sha1.hexdigest()
+
+def params_sha1(*parts):
+    """
+    Hash of parts (hashes, parameter dicts, etc.), serialised as JSON
+    (values JSON cannot represent, e.g. numpy scalars, are serialised using str())
+    """
+
+    return hashlib.sha1(json.dumps(parts, sort_keys = True, default = str).encode()).hexdigest()
+
+class FeatureCache:
+    """
+    Directory of feature matrices, one .npy file per key (stored as cache_dir/ab/abcdef....npy)
+    """
+
+    def __init__(self, cache_dir):
+        self.cache_dir = cache_dir
+
+    def _path(self, key):
+        return os.path.join(self.cache_dir, key[:2], key + '.npy')
+
+    def __contains__(self, key):
+        return os.path.isfile(self._path(key))
+
+    def get(self, key):
+        return np.load(self._path(key)) if key in self else None
+
+    def put(self, key, features):
+        path = self._path(key)
+        os.makedirs(os.path.dirname(path), exist_ok = True)
+
+        # Write to temporary file then move, so that interrupted writes never leave partial entries
+        part_path = path + '.{}.part'.format(os.getpid())
+
+        with open(part_path, 'wb') as f:
+            np.save(f, features)
+
+        os.replace(part_path, path)
+
+class ScoreCache:
+    """
+    SQLite table of scores by key. Scores are buffered by put() and written by checkpoint(),
+    so that completed scores survive an interrupted run.
+    """
+
+    def __init__(self, db_path):
+        os.makedirs(os.path.dirname(os.path.abspath(db_path)), exist_ok = True)
+
+        self._db = sqlite3.connect(db_path)
+        self._db.execute("CREATE TABLE IF NOT EXISTS scores (key TEXT PRIMARY KEY, score REAL)")
+        self._pending = []
+
+    def get_many(self, keys):
+        """
+        Returns dict of key -> score for those keys that are in the cache
+        """
+
+        scores = {}
+        keys   = list(keys)
+
+        # Stay under SQLite's limit on the number of query parameters
+        for i in range(0, len(keys), 500):
+            batch = keys[i:i + 500]
+            rows  = self._db.execute("SELECT key, score FROM scores WHERE key IN ({})".format(",".join("?" * len(batch))), batch)
+            scores.update(rows)
+
+        return scores
+
+    def put(self, key, score):
+        self._pending.append((key, float(score)))
+
+    def checkpoint(self):
+        with self._db:
+            self._db.executemany("INSERT OR REPLACE INTO scores (key, score) VALUES (?, ?)", self._pending)
+
+        self._pending = []
+
+    def close(self):
+        self.checkpoint()
+        self._db.close()
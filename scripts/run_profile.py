@@ -0,0 +1,357 @@
+import cProfile
+import glob
+import json
+import os
+import pstats
+import resource
+import sys
+import time
+import numpy as np
+import pandas as pd
+from contextlib import contextmanager
+from datetime import datetime
+from functools import partial
+from multiprocessing import util
+from pathlib import Path
+
+# Opt-in instrumentation shared by the extraction and DTW scripts (--profile):
+#
+# - per-stage wall and CPU time (stages timed in worker processes are summed over workers)
+# - throughput of stages that process a known number of items (e.g. files/s, pairs/s)
+# - per-pair segmental DTW time against distance matrix size
+# - peak resident memory (RSS) of the main process and of each worker
+# - optionally (--cprofile), cProfile statistics of main and worker processes, merged into one
+#   file readable with pstats or e.g. snakeviz
+#
+# Reports are written to profile_dir as {script}_{timestamp}.json, with per-pair DTW costs in
+# {script}_{timestamp}_pairs.csv.
+
+def add_profile_args(parser):
+    parser.add_argument('--profile', action='store_true', help = "write a report of time spent in each stage, throughput and peak memory use of main and worker processes to --profile_dir")
+    parser.add_argument('--profile_dir', default='data/interim/profiles', help = "directory for --profile reports")
+    parser.add_argument('--cprofile', action='store_true', help = "with --profile, also write cProfile statistics (of main and worker processes) to a .prof file in --profile_dir")
+
+def peak_rss_mb():
+    # ru_maxrss is in kilobytes on Linux, but in bytes on macOS
+    max_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+    return max_rss / (1 << 20) if sys.platform == 'darwin' else max_rss / (1 << 10)
+
+class RunProfiler:
+    """
+    Collects stage timings for a run. When disabled (the default), stage() only adds the cost
+    of entering a context manager, and timed() and map() pass iterables through as they are.
+
+    Example:
+
+        profiler = RunProfiler.from_args(args, 'feats_to_dtw')
+
+        with profiler.stage('load_features'):
+            ...
+
+        for result in profiler.map(executor.map, task_fn, tasks):
+            ...
+
+        profiler.report()
+
+    In worker processes (started with fork), stages timed inside task functions passed through
+    map() (or submit()) are collected per task and sent back to the main process with the task's result.
+    """
+
+    def __init__(self, enabled = False, profile_dir = None, script = None, run_args = None, cprofile = False):
+        self.enabled     = enabled
+        self.profile_dir = profile_dir
+        self.script      = script
+        self.run_args    = run_args or {}
+        self.cprofile    = cprofile and enabled
+
+        self._start_wall = time.perf_counter()
+        self._start_cpu  = time.process_time()
+        self._run_name   = "{}_{}".format(script, datetime.now().strftime('%Y%m%d-%H%M%S'))
+        self._reset()
+
+        self._cprofile  = None
+        self._in_worker = False
+
+        if self.cprofile:
+            Path(profile_dir).mkdir(parents = True, exist_ok = True)
+            self._cprofile = cProfile.Profile()
+            self._cprofile.enable()
+
+    @classmethod
+    def from_args(cls, args, script):
+        """
+        Profiler of the run of script, which task functions passed through map() or submit() report to
+        """
+
+        profiler = cls(args.profile, args.profile_dir, script, vars(args), args.cprofile)
+
+        # Task functions in workers find the profiler of their process here
+        global _profiler
+        _profiler = profiler
+
+        return profiler
+
+    def _reset(self):
+        self._pid    = os.getpid()
+        self.stages  = {}
+        self.pairs   = []
+        self.workers = {}
+
+    @contextmanager
+    def stage(self, name, items = 0, unit = None, matrix_shape = None):
+        """
+        Times the enclosed block as part of stage name, which processed items (of unit, e.g. 'files').
+        If matrix_shape is given, also records the time for that (query frames, reference frames) pair.
+        Yields a dict whose 'items' can be added to within the block, if not known beforehand
+        """
+
+        counts = { 'items' : items }
+
+        if not self.enabled:
+            yield counts
+            return
+
+        start_wall, start_cpu = time.perf_counter(), time.process_time()
+
+        try:
+            yield counts
+        finally:
+            wall, cpu = time.perf_counter() - start_wall, time.process_time() - start_cpu
+
+            self._add_stage(name, { 'wall_seconds' : wall, 'cpu_seconds' : cpu, 'calls' : 1, 'items' : counts['items'], 'unit' : unit })
+
+            if matrix_shape is not None:
+                self.pairs.append({ 'stage' : name, 'query_frames' : matrix_shape[0], 'reference_frames' : matrix_shape[1], 'seconds' : wall })
+
+    def timed(self, name, iterable, unit = None):
+        """
+        Yields items of iterable, timing the production of each (e.g. of a generator) as stage name
+        """
+
+        if not self.enabled:
+            yield from iterable
+            return
+
+        iterator = iter(iterable)
+
+        while True:
+            start_wall, start_cpu = time.perf_counter(), time.process_time()
+
+            try:
+                item = next(iterator)
+            except StopIteration:
+                return
+
+            self._add_stage(name, { 'wall_seconds' : time.perf_counter() - start_wall, 'cpu_seconds' : time.process_time() - start_cpu, 'calls' : 1, 'items' : 1, 'unit' : unit })
+
+            yield item
+
+    def _add_stage(self, name, stats):
+        stage = self.stages.setdefault(name, { 'wall_seconds' : 0, 'cpu_seconds' : 0, 'calls' : 0, 'items' : 0, 'unit' : stats['unit'] })
+
+        for k in [ 'wall_seconds', 'cpu_seconds', 'calls', 'items' ]:
+            stage[k] += stats[k]
+
+    def map(self, map_fn, fn, tasks, **kwargs):
+        """
+        map_fn(fn, tasks, **kwargs) (e.g. executor.map or pool.imap), collecting each task's time,
+        stages and the peak memory use of the worker that ran it
+        """
+
+        if not self.enabled:
+            yield from map_fn(fn, tasks, **kwargs)
+            return
+
+        for result, task_stats in map_fn(partial(_profiled_call, fn), tasks, **kwargs):
+            self._add_task(task_stats)
+
+            yield result
+
+    def submit(self, executor, fn, task):
+        """
+        executor.submit(fn, task), returning a future to be passed to result()
+        """
+
+        if not self.enabled:
+            return executor.submit(fn, task)
+
+        return executor.submit(_profiled_call, fn, task)
+
+    def result(self, future):
+        """
+        Result of a future returned by submit(), collecting the task's time, stages and worker memory use as map() does
+        """
+
+        if not self.enabled:
+            return future.result()
+
+        result, task_stats = future.result()
+        self._add_task(task_stats)
+
+        return result
+
+    def _add_task(self, task_stats):
+        worker = self.workers.setdefault(task_stats['pid'], { 'tasks' : 0, 'wall_seconds' : 0, 'cpu_seconds' : 0, 'peak_rss_mb' : 0 })
+
+        worker['tasks']        += 1
+        worker['wall_seconds'] += task_stats['wall_seconds']
+        worker['cpu_seconds']  += task_stats['cpu_seconds']
+        worker['peak_rss_mb']   = max(worker['peak_rss_mb'], task_stats['peak_rss_mb'])
+
+        for name, stats in task_stats['stages'].items():
+            self._add_stage(name, stats)
+
+        self.pairs.extend(task_stats['pairs'])
+
+    def report(self):
+        """
+        Writes the report (if enabled) and prints a summary of it
+        """
+
+        if not self.enabled:
+            return
+
+        Path(self.profile_dir).mkdir(parents = True, exist_ok = True)
+
+        total_wall = time.perf_counter() - self._start_wall
+
+        stages = {}
+
+        for name, stats in self.stages.items():
+            stages[name] = dict(stats)
+
+            if stats['items'] > 0 and stats['unit'] is not None:
+                stages[name][stats['unit'] + '_per_sec'] = stats['items'] / max(stats['wall_seconds'], 1e-9)
+
+        report = {
+            'script' : self.script,
+            'args' : self.run_args,
+            'wall_seconds' : total_wall,
+            'cpu_seconds' : time.process_time() - self._start_cpu,
+            'peak_rss_mb' : peak_rss_mb(),
+            'stages' : stages,
+            'workers' : { str(pid) : stats for pid, stats in self.workers.items() }
+        }
+
+        report_path = os.path.join(self.profile_dir, self._run_name + '.json')
+
+        if len(self.pairs) > 0:
+            pairs_df = pd.DataFrame(self.pairs)
+            pairs_df['cells'] = pairs_df['query_frames'] * pairs_df['reference_frames']
+            pairs_df.to_csv(os.path.join(self.profile_dir, self._run_name + '_pairs.csv'), index = False)
+
+            # Cost per cell of the distance matrix, and how it scales with matrix size
+            # (slope of log time against log cells: 1 if time is proportional to matrix size)
+            report['pairs'] = {}
+
+            for name, stage_df in pairs_df.groupby('stage'):
+                slope = np.polyfit(np.log(stage_df['cells']), np.log(np.maximum(stage_df['seconds'], 1e-9)), 1)[0] if stage_df['cells'].nunique() > 1 else np.nan
+
+                report['pairs'][name] = {
+                    'pairs' : int(stage_df.shape[0]),
+                    'median_seconds' : float(stage_df['seconds'].median()),
+                    'microseconds_per_1k_cells' : float(1e9 * stage_df['seconds'].sum() / stage_df['cells'].sum()),
+                    'log_time_vs_log_cells_slope' : float(slope)
+                }
+
+        if self._cprofile is not None:
+            report['cprofile'] = self._dump_cprofile()
+
+        json.dump(report, open(report_path, 'w'), indent = 2, default = str)
+
+        print("Run time {:.1f} s (CPU {:.1f} s), peak memory {:.0f} MB in main process{}".format(
+            report['wall_seconds'], report['cpu_seconds'], report['peak_rss_mb'],
+            ", {:.0f} MB in largest of {} workers".format(max(w['peak_rss_mb'] for w in self.workers.values()), len(self.workers)) if len(self.workers) > 0 else ""
+        ))
+
+        for name, stats in stages.items():
+            throughput = "" if stats['unit'] is None or stats['items'] == 0 else ", {:.1f} {}/s".format(stats[stats['unit'] + '_per_sec'], stats['unit'])
+            print("  {}: {:.1f} s (CPU {:.1f} s) over {} calls{}".format(name, stats['wall_seconds'], stats['cpu_seconds'], stats['calls'], throughput))
+
+        print("Profile report written to {}".format(report_path))
+
+    def _cprofile_path(self, pid = None):
+        return os.path.join(self.profile_dir, self._run_name + ('.prof' if pid is None else '.{}.prof'.format(pid)))
+
+    def _dump_cprofile(self):
+        # Merge statistics of the main process with those dumped by workers on exit
+        self._cprofile.disable()
+
+        main_path    = self._cprofile_path()
+        worker_paths = [ p for p in glob.glob(self._cprofile_path('*')) if p != main_path ]
+
+        self._cprofile.dump_stats(main_path)
+
+        stats = pstats.Stats(main_path)
+
+        for worker_path in worker_paths:
+            stats.add(worker_path)
+            os.remove(worker_path)
+
+        stats.dump_stats(main_path)
+
+        return main_path
+
+    def _start_worker(self):
+        # First task in a (forked) worker: drop what was collected by the main
+        # process before the fork, and start a separate cProfile for the worker
+        self._reset()
+        self._in_worker = True
+
+        if self._cprofile is not None:
+            self._cprofile.disable()
+            self._cprofile = cProfile.Profile()
+            util.Finalize(None, _dump_worker_cprofile, args = (self._cprofile, self._cprofile_path(os.getpid())), exitpriority = 10)
+
+    def _drain(self):
+        stages, pairs = self.stages, self.pairs
+        self.stages, self.pairs = {}, []
+
+        return stages, pairs
+
+_profiler = None
+
+# Disabled profiler for code called without one (e.g. library functions), which unlike
+# those from from_args() does not replace the profiler of the run for task functions
+NO_PROFILER = RunProfiler()
+
+def _dump_worker_cprofile(profile, path):
+    # Runs as the worker exits. A later worker may get the same pid, so add to existing statistics
+    stats = pstats.Stats(profile)
+
+    if os.path.isfile(path):
+        stats.add(path)
+
+    stats.dump_stats(path)
+
+def _profiled_call(fn, task):
+    profiler = _profiler
+
+    if profiler._pid != os.getpid():
+        profiler._start_worker()
+
+    # The main process's cProfile (if any) is enabled for the whole run
+    worker_cprofile = profiler._cprofile if profiler._in_worker else None
+
+    start_wall, start_cpu = time.perf_counter(), time.process_time()
+
+    if worker_cprofile is not None:
+        worker_cprofile.enable()
+
+    try:
+        result = fn(task)
+    finally:
+        if worker_cprofile is not None:
+            worker_cprofile.disable()
+
+    stages, pairs = profiler._drain()
+
+    return result, {
+        'pid' : os.getpid(),
+        'wall_seconds' : time.perf_counter() - start_wall,
+        'cpu_seconds' : time.process_time() - start_cpu,
+        'peak_rss_mb' : peak_rss_mb(),
+        'stages' : stages,
+        'pairs' : pairs
+    }
@@ -0,0 +1,469 @@
+import numpy as np
+from dtw import dtw
+from itertools import repeat
+from numpy.lib.stride_tricks import as_strided
+from scipy.ndimage import minimum_filter1d
+from scipy.spatial.distance import cdist
+
+# reject if alignment less than half of query size
+# or if larger than 1.5 times query size
+MIN_MATCH_RATIO, MAX_MATCH_RATIO = [0.5, 1.5]
+
+# Parameters that determine DTW scores (used as part of cache keys for scores)
+SEGDTW_PARAMS = {
+    'distance' : 'seuclidean, column-wise min-max normalised',
+    'step_pattern' : 'symmetricP1',
+    'open_end' : True,
+    'match_ratios' : [MIN_MATCH_RATIO, MAX_MATCH_RATIO]
+}
+
+def feats_to_distance_matrix(query_feats_matrix, reference_feats_matrix, columns = None):
+    """
+    For two feature matrices Q of shape (M, F) and R of shape (N, F) where M, N time frames and F feature columns
+    standardise each feature matrix within each feature component then compute Euclidean distance between each pair of
+    time frames. Produces a distance matrix of shape (M, N), normalised to [0, 1] within each column.
+
+    If columns (boolean mask of reference frames, e.g. from window_columns()) is given, only those columns
+    are computed, and the others are inf. The variances used to standardise are still those of all frames,
+    so computed columns are the same as in the full distance matrix.
+    """
+
+    assert query_feats_matrix.shape[1] == reference_feats_matrix.shape[1], "Query and reference feature matrices differ in number of columns"
+
+    if columns is not None:
+        # Variance of stacked query and reference frames, as computed by cdist for V = None
+        variance        = np.var(np.vstack([ query_feats_matrix, reference_feats_matrix ]).astype(np.double), axis = 0, ddof = 1)
+        distance_matrix = np.full((query_feats_matrix.shape[0], reference_feats_matrix.shape[0]), np.inf)
+
+        if columns.any():
+            selected = cdist(query_feats_matrix, reference_feats_matrix[columns], 'seuclidean', V = variance)
+            distance_matrix[:, columns] = (selected - selected.min(0)) / np.ptp(selected, 0)
+
+        return distance_matrix
+
+    distance_matrix = cdist(query_feats_matrix, reference_feats_matrix, 'seuclidean', V = None)
+                    # Normalise to [0, 1] range by subtracting min, then dividing by range (ptp = peak-to-peak)
+    distance_matrix = (distance_matrix - distance_matrix.min(0)) / np.ptp(distance_matrix, 0)
+
+    return distance_matrix
+
+def iter_distance_matrices(query_feats_matrix, reference_feats_matrices, batch_frames = 200_000, reference_columns = None):
+    """
+    Batched equivalent of calling feats_to_distance_matrix(query, reference) for each reference in
+    reference_feats_matrices, yielding one (M, N_r) distance matrix per reference in order.
+
+    References are concatenated (up to batch_frames reference frames at a time) so that the
+    standardised Euclidean distances for all of them come from matrix products in one vectorised call:
+
+        d(q, r)^2 = sum_f q_f^2 / V_f + sum_f r_f^2 / V_f - 2 sum_f q_f r_f / V_f
+
+    where, as in cdist(..., 'seuclidean', V = None), V is the variance of the stacked query and
+    reference frames and so differs for each reference. The column-wise [0, 1] normalisation is
+    done on the concatenated matrix before it is split back into per-reference slices.
+    Results match feats_to_distance_matrix() up to floating point error.
+
+    If reference_columns (one boolean mask of frames, or None for all frames, per reference) is given,
+    only those columns of each distance matrix are computed, as in feats_to_distance_matrix().
+    """
+
+    query = np.asarray(query_feats_matrix, dtype=np.float64)
+
+    if reference_columns is None:
+        reference_columns = repeat(None)
+
+    def _batches():
+        batch, batch_columns, batch_size = [], [], 0
+        for reference_feats_matrix, columns in zip(reference_feats_matrices, reference_columns):
+            assert query.shape[1] == reference_feats_matrix.shape[1], "Query and reference feature matrices differ in number of columns"
+            batch.append(np.asarray(reference_feats_matrix, dtype=np.float64))
+            batch_columns.append(columns)
+            batch_size += reference_feats_matrix.shape[0]
+            if batch_size >= batch_frames:
+                yield batch, batch_columns
+                batch, batch_columns, batch_size = [], [], 0
+        if len(batch) > 0:
+            yield batch, batch_columns
+
+    query_sq   = query ** 2
+    query_mean = query.mean(0)
+    query_ss   = ((query - query_mean) ** 2).sum(0)
+
+    for batch, batch_columns in _batches():
+
+        # Variance of stacked query and reference frames for each reference, combining
+        # per-matrix means and sums of squares (Chan et al.) instead of stacking them
+        inv_var = np.empty((len(batch), query.shape[1]))
+        for k, reference in enumerate(batch):
+            n_q, n_r       = query.shape[0], reference.shape[0]
+            reference_mean = reference.mean(0)
+            reference_ss   = ((reference - reference_mean) ** 2).sum(0)
+            pooled_ss      = query_ss + reference_ss + (reference_mean - query_mean) ** 2 * n_q * n_r / (n_q + n_r)
+            inv_var[k]     = (n_q + n_r - 1) / pooled_ss
+
+        # Distances are only computed for selected columns (variances are still those of all frames)
+        full_lengths = [ r.shape[0] for r in batch ]
+        batch        = [ r if columns is None else r[columns] for r, columns in zip(batch, batch_columns) ]
+        lengths      = [ r.shape[0] for r in batch ]
+
+        weighted_refs = np.vstack([ reference * inv_var[k] for k, reference in enumerate(batch) ])
+        references_sq = np.concatenate([ (reference ** 2) @ inv_var[k] for k, reference in enumerate(batch) ])
+
+        distance_matrix  = np.repeat(query_sq @ inv_var.T, lengths, axis=1)
+        distance_matrix += references_sq
+        distance_matrix -= 2 * (query @ weighted_refs.T)
+        distance_matrix  = np.sqrt(np.maximum(distance_matrix, 0, out=distance_matrix), out=distance_matrix)
+
+        # Normalise to [0, 1] range by subtracting min, then dividing by range (ptp = peak-to-peak)
+        distance_matrix = (distance_matrix - distance_matrix.min(0)) / np.ptp(distance_matrix, 0)
+
+        for reference_matrix, columns, full_length in zip(np.split(distance_matrix, np.cumsum(lengths)[:-1], axis=1), batch_columns, full_lengths):
+            if columns is None:
+                yield reference_matrix
+            else:
+                full_matrix = np.full((query.shape[0], full_length), np.inf)
+                full_matrix[:, columns] = reference_matrix
+                yield full_matrix
+
+def n_window_offsets(query_length, reference_length):
+    # Number of start offsets of segmental DTW windows (see segdtw_dists_numpy)
+    if int(query_length * MAX_MATCH_RATIO) == 0:
+        return 0
+
+    return max(int(reference_length - (MIN_MATCH_RATIO * query_length)), 0)
+
+def spans_to_mask(spans, length):
+    """
+    Boolean mask of length frames, true within spans ((spans, 2) array of [start, end) frames, e.g. speech regions)
+    """
+
+    mask = np.zeros(length, dtype=bool)
+
+    for start, end in spans:
+        mask[start:end] = True
+
+    return mask
+
+def window_columns(start_mask, query_length):
+    """
+    Boolean mask of the reference frames (columns of the distance matrix) covered by segmental DTW
+    windows starting at offsets in start_mask (boolean mask of reference frames), i.e. the only
+    columns that the segdtw_dists_* functions read when given start_mask
+    """
+
+    window_size = int(query_length * MAX_MATCH_RATIO)
+    starts      = start_mask.copy()
+    starts[n_window_offsets(query_length, len(start_mask)):] = False
+
+    # Column j is covered if any of the window_size offsets up to j is a start
+    n_starts = np.concatenate([[0], np.cumsum(starts)])
+    columns  = np.arange(len(start_mask))
+
+    return n_starts[columns + 1] - n_starts[np.maximum(columns + 1 - window_size, 0)] > 0
+
+def _offset_runs(start_mask, last_segment_end):
+    # [start, end) ranges of consecutive offsets in start_mask, or all offsets if start_mask is None
+    if start_mask is None:
+        return [ (0, last_segment_end) ]
+
+    edges = np.diff(np.concatenate([[0], start_mask[:last_segment_end].astype(np.int8), [0]]))
+
+    return list(zip(np.flatnonzero(edges == 1), np.flatnonzero(edges == -1)))
+
+def segdtw_dists_dtw_python(distance_matrix, start_mask = None):
+    """
+    Reference implementation of segmental DTW: divide reference into segments by moving
+    a window roughly the size of the query along the length of the reference and
+    calculate a DTW alignment at each step using dtw-python (one dtw() call per offset).
+    Returns a list with one normalised distance per start offset (1 for rejected alignments).
+
+    If start_mask (boolean mask of reference frames, e.g. speech regions) is given, windows
+    only start at offsets in it, and other offsets are rejected (1). Columns of distance_matrix
+    not covered by these windows (see window_columns) are not used, and can be inf.
+    """
+
+    segdtw_dists = []
+    query_length, reference_length = distance_matrix.shape
+
+    window_size      = int(query_length * MAX_MATCH_RATIO)
+    last_segment_end = int(reference_length - (MIN_MATCH_RATIO * query_length))
+
+    for r_i in range(last_segment_end):
+
+        if start_mask is not None and not start_mask[r_i]:
+            segdtw_dists.append(1)
+            continue
+
+        segment_start = r_i
+        segment_end   = min(r_i + window_size, reference_length)
+
+        segment_data  = distance_matrix[:,segment_start:segment_end]
+
+        dtw_obj = dtw(segment_data,
+            step_pattern = "symmetricP1", # See Sakoe & Chiba (1978) for definition of step pattern
+            open_end = True,              # Let alignment end anywhere along the segment (need not be at lower corner)
+            distance_only = True          # Speed up dtw(), no backtracing for alignment path
+        )
+
+        match_ratio = dtw_obj.jmin / query_length
+
+        if match_ratio < MIN_MATCH_RATIO or match_ratio > MAX_MATCH_RATIO:
+            segdtw_dists.append(1)
+        else:
+            segdtw_dists.append(dtw_obj.normalizedDistance)
+
+    return segdtw_dists
+
+def segdtw_dists_numpy(distance_matrix, block_size = 4096, start_mask = None):
+    """
+    Vectorised segmental DTW, equivalent to segdtw_dists_dtw_python().
+
+    The symmetricP1 recursion for row i only depends on rows i - 1 and i - 2, so
+    instead of solving one DTW per start offset, all offsets are swept together
+    one query row at a time. Each offset's segment is a (zero-copy) sliding window
+    view over the same row of the distance matrix, padded with inf past the end
+    of the reference so that segments clipped at the reference end behave as
+    in dtw-python. Offsets are processed in blocks of block_size to bound memory.
+    Returns an array with one normalised distance per start offset (1 for rejected alignments).
+    If start_mask is given, only offsets in it are computed, as in segdtw_dists_dtw_python().
+    """
+
+    query_length, reference_length = distance_matrix.shape
+
+    window_size      = int(query_length * MAX_MATCH_RATIO)
+    last_segment_end = int(reference_length - (MIN_MATCH_RATIO * query_length))
+
+    if last_segment_end <= 0 or window_size == 0:
+        return np.ones(0)
+
+    # Pad each row so that every window of window_size starting before
+    # last_segment_end exists; padded cells are unreachable (inf cost)
+    padded = np.full((query_length, last_segment_end + window_size - 1), np.inf)
+    n_cols = min(reference_length, padded.shape[1])
+    padded[:, :n_cols] = distance_matrix[:, :n_cols]
+
+    # Denominator for 'N+M' normalisation of the last row, i.e. n + j + 1 for column j
+    norm = query_length + np.arange(window_size) + 1
+
+    segdtw_dists = np.ones(last_segment_end)
+
+    blocks = [ (block_start, min(block_start + block_size, run_end)) for run_start, run_end in _offset_runs(start_mask, last_segment_end) for block_start in range(run_start, run_end, block_size) ]
+
+    for block_start, block_end in blocks:
+
+        # (rows, offsets, window) views: local[i, k, j] = distance_matrix[i, block_start + k + j]
+        local = _sliding_windows(padded[:, block_start:block_end + window_size - 1], window_size)
+
+        last_row = _symmetricP1_last_row(local)
+
+        # Open end: alignment may end at any column of the last query row
+        last_row = last_row / norm
+        jmin     = np.argmin(last_row, axis=1)
+        dists    = last_row[np.arange(block_end - block_start), jmin]
+
+        match_ratio = jmin / query_length
+        rejected    = (match_ratio < MIN_MATCH_RATIO) | (match_ratio > MAX_MATCH_RATIO) | np.isinf(dists)
+
+        segdtw_dists[block_start:block_end] = np.where(rejected, 1, dists)
+
+    return segdtw_dists
+
+def _sliding_windows(matrix, window_size):
+    """
+    Zero-copy (rows, windows, window_size) view of the windows along the columns of a 2D matrix,
+    as numpy.lib.stride_tricks.sliding_window_view(matrix, window_size, axis=1) (numpy >= 1.20)
+    """
+
+    n_rows, n_cols = matrix.shape
+    row_stride, col_stride = matrix.strides
+
+    return as_strided(matrix, shape=(n_rows, n_cols - window_size + 1, window_size), strides=(row_stride, col_stride, col_stride), writeable=False)
+
+def _symmetricP1_last_row(local):
+    """
+    Cumulative cost of the last query row for a stack of local cost matrices
+    of shape (rows, offsets, window), following the symmetricP1 step pattern:
+
+        g(i,j) = min( g(i-1,j-2) + 2d(i,j-1) + d(i,j),
+                      g(i-1,j-1) + 2d(i,j),
+                      g(i-2,j-1) + 2d(i-1,j) + d(i,j) )
+
+    with g(0,0) = d(0,0). Unreachable cells are inf.
+    """
+
+    n_rows, n_offsets, window_size = local.shape
+
+    prev2 = None
+    prev1 = np.full((n_offsets, window_size), np.inf)
+    prev1[:, 0] = local[0, :, 0]
+
+    for i in range(1, n_rows):
+        prev2, prev1 = prev1, _symmetricP1_row(prev1, prev2, local[i - 1], local[i])
+
+    return prev1
+
+def _symmetricP1_row(prev1, prev2, d_prev, d_i):
+    """
+    Cumulative cost of row i from those of rows i - 1 (prev1) and i - 2 (prev2, None for i = 1),
+    given the local costs of rows i - 1 (d_prev) and i (d_i), all of shape (offsets, window)
+    """
+
+    curr = np.full(d_i.shape, np.inf)
+
+    # Same operation order as dtw-python so that results are bitwise comparable
+    curr[:, 2:] = prev1[:, :-2] + 2 * d_i[:, 1:-1] + d_i[:, 2:]
+    np.minimum(curr[:, 1:], prev1[:, :-1] + 2 * d_i[:, 1:], out=curr[:, 1:])
+
+    if prev2 is not None:
+        np.minimum(curr[:, 1:], prev2[:, :-1] + 2 * d_prev[:, 1:] + d_i[:, 1:], out=curr[:, 1:])
+
+    return curr
+
+def segdtw_dists_pruned(distance_matrix, block_size = 256, abandon_every = 4, max_dist = np.inf, start_mask = None):
+    """
+    Segmental DTW with lower bound pruning and early abandoning. Only the minimum distance
+    over all start offsets is needed for the score (see segdtw_sim_score), so offsets that
+    cannot beat the best distance found so far are not (fully) computed. Returns an array
+    with one distance per start offset, as segdtw_dists_numpy() does, except that pruned or
+    abandoned offsets are inf. The minimum (and so the score) is exactly that of segdtw_dists_numpy().
+
+    For the offset o, the cost of a symmetricP1 path through the segment is a weighted sum of
+    local costs in which each query row i > 0 has a weight of 1 to 3, so replacing each local
+    cost by the minimum of its row within the segment, m_i(o), gives a lower bound for the cost
+    of alignments ending at each column j (cf. LB_Kim and LB_Keogh, which bound DTW by minima
+    and envelopes of the series instead), taking the smallest bound over the columns j giving
+    an accepted match ratio. Offsets are solved in contiguous blocks of block_size, in ascending
+    order of the smallest bound in each block, and offsets whose bound is larger than the best
+    distance so far are skipped. While solving a block, offsets whose partial cost after row i
+    plus the row minima of the remaining rows already exceeds the best distance are abandoned
+    (checked every abandon_every rows). Blocks are only narrowed from either end, so that the
+    recursion runs on zero-copy views of the distance matrix as in segdtw_dists_numpy().
+
+    If max_dist is given, offsets are only computed if they could give a distance below it (so
+    the minimum is at least max_dist, possibly inf, if none can), e.g. to skip references that
+    cannot make a top k. If start_mask is given, only offsets in it are computed, and others are
+    rejected (1), as in segdtw_dists_dtw_python().
+    """
+
+    query_length, reference_length = distance_matrix.shape
+
+    window_size      = int(query_length * MAX_MATCH_RATIO)
+    last_segment_end = int(reference_length - (MIN_MATCH_RATIO * query_length))
+
+    if last_segment_end <= 0 or window_size == 0:
+        return np.ones(0)
+
+    padded = np.full((query_length, last_segment_end + window_size - 1), np.inf)
+    n_cols = min(reference_length, padded.shape[1])
+    padded[:, :n_cols] = distance_matrix[:, :n_cols]
+
+    norm = query_length + np.arange(window_size) + 1
+
+    # Alignments ending at columns giving a rejected match ratio score 1, which never beats the best distance
+    valid_ends = ~((np.arange(window_size) / query_length < MIN_MATCH_RATIO) | (np.arange(window_size) / query_length > MAX_MATCH_RATIO))
+
+    # Row minima within the segment at each offset, m_i(o), and their sums over rows i and below
+    row_mins     = minimum_filter1d(padded, window_size, axis=1, mode='nearest', origin=-(window_size // 2))[:, :last_segment_end]
+    rows_to_go   = np.cumsum(row_mins[::-1], axis=0)[::-1]
+    rows_to_go   = np.vstack([ rows_to_go, np.zeros((1, last_segment_end)) ])
+
+    # Each row i > 0 gets a total weight of 1 to 3 in the cost of a path (a step adds 2 d(i, j) or
+    # 2 d(i, j - 1) + d(i, j) to one row, or 2 d(i - 1, j) + d(i, j) to two rows), and these weights
+    # sum to query_length - 1 + j for a path ending at column j. The cost is thus at least that of
+    # giving weight 1 to each row and the remaining j to the rows with the smallest minima, 2 each.
+    sorted_mins  = np.sort(row_mins[1:], axis=0)
+    smallest_sum = np.vstack([ np.zeros((1, last_segment_end)), np.cumsum(sorted_mins, axis=0) ])
+
+    ends      = np.arange(window_size)[valid_ends]
+    n_doubled = np.minimum(ends // 2, query_length - 1)
+    has_odd   = (ends % 2 == 1) & (n_doubled < query_length - 1)
+    odd_row   = np.minimum(n_doubled, max(query_length - 2, 0))
+
+    lower_bounds = np.full(last_segment_end, np.inf)
+    allowed      = np.ones(last_segment_end, dtype=bool) if start_mask is None else start_mask[:last_segment_end]
+
+    for block_start in range(0, last_segment_end if len(ends) > 0 else 0, block_size):
+        offsets = np.arange(block_start, min(block_start + block_size, last_segment_end))
+        offsets = offsets[allowed[offsets]]
+
+        # (ends, offsets) lower bounds of path costs
+        bounds  = (padded[0, offsets] + rows_to_go[1, offsets])[None, :] + 2 * smallest_sum[n_doubled][:, offsets]
+        bounds += np.where(has_odd[:, None], sorted_mins[odd_row][:, offsets], 0)
+
+        lower_bounds[offsets] = (bounds / norm[valid_ends][:, None]).min(axis=0)
+
+    windows      = _sliding_windows(padded, window_size)
+    max_norm     = norm[valid_ends].max() if valid_ends.any() else norm.max()
+    segdtw_dists = np.where(allowed, np.inf, 1)
+    best         = max_dist
+
+    # Blocks are contiguous ranges of offsets, so that local costs are zero-copy views
+    # as in segdtw_dists_numpy(), and pruning trims offsets from either end of a block
+    block_starts = np.arange(0, last_segment_end, block_size)
+    block_bounds = np.minimum.reduceat(lower_bounds, block_starts)
+
+    for block_start in block_starts[np.argsort(block_bounds, kind='stable')]:
+        block_end = min(block_start + block_size, last_segment_end)
+        keep      = ~_prunable(lower_bounds[block_start:block_end], best) & allowed[block_start:block_end]
+
+        if not keep.any():
+            # Blocks are in ascending order of their smallest bound, so the remaining ones are all prunable
+            break
+
+        kept     = np.flatnonzero(keep)
+        start    = block_start + kept[0]
+        end      = block_start + kept[-1] + 1
+
+        prev2 = None
+        prev1 = np.full((end - start, window_size), np.inf)
+        prev1[:, 0] = windows[0, start:end, 0]
+
+        for i in range(1, query_length):
+            prev2, prev1 = prev1, _symmetricP1_row(prev1, prev2, windows[i - 1, start:end], windows[i, start:end])
+
+            if i % abandon_every == 0 and i < query_length - 1:
+                # Path either ends a step in row i, or passes over row i in a step from row i - 1 to i + 1
+                partial_cost = np.minimum(prev1.min(axis=1) + rows_to_go[i + 1, start:end], prev2.min(axis=1) + rows_to_go[i, start:end])
+                keep         = ~_prunable(partial_cost / max_norm, best)
+
+                if not keep.any():
+                    start = end
+                    break
+
+                kept         = np.flatnonzero(keep)
+                prev1, prev2 = prev1[kept[0]:kept[-1] + 1], prev2[kept[0]:kept[-1] + 1]
+                start, end   = start + kept[0], start + kept[-1] + 1
+
+        if start == end:
+            continue
+
+        last_row = prev1 / norm
+        jmin     = np.argmin(last_row, axis=1)
+        dists    = last_row[np.arange(end - start), jmin]
+
+        match_ratio = jmin / query_length
+        rejected    = (match_ratio < MIN_MATCH_RATIO) | (match_ratio > MAX_MATCH_RATIO) | np.isinf(dists) | ~allowed[start:end]
+
+        segdtw_dists[start:end] = np.where(rejected, 1, dists)
+        best = np.fmin.reduce(segdtw_dists[start:end], initial=best)
+
+    return segdtw_dists
+
+def _prunable(bounds, best):
+    # Small margin so that floating point error in the bounds never prunes the best offset
+    return bounds * (1 - 1e-9) > best
+
+SEGDTW_IMPLEMENTATIONS = {
+    'numpy' : segdtw_dists_numpy,
+    'numpy-pruned' : segdtw_dists_pruned,
+    'dtw-python' : segdtw_dists_dtw_python
+}
+
+def segdtw_sim_score(segdtw_dists):
+    """
+    Convert distance (lower is better) to similary score (is higher better)
+    makes it easier to compare with CNN output probabilities
+
+    Return 0 if segdtw_dists is [] (i.e. no good alignments found)
+    """
+
+    return 0 if len(segdtw_dists) == 0 else 1 - min(segdtw_dists)
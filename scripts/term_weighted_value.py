@@ -0,0 +1,75 @@
+import glob
+import os
+import numpy as np
+import soundfile as sf
+
+# Maximum Term Weighted Value (MTWV), as computed by the NIST STDEval tool for the files prepared
+# by prep_STDEval.R (see dtw_to_mtwv.py), with the prior and costs used there by default
+
+PRIOR, COST_FA, COST_MISS = [0.0279, 1, 10]
+
+def reference_durations(dataset_dir):
+    # Durations in seconds of reference wav files, rounded to 2 decimals as by prep_STDEval.R
+    wav_paths = glob.glob(os.path.join(dataset_dir, "references", "*.wav"))
+
+    return { os.path.splitext(os.path.basename(p))[0] : round(sf.info(p).frames / sf.info(p).samplerate, 2) for p in wav_paths }
+
+def mtwv(results_df, n_true, n_trials, prior = PRIOR, cost_fa = COST_FA, cost_miss = COST_MISS):
+    """
+    Maximum Term Weighted Value over all thresholds, computed as STDEval does for DTW results in which
+    each (query, reference) pair is one detection spanning the whole reference:
+
+        TWV(t) = 1 - mean over terms of [ P_miss(term, t) + beta * P_fa(term, t) ],  beta = cost_fa / cost_miss * (1 / prior - 1)
+
+    where P_miss = 1 - (targets with score >= t) / n_true[term], P_fa = (non-targets with score >= t) / (n_trials - n_true[term]),
+    and terms are the queries with at least one occurrence (n_true > 0). Because TWV(t) is a sum of one contribution per
+    detection scoring >= t, the TWVs at all thresholds (each distinct score, plus one above all scores) are cumulative sums
+    over detections sorted by descending score. Of tied maximum values, that at the lowest threshold is reported, as by STDEval.
+    Returns (mtwv, p_fa, p_miss, threshold).
+    """
+
+    beta  = cost_fa / cost_miss * (1 / prior - 1)
+    terms = n_true[n_true > 0]
+
+    results_df = results_df[results_df["query"].isin(terms.index) & results_df["prediction"].notna()]
+
+    scores = results_df["prediction"].values
+    target = results_df["label"].values == 1
+    term_n = terms.loc[results_df["query"]].values
+
+    # Contributions of each detection to P_miss (negative) and P_fa, if scoring above threshold
+    miss_weights = np.where(target, -1 / (len(terms) * term_n), 0)
+    fa_weights   = np.where(target, 0, 1 / (len(terms) * (n_trials - term_n)))
+
+    order  = np.argsort(-scores, kind = 'stable')
+    scores = scores[order]
+
+    p_miss = np.maximum(1 + np.cumsum(miss_weights[order]), 0) # (rounding error)
+    p_fa   = np.cumsum(fa_weights[order])
+
+    # Threshold at each distinct score: last detection of each run of tied scores
+    last   = np.flatnonzero(np.append(scores[1:] != scores[:-1], True))
+    p_miss = np.append(1, p_miss[last])
+    p_fa   = np.append(0, p_fa[last])
+    twv    = 1 - p_miss - beta * p_fa
+
+    # twv[0] is for no detections (threshold above all scores, reported as the highest score),
+    # twv[i] for the threshold at the i-th highest distinct score
+    thresholds = np.append(scores[:1], scores[last])
+
+    # Highest value, at the lowest threshold if tied
+    best = len(twv) - 1 - np.argmax(twv[::-1])
+
+    return twv[best], p_fa[best], p_miss[best], thresholds[best]
+
+def labels_mtwv(results_df, labels_df, ref_durs, trials_per_sec = 1, **costs):
+    """
+    MTWV of results_df (query, reference, label, prediction) for the pairs of labels_df: occurrences of each
+    query are counted from labels_df (so pairs missing from results_df count as misses), and trials from the
+    durations (ref_durs, from reference_durations()) of its references, as in the files of prep_STDEval.R
+    """
+
+    n_true   = labels_df.groupby("query")["label"].sum()
+    n_trials = np.round(trials_per_sec * sum(ref_durs[r] for r in labels_df["reference"].unique()))
+
+    return mtwv(results_df, n_true, n_trials, **costs)
@@ -0,0 +1,92 @@
+import numpy as np
+
+# Energy-based voice activity detection, used by the extraction scripts (--vad) to store the speech regions
+# of each file next to its features, so that feats_to_dtw.py --speech_only only starts DTW windows inside them.
+#
+# Frames are marked as speech if their energy (in dB) is above a threshold set between the quietest
+# (background) and loudest frames of the file. Pauses shorter than min_gap_seconds are kept as part of
+# the speech around them, bursts shorter than min_speech_seconds are dropped, and regions are padded
+# by pad_seconds on either side. Settings err on the side of keeping audio, as speech missed here can
+# never be matched, while non-speech kept only costs search time.
+
+VAD_PARAMS = {
+    'frame_seconds' : 0.02,
+    'floor_percentile' : 10,
+    'peak_percentile' : 99,
+    'threshold_ratio' : 0.2,
+    'min_gap_seconds' : 0.3,
+    'min_speech_seconds' : 0.1,
+    'pad_seconds' : 0.2
+}
+
+def speech_regions(wav, sample_rate, params = VAD_PARAMS):
+    """
+    Returns the (start, end) times in seconds of the speech regions in wav (array of samples, averaged over channels if 2D)
+    """
+
+    wav = np.asarray(wav, dtype = np.float64)
+    wav = wav.mean(axis = 1) if wav.ndim > 1 else wav
+
+    frame_size = max(int(round(params['frame_seconds'] * sample_rate)), 1)
+    n_frames   = len(wav) // frame_size
+    duration   = len(wav) / sample_rate
+
+    if n_frames == 0 or not np.any(wav):
+        return []
+
+    # Energy of non-overlapping frames (the last, partial frame is counted as speech if the one before it is)
+    frames    = wav[:n_frames * frame_size].reshape(n_frames, frame_size)
+    energy_db = 10 * np.log10(np.einsum('ij,ij->i', frames, frames) / frame_size + 1e-20)
+
+    floor, peak = np.percentile(energy_db, [ params['floor_percentile'], params['peak_percentile'] ])
+    is_speech   = energy_db > floor + params['threshold_ratio'] * (peak - floor)
+
+    # Runs of speech frames as [start, end) frame numbers
+    edges   = np.diff(np.concatenate([[0], is_speech.astype(np.int8), [0]]))
+    regions = [ [ start, end ] for start, end in zip(np.flatnonzero(edges == 1), np.flatnonzero(edges == -1)) ]
+
+    min_gap, min_speech, pad = [ int(round(params[p] / params['frame_seconds'])) for p in ['min_gap_seconds', 'min_speech_seconds', 'pad_seconds'] ]
+
+    merged = []
+
+    for region in regions:
+        if len(merged) > 0 and region[0] - merged[-1][1] < min_gap:
+            merged[-1][1] = region[1]
+        else:
+            merged.append(region)
+
+    padded = []
+
+    for start, end in merged:
+        if end - start < min_speech:
+            continue
+
+        start, end = max(start - pad, 0), end + pad
+
+        if len(padded) > 0 and start <= padded[-1][1]:
+            padded[-1][1] = end
+        else:
+            padded.append([ start, end ])
+
+    return [ (float(start * params['frame_seconds']), float(end * params['frame_seconds'] if end < n_frames else duration)) for start, end in padded ]
+
+def speech_frames(regions, frame_seconds, n_frames):
+    """
+    Converts speech regions in seconds into an (regions, 2) array of [start, end) numbers of feature
+    frames frame_seconds apart, with all frames overlapping a region counted as speech
+    """
+
+    frames = []
+
+    for start, end in regions:
+        start, end = int(np.floor(start / frame_seconds)), min(int(np.ceil(end / frame_seconds)), n_frames)
+
+        if end <= start:
+            continue
+
+        if len(frames) > 0 and start <= frames[-1][1]:
+            frames[-1][1] = max(frames[-1][1], end)
+        else:
+            frames.append([ start, end ])
+
+    return np.array(frames, dtype = int).reshape(-1, 2)
@@ -0,0 +1,354 @@
+import os
+import soundfile as sf
+import numpy as np
+import torch
+import transformers
+
+from pathlib import Path
+from run_cache import params_sha1
+from run_profile import NO_PROFILER
+
+from transformers.models.wav2vec2 import Wav2Vec2Model
+
+KNOWN_MODELS = {
+    # Pre-trained
+    'wav2vec2-base': 'facebook/wav2vec2-base',
+    'wav2vec2-large': {'name' : 'facebook/wav2vec2-large', 'revision' : '85c73b1a7c1ee154fd7b06634ca7f42321db94db' },
+    # March 11, 2021 version: https://huggingface.co/facebook/wav2vec2-large/commit/85c73b1a7c1ee154fd7b06634ca7f42321db94db
+    'wav2vec2-large-lv60': 'facebook/wav2vec2-large-lv60',
+    'wav2vec2-large-xlsr-53': {'name' : 'facebook/wav2vec2-large-xlsr-53', 'revision' : '8e86806e53a4df405405f5c854682c785ae271da' },
+    # May 6, 2021 version: https://huggingface.co/facebook/wav2vec2-large-xlsr-53/commit/8e86806e53a4df405405f5c854682c785ae271da
+
+    # Fine-tuned
+    'wav2vec2-base-960h': 'facebook/wav2vec2-base-960h',
+    'wav2vec2-large-960h': 'facebook/wav2vec2-large-960h',
+    'wav2vec2-large-960h-lv60': 'facebook/wav2vec2-large-960h-lv60',
+    'wav2vec2-large-960h-lv60-self': 'facebook/wav2vec2-large-960h-lv60-self',
+    'wav2vec2-large-xlsr-53-english': 'jonatasgrosman/wav2vec2-large-xlsr-53-english',
+    'wav2vec2-large-xlsr-53-tamil': 'manandey/wav2vec2-large-xlsr-tamil'
+}
+
+SAMPLE_RATE = 16_000
+
+# Inference backends: the model as loaded (eager), with linear layers dynamically quantized to int8 (int8),
+# traced with TorchScript (torchscript, torchscript-int8), or exported to ONNX and run with onnxruntime
+# (onnx, and onnx-int8 with weights quantized by onnxruntime). Backends other than eager run on CPU.
+BACKENDS = ['eager', 'int8', 'torchscript', 'torchscript-int8', 'onnx', 'onnx-int8']
+
+def load_wav2vec2_featurizer(model, layer=None, num_threads=None, chunk_seconds=None, left_context_seconds=0, right_context_seconds=0, profiler=None, backend='eager', backend_cache_dir='data/interim/cache/models'):
+    """
+    Loads Wav2Vec2 featurization pipeline and returns it as a function.
+    Featurizer returns a dict with the representations of all stages from a single forward pass
+    if "layer" argument is None, keyed by layer number as used by the "layer" argument
+    (-2: encoder, -1: quantizer, 1 to N: transformer layers).
+    Otherwise, only returns the specified layer representations.
+
+    Featurizer takes the path to a wav file, or a list of paths to featurize together as one
+    zero-padded batch (see length_buckets), in which case a list of outputs is returned, each
+    trimmed to the number of frames of its file. "num_threads" sets the number of threads
+    used by torch for intra-op parallelism on CPU.
+
+    If "chunk_seconds" is given, files are featurized in streaming mode: audio is read and passed
+    through the model in windows of chunk_seconds, plus left_context_seconds and right_context_seconds
+    of surrounding audio, and the frames for each chunk (excluding context) are stitched back together.
+    This bounds memory use regardless of file length. Window boundaries are aligned to frames (20 ms),
+    so CNN encoder outputs are unchanged (for models without group norm), but transformer outputs
+    only see the audio within each window and so may differ from those using the full file.
+
+    If a RunProfiler is given as "profiler", reading audio and model forward passes are timed as its
+    'read_audio' and 'model_forward' stages.
+
+    "backend" selects how the model is run (see BACKENDS). The torchscript and onnx backends need a single
+    "layer", and run one file at a time. Their traced or exported models are cached in "backend_cache_dir",
+    keyed by model, revision, layer, backend and torch and transformers versions, so that they are only
+    created once.
+    """
+
+    assert backend in BACKENDS, f'Unknown backend {backend}, expected one of {BACKENDS}'
+
+    profiler = profiler or NO_PROFILER
+
+    model_spec = KNOWN_MODELS.get(model, model)
+    model_kwargs = {}
+    if layer is not None:
+        model_kwargs["num_hidden_layers"] = layer if layer > 0 else 0
+
+    if type(model_spec) is dict:
+        model_name_or_path       = model_spec['name']
+        model_kwargs['revision'] = model_spec['revision']
+    else:
+        model_name_or_path = model_spec
+
+    if num_threads is not None:
+        torch.set_num_threads(num_threads)
+
+    model = Wav2Vec2Model.from_pretrained(model_name_or_path, **model_kwargs)
+
+    use_cuda = torch.cuda.is_available() and backend == 'eager'
+    num_gpus = torch.cuda.device_count() if use_cuda else 0
+
+    if num_gpus > 1:
+        model = torch.nn.DataParallel(model)
+
+    model.eval()
+    if use_cuda:
+        model.cuda()
+
+    if backend != 'eager':
+        # Inference on CPU: intra-op threads only, no inter-op parallelism between independent ops
+        try:
+            torch.set_num_interop_threads(1)
+        except RuntimeError:
+            pass # (can only be set before any inter-op parallel work has run)
+
+    if backend.endswith('int8') and not backend.startswith('onnx'):
+        model = torch.quantization.quantize_dynamic(model, {torch.nn.Linear}, dtype=torch.qint8)
+
+    w2v2 = model if num_gpus <= 1 else model.module
+
+    # Models whose CNN encoder uses group norm (e.g. wav2vec2-base) were trained without attention
+    # masks, and zero-padding changes their outputs, so batches for these are run one file at a time
+    supports_batching = w2v2.config.feat_extract_norm == 'layer'
+
+    exported = None
+
+    if backend.startswith('torchscript') or backend.startswith('onnx'):
+        assert layer is not None, f'The {backend} backend only outputs a single layer'
+
+        cache_key = params_sha1(model_spec, layer, backend, torch.__version__, transformers.__version__)
+        exported  = _load_exported(_LayerOutput(w2v2, layer), backend, os.path.join(backend_cache_dir, f'{os.path.basename(model_name_or_path)}_{layer}_{backend}_{cache_key[:12]}'), num_threads)
+
+        # Exported models take no attention mask
+        supports_batching = False
+
+    def _forward(input_values, attention_mask, frame_lengths):
+        if exported is not None:
+            return exported(input_values)
+
+        if layer is None:
+            encoder_state   = w2v2.feature_extractor(input_values).transpose(1, 2)
+            quantizer_state = w2v2.feature_projection(encoder_state)
+
+            frame_mask    = None if attention_mask is None else torch.arange(encoder_state.shape[1], device=encoder_state.device)[None, :] < frame_lengths[:, None].to(encoder_state.device)
+            hidden_states = list(w2v2.encoder(quantizer_state, attention_mask=frame_mask, output_hidden_states=True).hidden_states)
+
+            # Models with stable layer norm (e.g. large-lv60, large-xlsr-53) only apply the final encoder
+            # layer norm to the last hidden state, whereas a model truncated to L layers (as when "layer" is
+            # given) applies it to layer L. Apply it here so outputs match those of the truncated models.
+            if w2v2.config.do_stable_layer_norm:
+                hidden_states[1:-1] = [ w2v2.encoder.layer_norm(s) for s in hidden_states[1:-1] ]
+
+            hidden_states = { l : s for l, s in enumerate(hidden_states) if l > 0 }
+            hidden_states[-2] = encoder_state
+            hidden_states[-1] = quantizer_state
+
+            return hidden_states
+
+        if layer >= 0:
+            hidden_state = model(input_values, attention_mask=attention_mask).last_hidden_state
+        else:
+            hidden_state = w2v2.feature_extractor(input_values)
+            hidden_state = hidden_state.transpose(1, 2)
+            if layer == -1:
+                hidden_state = w2v2.feature_projection(hidden_state)
+
+        return hidden_state
+
+    def _read(path, start=0, stop=None):
+        with profiler.stage('read_audio'):
+            input_values, rate = sf.read(path, start=start, stop=stop, dtype=np.float32)
+        assert rate == SAMPLE_RATE
+        return input_values
+
+    @torch.no_grad()
+    def _featurize_batch(wavs):
+        lengths        = torch.tensor([ len(w) for w in wavs ])
+        input_values   = torch.zeros(len(wavs), int(lengths.max()))
+        attention_mask = torch.zeros(len(wavs), int(lengths.max()), dtype=torch.long)
+
+        for i, wav in enumerate(wavs):
+            input_values[i, :len(wav)]   = torch.from_numpy(wav)
+            attention_mask[i, :len(wav)] = 1
+
+        # No padding for a single file
+        if len(wavs) == 1:
+            attention_mask = None
+
+        if use_cuda:
+            input_values   = input_values.cuda()
+            attention_mask = attention_mask.cuda() if attention_mask is not None else None
+
+        frame_lengths = w2v2._get_feat_extract_output_lengths(lengths)
+
+        with profiler.stage('model_forward', items=int(frame_lengths.sum()), unit='frames'):
+            outputs = _forward(input_values, attention_mask, frame_lengths)
+
+        def _trim(state, i):
+            return state[i, :int(frame_lengths[i])].cpu().numpy()
+
+        if type(outputs) is dict:
+            return [ { l : _trim(s, i) for l, s in outputs.items() } for i in range(len(wavs)) ]
+
+        return [ _trim(outputs, i) for i in range(len(wavs)) ]
+
+    # Number of audio samples per output frame (320, i.e. 50 frames per second)
+    frame_stride = int(np.prod(w2v2.config.conv_stride))
+
+    def _featurize_streaming(path):
+        n_samples = sf.info(path).frames
+
+        chunk, left, right = [ int(round(s * SAMPLE_RATE / frame_stride)) * frame_stride for s in [chunk_seconds, left_context_seconds, right_context_seconds] ]
+
+        # The CNN encoder's receptive field extends past the frame stride,
+        # so at least one frame of right context is needed for the last frame of a chunk
+        chunk = max(chunk, frame_stride)
+        right = max(right, frame_stride)
+
+        chunk_outputs = []
+        core_start    = 0
+
+        while core_start < n_samples:
+            core_end = min(core_start + chunk, n_samples)
+
+            # Fold a short remainder into the last chunk instead of featurizing a tiny window
+            if n_samples - core_end < chunk // 2:
+                core_end = n_samples
+
+            window_start = max(0, core_start - left)
+            window_end   = min(n_samples, core_end + right)
+
+            output = _featurize_batch([ _read(path, window_start, window_end) ])[0]
+
+            # Keep frames of the chunk itself, i.e. drop those of left and right context
+            first_frame = (core_start - window_start) // frame_stride
+            last_frame  = None if core_end == n_samples else (core_end - window_start) // frame_stride
+
+            if type(output) is dict:
+                chunk_outputs.append({ l : s[first_frame:last_frame] for l, s in output.items() })
+            else:
+                chunk_outputs.append(output[first_frame:last_frame])
+
+            core_start = core_end
+
+        if type(chunk_outputs[0]) is dict:
+            return { l : np.concatenate([ o[l] for o in chunk_outputs ]) for l in chunk_outputs[0].keys() }
+
+        return np.concatenate(chunk_outputs)
+
+    def _featurize(path):
+        if chunk_seconds is not None:
+            return [ _featurize_streaming(p) for p in path ] if type(path) in [list, tuple] else _featurize_streaming(path)
+
+        if type(path) not in [list, tuple]:
+            return _featurize_batch([ _read(path) ])[0]
+
+        if not supports_batching:
+            return [ _featurize_batch([ _read(p) ])[0] for p in path ]
+
+        return _featurize_batch([ _read(p) for p in path ])
+
+    return _featurize
+
+class _LayerOutput(torch.nn.Module):
+    """
+    Outputs of a single layer (-2: encoder, -1: quantizer, 1 to N: last transformer layer of a
+    model truncated to N layers) as one tensor, the form needed for tracing and ONNX export
+    """
+
+    def __init__(self, w2v2, layer):
+        super().__init__()
+        self.w2v2  = w2v2
+        self.layer = layer
+
+    def forward(self, input_values):
+        if self.layer >= 0:
+            return self.w2v2(input_values, return_dict=False)[0]
+
+        hidden_state = self.w2v2.feature_extractor(input_values).transpose(1, 2)
+
+        return self.w2v2.feature_projection(hidden_state) if self.layer == -1 else hidden_state
+
+def _load_exported(layer_output, backend, cache_path, num_threads):
+    """
+    Returns function running layer_output (traced with TorchScript, or exported to ONNX), loaded
+    from cache_path (+ '.pt' or '.onnx') if it exists, otherwise created and saved there first
+    """
+
+    Path(os.path.dirname(cache_path)).mkdir(parents=True, exist_ok=True)
+
+    # Example input for tracing/export: 2 seconds of audio (input length is dynamic)
+    example = torch.zeros(1, 2 * SAMPLE_RATE)
+
+    if backend.startswith('torchscript'):
+        if not os.path.isfile(cache_path + '.pt'):
+            with torch.no_grad():
+                traced = torch.jit.trace(layer_output, example, check_trace=False)
+
+            torch.jit.save(traced, cache_path + '.part.pt')
+            os.replace(cache_path + '.part.pt', cache_path + '.pt')
+
+        traced = torch.jit.load(cache_path + '.pt')
+        traced.eval()
+
+        # Inline weights as constants and fold them (torch >= 1.8)
+        if hasattr(torch.jit, 'freeze'):
+            traced = torch.jit.freeze(traced)
+
+        return traced
+
+    # onnxruntime is only needed for the onnx backends
+    import onnxruntime
+
+    onnx_path = cache_path + '.onnx'
+
+    if not os.path.isfile(onnx_path):
+        fp32_path = cache_path + ('.fp32.onnx' if backend == 'onnx-int8' else '.part.onnx')
+
+        with torch.no_grad():
+            torch.onnx.export(layer_output, example, fp32_path, input_names=['input_values'], output_names=['hidden_state'],
+                dynamic_axes={ 'input_values' : { 1 : 'samples' }, 'hidden_state' : { 1 : 'frames' } }, opset_version=11)
+
+        if backend == 'onnx-int8':
+            from onnxruntime.quantization import QuantType, quantize_dynamic
+            quantize_dynamic(fp32_path, cache_path + '.part.onnx', weight_type=QuantType.QInt8)
+            os.remove(fp32_path)
+
+        os.replace(cache_path + '.part.onnx', onnx_path)
+
+    options = onnxruntime.SessionOptions()
+    options.intra_op_num_threads     = num_threads or 0 # (0: onnxruntime default)
+    options.inter_op_num_threads     = 1
+    options.execution_mode           = onnxruntime.ExecutionMode.ORT_SEQUENTIAL
+    options.graph_optimization_level = onnxruntime.GraphOptimizationLevel.ORT_ENABLE_ALL
+
+    session = onnxruntime.InferenceSession(onnx_path, options, providers=['CPUExecutionProvider'])
+
+    def _run(input_values):
+        return torch.from_numpy(session.run(None, { 'input_values' : input_values.numpy() })[0])
+
+    return _run
+
+def length_buckets(wav_paths, max_batch_seconds):
+    """
+    Sort wav files by duration and pack them into batches (lists of paths) such that the
+    padded length of each batch (number of files x longest file) is at most max_batch_seconds
+    of audio. Files longer than max_batch_seconds are placed in a batch of their own.
+    """
+
+    durations = { p : sf.info(p).frames for p in wav_paths }
+    budget    = max_batch_seconds * SAMPLE_RATE
+
+    buckets, bucket = [], []
+
+    # In ascending order, each file added is the longest in its bucket so far
+    for path in sorted(wav_paths, key=lambda p: durations[p]):
+        if len(bucket) > 0 and (len(bucket) + 1) * durations[path] > budget:
+            buckets.append(bucket)
+            bucket = []
+
+        bucket.append(path)
+
+    if len(bucket) > 0:
+        buckets.append(bucket)
+
+    return buckets
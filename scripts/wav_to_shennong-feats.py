@@ -1,20 +1,22 @@
 import argparse
 import glob
+import inspect
 import os
-import pickle
 import numpy as np
-import pandas as pd
+from contextlib import ExitStack
+from feature_store import FeatureWriter
+from functools import partial
+from multiprocessing import Pool
+from run_cache import FeatureCache, file_sha1, params_sha1
+from run_profile import RunProfiler, add_profile_args
 from pathlib import Path
+from voice_activity import speech_frames, speech_regions
 
 from shennong.audio import Audio
 from shennong.features.processor.mfcc import MfccProcessor
 from shennong.features.postprocessor.delta import DeltaPostProcessor
 from shennong.features.processor.bottleneck import BottleneckProcessor
 
-mfcc_processor  = MfccProcessor(sample_rate=8000)
-delta_processor = DeltaPostProcessor(order=2)
-bnf_processor   = BottleneckProcessor(weights='BabelMulti')
-
 parser = argparse.ArgumentParser(
     description='example: python wav_to_shennong-feats.py mfcc wrm-pd',
     formatter_class=argparse.ArgumentDefaultsHelpFormatter
@@ -29,71 +31,158 @@ parser.add_argument('--datasets_dir', default='data/raw/datasets', help = "direc
 parser.add_argument('--queries_dir',  default='queries', help = "directory with .wav files for queries")
 parser.add_argument('--references_dir',  default='references', help = "directory with .wav files for references")
 
+parser.add_argument('--feats_dtype',  default='float32', choices=['float32', 'float16'], help = "storage data type of features written to .npy files")
+parser.add_argument('--vad', action='store_true', help = "detect speech regions of each wav file (see voice_activity.py) and store them with the features (queries.speech.csv, references.speech.csv), for feats_to_dtw.py --speech_only")
+parser.add_argument('--cache_dir',  default=None, help = "if given, cache features of each wav file in this directory (keyed by hash of wav file contents and processor parameters), so that re-runs only process new or changed files")
+parser.add_argument('--num_workers',  default=os.cpu_count(), type=int, help = "number of worker processes extracting features")
+
+add_profile_args(parser)
+
 args = parser.parse_args()
 
-def wavs_to_feats_df(wavs_list, feats):
+profiler = RunProfiler.from_args(args, 'wav_to_shennong-feats')
+
+cache = FeatureCache(args.cache_dir) if args.cache_dir is not None else None
+
+# Frame shift of MFCC (default) and BNF features
+FRAME_SECONDS = 0.01
+
+# Processor classes and the arguments they are created with
+PROCESSORS = {
+    'mfcc' : (MfccProcessor, { 'sample_rate' : 8000 }),
+    'delta' : (DeltaPostProcessor, { 'order' : 2 }),
+    'bnf' : (BottleneckProcessor, { 'weights' : 'BabelMulti' })
+}
+
+FEATURE_PROCESSORS = { 'mfcc' : [ 'mfcc', 'delta' ], 'bnf' : [ 'bnf' ] }
+
+# Processors are created on first use in each worker process, so that e.g. the
+# bottleneck network is only loaded when BNF features are requested
+_processors = {}
+
+def get_processor(name):
+    if name not in _processors:
+        with profiler.stage('load_processors'):
+            processor_class, kwargs = PROCESSORS[name]
+            _processors[name] = processor_class(**kwargs)
+
+    return _processors[name]
+
+def processor_params(feats):
+    """
+    Parameters of the processors for feats (mfcc, bnf), i.e. the defaults of their classes updated with
+    the arguments in PROCESSORS, without creating the processors (so that cache hits never load e.g. the
+    bottleneck network)
+    """
+
+    params = {}
 
-    assert feats in ['mfcc', 'bnf'], "Unknown feature parameter for wavs_to_feats_df function: {}".format(feats)
+    for name in FEATURE_PROCESSORS[feats]:
+        processor_class, kwargs = PROCESSORS[name]
+        defaults     = { k : p.default for k, p in inspect.signature(processor_class.__init__).parameters.items() if p.default is not inspect.Parameter.empty }
+        params[name] = dict(defaults, **kwargs)
 
-    feats_list = []
+    return params
 
-    for wav_file in wavs_list:
+def wav_to_feats(wav_file, features):
+    """
+    Returns (filename, { feature : data }, speech regions) for a wav file and a list of features (mfcc, bnf),
+    decoding and resampling the wav file only once for all of them
+    (features are taken from the cache if given and already computed).
+    Speech regions (in seconds) are only detected with --vad, and are otherwise None.
+    """
 
-        wav_data = Audio.load(wav_file).resample(8000)
+    filename   = os.path.splitext(os.path.basename(wav_file))[0] # '.../filename.wav' => 'filename'
+    feats_data = {}
+    wav_data   = None
 
-        assert wav_data.sample_rate == 8000, "Error. Could not resample file to 8000 Hz for MFCC/BNF feature extraction."
-        assert wav_data.nchannels == 1, "Unexpected non-mono file supplied: {}".format(filename)
+    for feats in features:
 
-        if feats == 'mfcc':
-            mfcc_data = mfcc_processor.process(wav_data)
-            mfcc_data = delta_processor.process(mfcc_data)
-            feats_list.append(mfcc_data.data)
+        assert feats in ['mfcc', 'bnf'], "Unknown feature parameter for wav_to_feats function: {}".format(feats)
 
-        elif feats == 'bnf':
-            bnf_data = bnf_processor.process(wav_data)
-            feats_list.append(bnf_data.data)        
+        if cache is not None:
+            with profiler.stage('read_cache'):
+                cache_key = params_sha1(file_sha1(wav_file), feats, processor_params(feats))
+                cached    = cache.get(cache_key)
 
-    feats_df = pd.DataFrame({
-        "filename" : [ os.path.splitext(os.path.basename(f))[0] for f in wavs_list ], # '.../filename.wav' => 'filename',
-        "features" : feats_list
-    })
+            if cached is not None:
+                feats_data[feats] = cached
+                continue
 
-    return feats_df
+        if wav_data is None:
+            with profiler.stage('read_resample'):
+                wav_data = Audio.load(wav_file).resample(8000)
 
-def dir_to_feats_pkl(feats, input_dir, output_pickle):
+            assert wav_data.sample_rate == 8000, "Error. Could not resample file to 8000 Hz for MFCC/BNF feature extraction."
+            assert wav_data.nchannels == 1, "Unexpected non-mono file supplied: {}".format(filename)
+
+        with profiler.stage(feats, items=1, unit='files'):
+            if feats == 'mfcc':
+                mfcc_data = get_processor('mfcc').process(wav_data)
+                mfcc_data = get_processor('delta').process(mfcc_data)
+                feats_data[feats] = mfcc_data.data
+
+            elif feats == 'bnf':
+                bnf_data = get_processor('bnf').process(wav_data)
+                feats_data[feats] = bnf_data.data
+
+        if cache is not None:
+            with profiler.stage('write_cache'):
+                cache.put(cache_key, feats_data[feats])
+
+    regions = None
+
+    if args.vad:
+        with profiler.stage('vad', items=1, unit='files'):
+            audio   = wav_data if wav_data is not None else Audio.load(wav_file)
+            regions = speech_regions(audio.data, audio.sample_rate)
+
+    return filename, feats_data, regions
+
+def dir_to_feats_npy(features, input_dir, output_npys):
+    """
+    Extract features (list of mfcc, bnf) of all wav files in input_dir using a pool of
+    worker processes, writing each type of feature to its path in output_npys
+    """
 
     assert os.path.isdir(input_dir)
 
-    input_wavs = glob.glob(os.path.join(input_dir, "*.wav"))
+    input_wavs = sorted(glob.glob(os.path.join(input_dir, "*.wav")))
+
+    with profiler.stage('extract', items = len(input_wavs), unit = 'files'), ExitStack() as stack, Pool(args.num_workers) as pool:
+        writers = { feats : stack.enter_context(FeatureWriter(output_npys[feats], dtype = args.feats_dtype)) for feats in features }
+
+        # Write features for each wav file as they are extracted (in order of input_wavs, so output is the same for any number of workers)
+        for i, (filename, feats_data, regions) in enumerate(profiler.map(pool.imap, partial(wav_to_feats, features = features), input_wavs)):
+            with profiler.stage('write_features'):
+                for feats, writer in writers.items():
+                    speech = None if regions is None else speech_frames(regions, FRAME_SECONDS, feats_data[feats].shape[0])
+                    writer.append(filename, feats_data[feats], speech = speech)
 
-    feats_df = wavs_to_feats_df(input_wavs, feats)
+            if (i + 1) % 100 == 0:
+                print("{} of {} files in {} processed".format(i + 1, len(input_wavs), input_dir))
 
-    with open(output_pickle, 'wb') as handle:
-        pickle.dump(feats_df, handle)
+        # Let workers exit normally (rather than being terminated on leaving the with block), so that they write their --cprofile statistics
+        pool.close()
+        pool.join()
 
-    print("Features written to {}".format(output_pickle))
+    for feats in features:
+        print("Features written to {}".format(output_npys[feats]))
 
 features = ['mfcc', 'bnf'] if args.features == '_all_' else [ args.features ]
 datasets = [ os.path.basename(p) for p in glob.glob(os.path.join(args.datasets_dir, "*")) ] if args.dataset == '_all_' else [ args.dataset ]
 
 for dataset in datasets:
 
+    # Create output folders if they don't already exist
     for feature in features:
+        Path(os.path.join(args.feats_dir, dataset, feature)).mkdir(parents=True, exist_ok=True)
 
-        # Create output folder if it doesn't already exist
-        ds_feat_output_dir = os.path.join(args.feats_dir, dataset, feature)
-        Path(ds_feat_output_dir).mkdir(parents=True, exist_ok=True)
-
-        queries_wav_dir  = os.path.join(args.datasets_dir, dataset, args.queries_dir)
-        queries_pkl_path = os.path.join(ds_feat_output_dir, "queries.pickle")
-
-        refs_wav_dir    = os.path.join(args.datasets_dir, dataset, args.references_dir)
-        refs_pkl_path   = os.path.join(ds_feat_output_dir, "references.pickle")
+    # All requested features are extracted in a single pass over each directory
+    for split, split_dir in [ ("queries", args.queries_dir), ("references", args.references_dir) ]:
+        wav_dir   = os.path.join(args.datasets_dir, dataset, split_dir)
+        npy_paths = { feature : os.path.join(args.feats_dir, dataset, feature, split + ".npy") for feature in features }
 
-        if feature == 'mfcc':
-            dir_to_feats_pkl("mfcc", queries_wav_dir, queries_pkl_path)
-            dir_to_feats_pkl("mfcc", refs_wav_dir, refs_pkl_path)
+        dir_to_feats_npy(features, wav_dir, npy_paths)
 
-        elif feature == 'bnf':
-            dir_to_feats_pkl("bnf", queries_wav_dir, queries_pkl_path)
-            dir_to_feats_pkl("bnf", refs_wav_dir, refs_pkl_path)
+profiler.report()
@@ -1,35 +1,17 @@
 import os
-import pickle
-import torch
-import soundfile as sf
 import numpy as np
-import pandas as pd
-import torch
+import soundfile as sf
 
 from argparse import ArgumentParser
+from feature_store import FeatureWriter
 from glob import glob
 from transformers import logging
-from transformers.models.wav2vec2 import Wav2Vec2Model
 from pathlib import Path
 from tqdm import tqdm
-
-KNOWN_MODELS = {
-    # Pre-trained
-    'wav2vec2-base': 'facebook/wav2vec2-base',
-    'wav2vec2-large': {'name' : 'facebook/wav2vec2-large', 'revision' : '85c73b1a7c1ee154fd7b06634ca7f42321db94db' },
-    # March 11, 2021 version: https://huggingface.co/facebook/wav2vec2-large/commit/85c73b1a7c1ee154fd7b06634ca7f42321db94db
-    'wav2vec2-large-lv60': 'facebook/wav2vec2-large-lv60',
-    'wav2vec2-large-xlsr-53': {'name' : 'facebook/wav2vec2-large-xlsr-53', 'revision' : '8e86806e53a4df405405f5c854682c785ae271da' },
-    # May 6, 2021 version: https://huggingface.co/facebook/wav2vec2-large-xlsr-53/commit/8e86806e53a4df405405f5c854682c785ae271da
-    
-    # Fine-tuned
-    'wav2vec2-base-960h': 'facebook/wav2vec2-base-960h',
-    'wav2vec2-large-960h': 'facebook/wav2vec2-large-960h',
-    'wav2vec2-large-960h-lv60': 'facebook/wav2vec2-large-960h-lv60',
-    'wav2vec2-large-960h-lv60-self': 'facebook/wav2vec2-large-960h-lv60-self',
-    'wav2vec2-large-xlsr-53-english': 'jonatasgrosman/wav2vec2-large-xlsr-53-english',
-    'wav2vec2-large-xlsr-53-tamil': 'manandey/wav2vec2-large-xlsr-tamil'
-}
+from run_cache import FeatureCache, file_sha1, params_sha1
+from run_profile import RunProfiler, add_profile_args
+from voice_activity import speech_frames, speech_regions
+from w2v2_featurizer import BACKENDS, KNOWN_MODELS, SAMPLE_RATE, load_wav2vec2_featurizer, length_buckets
 
 parser = ArgumentParser(
     prog='Wav2Vec2 Featurizer',
@@ -47,138 +29,257 @@ parser.add_argument('--queries_dir',  default='queries', help = 'directory with
 parser.add_argument('--references_dir',  default='references', help = 'directory with .wav files for references')
 
 parser.add_argument('--model', default='wav2vec2-large-xlsr-53')
+parser.add_argument('--feats_dtype', default='float32', choices=['float32', 'float16'], help='storage data type of features written to .npy files')
+parser.add_argument('--batch_seconds', default=0, type=float, help='featurize wav files in batches of similar length with at most this many seconds of (padded) audio per batch, 0 for one file at a time')
+parser.add_argument('--num_threads', default=None, type=int, help='number of threads used by torch on CPU (default: torch default)')
+parser.add_argument('--backend', default='eager', choices=BACKENDS, help='inference backend (see w2v2_featurizer.py): other than eager, these run on CPU, and features are written to a directory with the backend as suffix (e.g. wav2vec2-large-xlsr-53_transformer-L11_int8). torchscript and onnx backends need a single layer')
+parser.add_argument('--backend_cache_dir', default='data/interim/cache/models', help='directory for models traced or exported by the torchscript and onnx backends')
+parser.add_argument('--chunk_seconds', default=None, type=float, help='if given, featurize audio in streaming mode, in chunks of this many seconds (bounds memory use for long files)')
+parser.add_argument('--left_context_seconds', default=2.0, type=float, help='in streaming mode, seconds of audio before each chunk given to the model as context')
+parser.add_argument('--right_context_seconds', default=2.0, type=float, help='in streaming mode, seconds of audio after each chunk given to the model as context')
+parser.add_argument('--check_streaming', default=0, type=int, help='if > 0, only report difference between streaming and full-context features for this many of the longest references in each dataset')
+parser.add_argument('--check_batching', default=0, type=int, help='if > 0, only report difference between features from batches (of --batch_seconds) and from one file at a time, for this many files (of all lengths) in each dataset')
+parser.add_argument('--batching_tolerance', default=1e-4, type=float, help='with --check_batching, maximum abs difference between batched and unbatched features (otherwise the check fails)')
+parser.add_argument('--vad', action='store_true', help='detect speech regions of each wav file (see voice_activity.py) and store them with the features (queries.speech.csv, references.speech.csv), for feats_to_dtw.py --speech_only')
+parser.add_argument('--cache_dir', default=None, help='if given, cache features of each wav file for each layer in this directory (keyed by hash of wav file contents, model and layer), so that re-runs only featurize new or changed files')
 parser.add_argument('--hft_logging', default=40, help='HuggingFace Transformers verbosity level (40 = errors, 30 = warnings, 20 = info, 10 = debug)')
 
+add_profile_args(parser)
+
 args = parser.parse_args()
 
+profiler = RunProfiler.from_args(args, 'wav_to_w2v2-feats')
+
 logging.set_verbosity(args.hft_logging)
 
-def load_wav2vec2_featurizer(model, layer=None):
-    """
-    Loads Wav2Vec2 featurization pipeline and returns it as a function.
-    Featurizer returns a list with all hidden layer representations if "layer" argument is None.
-    Otherwise, only returns the specified layer representations.
-    """
-
-    model_spec = KNOWN_MODELS.get(model, model)
-    model_kwargs = {}
-    if layer is not None:
-        model_kwargs["num_hidden_layers"] = layer if layer > 0 else 0
-
-    if type(model_spec) is dict:
-        model_name_or_path       = model_spec['name']
-        model_kwargs['revision'] = model_spec['revision']
+cache = FeatureCache(args.cache_dir) if args.cache_dir is not None else None
+
+# Duration of a wav2vec 2.0 output frame (CNN encoder stride of 320 samples at 16 kHz)
+FRAME_SECONDS = 320 / SAMPLE_RATE
+
+def stage_name(layer):
+    # Features from backends other than eager get the backend as suffix, e.g. wav2vec2-large-xlsr-53_transformer-L01_int8
+    suffix = "" if args.backend == 'eager' else "_" + args.backend
+
+    if layer == -2:
+        # e.g. wav2vec2-large-xlsr-53_encoder
+        return "{}_encoder{}".format(args.model, suffix)
+    elif layer == -1:
+        # e.g. wav2vec2-large-xlsr-53_quantizer
+        return "{}_quantizer{}".format(args.model, suffix)
     else:
-        model_name_or_path = model_spec
-    
-    model = Wav2Vec2Model.from_pretrained(model_name_or_path, **model_kwargs)
-
-    num_gpus = torch.cuda.device_count()
-
-    if num_gpus > 1:
-        model = torch.nn.DataParallel(model)
-
-    model.eval()
-    if torch.cuda.is_available():
-        model.cuda()
-
-    @torch.no_grad()
-    def _featurize(path):
-        input_values, rate = sf.read(path, dtype=np.float32)
-        assert rate == 16_000
-        input_values = torch.from_numpy(input_values).unsqueeze(0)
-        if torch.cuda.is_available():
-            input_values = input_values.cuda()
-
-        if layer is None:
-            hidden_states = model(input_values, output_hidden_states=True).hidden_states
-            hidden_states = [s.squeeze(0).cpu().numpy() for s in hidden_states]
-            return hidden_states
-
-        if layer >= 0:
-            hidden_state = model(input_values).last_hidden_state.squeeze(0).cpu().numpy()
-        else:
-            hidden_state = model.feature_extractor(input_values) if num_gpus <= 1 else model.module.feature_extractor(input_values)
-            hidden_state = hidden_state.transpose(1, 2)
-            if layer == -1:
-                hidden_state = model.feature_projection(hidden_state) if num_gpus <= 1 else model.module.feature_projection(hidden_state)
-            hidden_state = hidden_state.squeeze(0).cpu().numpy()
-
-        return hidden_state
-
-    return _featurize
-
-def featurize(wav_paths, layer, stage, dataset):
+        # e.g. wav2vec2-large-xlsr-53_transformer-L01
+        return "{}_transformer-L{}{}".format(args.model, str(layer).zfill(2), suffix)
+
+def feature_keys(wav_path, layers):
+    '''
+    Cache keys for the features of wav_path for each of the given layers
+    '''
+
+    wav_hash  = file_sha1(wav_path)
+    streaming = None if args.chunk_seconds is None else [ args.chunk_seconds, args.left_context_seconds, args.right_context_seconds ]
+
+    # Model spec includes revision for pinned models (and backend, unless eager, so that keys of eager features are unchanged)
+    model_spec = KNOWN_MODELS.get(args.model, args.model) if args.backend == 'eager' else [ KNOWN_MODELS.get(args.model, args.model), args.backend ]
+
+    return { layer : params_sha1(wav_hash, model_spec, layer, streaming) for layer in layers }
+
+def wav_speech_regions(wav_path):
+    '''
+    Speech regions (in seconds) of wav_path if --vad is given, otherwise None
     '''
-    Computes w2v2 from the queries and references files
+
+    if not args.vad:
+        return None
+
+    with profiler.stage('vad', items=1, unit='files'):
+        wav, rate = sf.read(wav_path)
+        return speech_regions(wav, rate)
+
+def append_features(writer, wav_path, features, regions):
+    speech = None if regions is None else speech_frames(regions, FRAME_SECONDS, features.shape[0])
+    writer.append(wav_path.split('/')[-1][:-4], features, speech=speech)
+
+def featurize(featurizer, wav_paths, layers, dataset):
+    '''
+    Computes w2v2 from the queries and references files, writing features for each
+    of the given layers (-2: encoder, -1: quantizer, 1-24: transformer layers) into
+    their own output directory. If more than one layer is given, featurizer should
+    have been loaded with layer=None so that each file only needs one forward pass.
+    If a cache is used, only files with features not already in the cache are featurized.
     '''
 
-    featurizer = load_wav2vec2_featurizer(args.model, layer=layer)
-    
-    fnames_list = []
-    feats_list = []
-    
-    # Create features for each wav file
-    for wav_path in tqdm(wav_paths, ncols=80):
-        proc_set = wav_path.split('/')[-2]
-
-        # Extract features
-        hidden_states = featurizer(wav_path)
-        fnames_list.append(wav_path.split('/')[-1][:-4])
-        # print(hidden_states.shape)
-        feats_list.append(hidden_states)
-
-    feats_df = pd.DataFrame({
-        'filename' : fnames_list,
-        'features' : feats_list
-    })
-
-    if layer < 0:
-        # e.g. wav2vec2-large-xlsr-53_encoder or # wav2vec2-large-xlsr-53_quantizer
-        stage_name = "{}_{}".format(args.model, stage)
+    proc_set = wav_paths[0].split('/')[-2]
+
+    writers = {}
+
+    for layer in layers:
+        ds_feat_output_dir = os.path.join(args.feats_dir, dataset, stage_name(layer))
+        Path(ds_feat_output_dir).mkdir(parents=True, exist_ok=True)
+
+        writers[layer] = FeatureWriter(ds_feat_output_dir + '/' + proc_set + '.npy', dtype=args.feats_dtype)
+
+    if cache is not None:
+        with profiler.stage('hash_wavs'):
+            keys      = { p : feature_keys(p, layers) for p in wav_paths }
+            new_paths = [ p for p in wav_paths if not all(k in cache for k in keys[p].values()) ]
+
+        print(f'{len(wav_paths) - len(new_paths)} of {len(wav_paths)} files in {proc_set} already featurized (cached in {args.cache_dir})')
     else:
-        # e.g. wav2vec2-large-xlsr-53_transformer-L01
-        stage_name = "{}_{}-L{}".format(args.model, stage, str(layer).zfill(2))
+        new_paths = wav_paths
+
+    batches = length_buckets(new_paths, args.batch_seconds) if args.batch_seconds > 0 else [ [ p ] for p in new_paths ]
+
+    # Write features for each wav file as they are created (or, if using a cache, add them to the cache)
+    with tqdm(total=len(new_paths), ncols=80) as pbar:
+        for batch in batches:
+            # Extract features
+            with profiler.stage('featurize', items=len(batch), unit='files'):
+                batch_states = featurizer(batch)
+
+            for wav_path, hidden_states in zip(batch, batch_states):
+                hidden_states = hidden_states if len(layers) > 1 else { layers[0] : hidden_states }
+                regions       = wav_speech_regions(wav_path) if cache is None else None
+
+                with profiler.stage('write_features'):
+                    for layer, writer in writers.items():
+                        assert layer in hidden_states, f'Layer {layer} not available from model {args.model}'
+
+                        if cache is not None:
+                            cache.put(keys[wav_path][layer], hidden_states[layer])
+                        else:
+                            append_features(writer, wav_path, hidden_states[layer], regions)
+
+            pbar.update(len(batch))
 
-    ds_feat_output_dir = os.path.join(args.feats_dir, dataset, stage_name)
-    Path(ds_feat_output_dir).mkdir(parents=True, exist_ok=True)
-    
-    with open(ds_feat_output_dir + '/' + proc_set + '.pickle', 'wb') as handle:
-        pickle.dump(feats_df, handle)
+    with profiler.stage('write_features'):
+        if cache is not None:
+            for wav_path in wav_paths:
+                regions = wav_speech_regions(wav_path)
+
+                for layer, writer in writers.items():
+                    append_features(writer, wav_path, cache.get(keys[wav_path][layer]), regions)
+
+        for writer in writers.values():
+            writer.close()
+
+def check_streaming(featurizer, wav_paths, layers):
+    '''
+    Reports how far features from the streaming featurizer drift from those
+    computed with the full file as context, for the longest files in wav_paths
+    '''
+
+    full_featurizer = load_wav2vec2_featurizer(args.model, layer=layers[0] if len(layers) == 1 else None, num_threads=args.num_threads,
+        backend=args.backend, backend_cache_dir=args.backend_cache_dir)
+
+    wav_paths = sorted(wav_paths, key=lambda p: sf.info(p).frames, reverse=True)[:args.check_streaming]
+
+    for wav_path in wav_paths:
+        full_states   = full_featurizer(wav_path)
+        stream_states = featurizer(wav_path)
+
+        if len(layers) == 1:
+            full_states, stream_states = { layers[0] : full_states }, { layers[0] : stream_states }
+
+        for layer in layers:
+            full, stream = full_states[layer], stream_states[layer]
+            assert full.shape == stream.shape, f'Streaming features for {wav_path} have shape {stream.shape}, expected {full.shape}'
+
+            cosine = np.sum(full * stream, axis=1) / (np.linalg.norm(full, axis=1) * np.linalg.norm(stream, axis=1))
+
+            print("{} ({:.1f} s), {}: mean abs diff = {:.6f}, max abs diff = {:.6f}, min frame cosine similarity = {:.6f}".format(
+                wav_path, sf.info(wav_path).duration, stage_name(layer), np.abs(full - stream).mean(), np.abs(full - stream).max(), cosine.min()
+            ))
+
+def check_batching(featurizer, wav_paths, layers):
+    '''
+    Reports how far features of files featurized together in zero-padded batches differ from
+    those of the same files featurized one at a time, for a sample of files of all lengths in wav_paths
+    '''
+
+    wav_paths = sorted(wav_paths, key=lambda p: sf.info(p).frames)
+    wav_paths = [ wav_paths[i] for i in np.unique(np.linspace(0, len(wav_paths) - 1, args.check_batching).round().astype(int)) ]
+    batches   = length_buckets(wav_paths, args.batch_seconds)
+
+    max_diffs = { layer : 0 for layer in layers }
+
+    for batch in batches:
+        for wav_path, batch_states in zip(batch, featurizer(batch)):
+            single_states = featurizer(wav_path)
+
+            if len(layers) == 1:
+                batch_states, single_states = { layers[0] : batch_states }, { layers[0] : single_states }
+
+            for layer in layers:
+                assert layer in batch_states, f'Layer {layer} not available from model {args.model}'
+
+                batched, single = batch_states[layer], single_states[layer]
+                assert batched.shape == single.shape, f'Batched features for {wav_path} have shape {batched.shape}, expected {single.shape}'
+
+                max_diffs[layer] = max(max_diffs[layer], np.abs(batched - single).max())
+
+    print("{} files in {} batches (of up to {} files, {} s of padded audio):".format(len(wav_paths), len(batches), max(len(b) for b in batches), args.batch_seconds))
+
+    for layer in layers:
+        print("{}: max abs diff = {:.2e} ({} tolerance {:.0e})".format(
+            stage_name(layer), max_diffs[layer], 'within' if max_diffs[layer] <= args.batching_tolerance else 'EXCEEDS', args.batching_tolerance
+        ))
+
+    assert max(max_diffs.values()) <= args.batching_tolerance, 'Batched features differ from unbatched features by more than --batching_tolerance'
 
 def main():
-    datasets = [ os.path.basename(p) for p in glob.glob(os.path.join(args.datasets_dir, '*')) ] if args.dataset == '_all_' else [ args.dataset ]
+    datasets = [ os.path.basename(p) for p in glob(os.path.join(args.datasets_dir, '*')) ] if args.dataset == '_all_' else [ args.dataset ]
 
     assert args.stage in ['encoder', 'quantizer', 'transformer', '_all_'], 'Unknown wav2vec 2.0 stage specified: {}'.format(args.stage)
     stages = [ 'encoder', 'quantizer', 'transformer' ] if args.stage == '_all_' else [ args.stage ]
 
+    layers = []
+
+    for stage in stages:
+
+        if stage == 'encoder':
+            layers += [-2]
+
+        if stage == 'quantizer':
+            layers += [-1]
+
+        if stage == 'transformer':
+            if args.layer == '_all_':
+                layers += list(range(1, 25))
+            else:
+                assert int(args.layer) > 0 or int(args.layer) <= 24, f'Specified transformer layer {args.layer} out of range'
+                layers += [ int(args.layer) ]
+
+    # Load model once: if more than one layer is needed, all layers are
+    # extracted from a single forward pass of the full model for each file
+    with profiler.stage('load_model'):
+        featurizer = load_wav2vec2_featurizer(args.model, layer=layers[0] if len(layers) == 1 else None, num_threads=args.num_threads,
+            chunk_seconds=args.chunk_seconds, left_context_seconds=args.left_context_seconds, right_context_seconds=args.right_context_seconds, profiler=profiler,
+            backend=args.backend, backend_cache_dir=args.backend_cache_dir)
+
     for dataset in datasets:
 
-        for stage in stages:
-            
-            # Check wav files in input directory
-            queries_wav_paths = glob(os.path.join(args.datasets_dir, dataset, args.queries_dir) + '/*.wav')
-            assert len(queries_wav_paths) > 0, f'No wav files found in {args.input_dir}'
+        # Check wav files in input directory
+        queries_wav_paths = glob(os.path.join(args.datasets_dir, dataset, args.queries_dir) + '/*.wav')
+        assert len(queries_wav_paths) > 0, f'No wav files found in {os.path.join(args.datasets_dir, dataset, args.queries_dir)}'
 
-            refs_wav_paths = glob(os.path.join(args.datasets_dir, dataset, args.references_dir) + '/*.wav')
-            assert len(refs_wav_paths) > 0, f'No wav files found in {args.input_dir}'
+        refs_wav_paths = glob(os.path.join(args.datasets_dir, dataset, args.references_dir) + '/*.wav')
+        assert len(refs_wav_paths) > 0, f'No wav files found in {os.path.join(args.datasets_dir, dataset, args.references_dir)}'
 
-            if stage == 'encoder':
-                layers = [-2]
+        if args.check_streaming > 0:
+            assert args.chunk_seconds is not None, '--check_streaming requires --chunk_seconds'
+            check_streaming(featurizer, refs_wav_paths, layers)
+            continue
 
-            if stage == 'quantizer':
-                layers = [-1]
-            
-            if stage == 'transformer':
-                if args.layer == '_all_':
-                    layers = list(range(1, 25))
-                else:
-                    assert int(args.layer) > 0 or int(args.layer) <= 24, f'Specified transformer layer {args.layer} out of range'
-                    layers = [ int(args.layer) ]
+        if args.check_batching > 0:
+            assert args.batch_seconds > 0 and args.chunk_seconds is None, '--check_batching requires --batch_seconds (and no --chunk_seconds, as streaming mode featurizes one file at a time)'
+            check_batching(featurizer, queries_wav_paths + refs_wav_paths, layers)
+            continue
 
-            for layer in layers:
-                featurize(queries_wav_paths, layer, stage, dataset)
-                featurize(refs_wav_paths, layer, stage, dataset)             
+        featurize(featurizer, queries_wav_paths, layers, dataset)
+        featurize(featurizer, refs_wav_paths, layers, dataset)
+
+    profiler.report()
 
 if __name__ == '__main__':
     main()                  